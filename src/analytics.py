@@ -0,0 +1,237 @@
+import csv
+import logging
+import os
+import pickle
+import shutil
+from collections import Counter
+from datetime import datetime, time, timedelta, timezone
+import metrics
+
+STATE_FILE = 'state.pkl'
+
+# Columns of chat_history the analytics read
+COLUMNS = ('chat_id', 'id', 'date', 'sender', 'text')
+
+# Hashed feature space of the message vectors; collisions only blur the topics slightly
+N_FEATURES = 2 ** 18
+
+# Messages no analytics run looks further back than
+ANALYTICS_EPOCH = datetime(2013, 8, 1, tzinfo=timezone.utc)
+
+
+class TopTerms:
+    """
+    Approximate term counts with bounded memory.
+
+    Once more than 2 * `capacity` terms are tracked, all but the `capacity` most
+    frequent are dropped, so rare terms are forgotten while frequent ones keep
+    (close to) their exact counts.
+    """
+
+    def __init__(self, capacity=5000):
+        self.capacity = capacity
+        self.counts = Counter()
+
+    def update(self, terms):
+        self.counts.update(terms)
+        if len(self.counts) > 2 * self.capacity:
+            self.counts = Counter(dict(self.counts.most_common(self.capacity)))
+
+    def top(self, n):
+        return self.counts.most_common(n)
+
+
+class ChatAnalytics:
+    """
+    Incremental, out-of-core analytics of chat_history.
+
+    History is read from the sink one day at a time, in chunks of `chunk_rows`
+    messages (see Sink.read_history), so memory is bounded by the chunk size and
+    the model, never by the size of the history. Messages are vectorized with a
+    HashingVectorizer (no vocabulary to hold), weighted by inverse document
+    frequencies counted incrementally in the hashed space, and clustered into
+    topics with MiniBatchKMeans.partial_fit.
+
+    The model, the document frequencies, the per-topic term counts and the last
+    processed day are persisted in `directory` after every day, so each run only
+    reads the days completed since the previous one. Only complete (past, UTC)
+    days are processed; messages backloaded into already processed days are not
+    picked up. For every day, `directory/daily/YYYY-MM-DD/` gets:
+
+    - frequency.csv: chat_id, messages, senders
+    - top_terms.csv: chat_id, rank, term, count
+    - topics.csv: chat_id, id, topic (-1 for messages without text)
+
+    and `directory/topics.csv` lists the size and top terms of every topic.
+    Requires the `scikit-learn` package.
+    """
+
+    def __init__(self, sink, directory, n_topics=10, chunk_rows=10000, top_terms=30, n_features=N_FEATURES):
+        """
+        Args:
+            sink (Sink): The sink to read chat_history from.
+            directory (str): The directory of the model state and the outputs, created if missing.
+            n_topics (int): The number of topics to cluster messages into.
+            chunk_rows (int): The number of messages read and vectorized at a time.
+            top_terms (int): The number of top terms listed per chat and day and per topic.
+            n_features (int): The size of the hashed feature space.
+        """
+        from sklearn.feature_extraction import FeatureHasher
+        from sklearn.feature_extraction.text import HashingVectorizer
+
+        os.makedirs(directory, exist_ok=True)
+        self.sink = sink
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        self.top_terms = top_terms
+        self.state = self._load_state() or self._new_state(n_topics, n_features)
+        # Messages are tokenized once, for the term counts and the hashing alike
+        self.analyzer = HashingVectorizer(stop_words='english').build_analyzer()
+        self.hasher = FeatureHasher(n_features=self.state['n_features'], input_type='string', alternate_sign=False)
+
+    def _new_state(self, n_topics, n_features):
+        import numpy as np
+        from sklearn.cluster import MiniBatchKMeans
+
+        return {
+            'processed_through': None,
+            'n_features': n_features,
+            'documents': 0,
+            'document_frequencies': np.zeros(n_features, dtype=np.float64),
+            'model': MiniBatchKMeans(n_clusters=n_topics, random_state=0, n_init=3),
+            'fitted': False,
+            'topic_sizes': [0] * n_topics,
+            'topic_terms': [TopTerms() for _ in range(n_topics)],
+        }
+
+    def _load_state(self):
+        path = os.path.join(self.directory, STATE_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        logging.info(f"Loaded analytics state processed through {state['processed_through']} ({state['documents']} messages)")
+        return state
+
+    def _save_state(self):
+        path = os.path.join(self.directory, STATE_FILE)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self.state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    async def run(self, start_date=None, end_date=None):
+        """
+        Processes the days after the last processed one, up to yesterday.
+
+        Args:
+            start_date (date, optional): The first day to process if nothing was processed yet.
+                Defaults to the first day with messages.
+            end_date (date, optional): The last day to process. Defaults to yesterday (UTC).
+
+        Returns:
+            int: The number of days processed.
+        """
+        end_date = end_date or datetime.now(timezone.utc).date() - timedelta(days=1)
+        if self.state['processed_through']:
+            start_date = self.state['processed_through'] + timedelta(days=1)
+        first = datetime.combine(start_date, time.min, tzinfo=timezone.utc) if start_date else ANALYTICS_EPOCH
+        last = datetime.combine(end_date + timedelta(days=1), time.min, tzinfo=timezone.utc)
+        if first >= last:
+            logging.info(f"Analytics are up to date through {self.state['processed_through']}")
+            return 0
+
+        days = await self.sink.history_days(first, last)
+        logging.info(f"Processing analytics of {len(days)} days from {first.date()} to {end_date}")
+        for day in days:
+            with metrics.timed('stage_duration_seconds', stage='analytics', chat='all'):
+                await self._process_day(day)
+            self.state['processed_through'] = day
+            self._save_state()
+        # Days without messages count as processed too
+        self.state['processed_through'] = end_date
+        self._save_state()
+        self._write_topics()
+        return len(days)
+
+    async def _process_day(self, day):
+        day_start = datetime.combine(day, time.min, tzinfo=timezone.utc)
+        output = os.path.join(self.directory, 'daily', day.isoformat())
+        tmp_output = f"{output}.tmp"
+        shutil.rmtree(tmp_output, ignore_errors=True)
+        os.makedirs(tmp_output)
+
+        messages = Counter()
+        senders = {}
+        terms = {}
+        with open(os.path.join(tmp_output, 'topics.csv'), 'w', newline='', encoding='utf-8') as f:
+            topics = csv.writer(f)
+            topics.writerow(('chat_id', 'id', 'topic'))
+            async for rows in self.sink.read_history(day_start, day_start + timedelta(days=1), COLUMNS, self.chunk_rows):
+                tokens = [self.analyzer(row['text'] or '') for row in rows]
+                for row, row_tokens in zip(rows, tokens):
+                    chat_id = row['chat_id']
+                    messages[chat_id] += 1
+                    if row['sender']:
+                        senders.setdefault(chat_id, set()).add(row['sender'])
+                    terms.setdefault(chat_id, TopTerms()).update(row_tokens)
+                for row, topic in zip(rows, self._assign_topics(tokens)):
+                    topics.writerow((row['chat_id'], row['id'], topic))
+
+        with open(os.path.join(tmp_output, 'frequency.csv'), 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(('chat_id', 'messages', 'senders'))
+            for chat_id, count in sorted(messages.items()):
+                writer.writerow((chat_id, count, len(senders.get(chat_id, ()))))
+        with open(os.path.join(tmp_output, 'top_terms.csv'), 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(('chat_id', 'rank', 'term', 'count'))
+            for chat_id, chat_terms in sorted(terms.items()):
+                for rank, (term, count) in enumerate(chat_terms.top(self.top_terms), 1):
+                    writer.writerow((chat_id, rank, term, count))
+
+        shutil.rmtree(output, ignore_errors=True)
+        os.replace(tmp_output, output)
+        metrics.inc('messages_analyzed', sum(messages.values()))
+        logging.info(f"Analyzed {sum(messages.values())} messages of {len(messages)} chats on {day}")
+
+    def _assign_topics(self, tokens):
+        """
+        Updates the model with a chunk of tokenized messages and returns their topics.
+        """
+        import numpy as np
+        from sklearn.preprocessing import normalize
+
+        state = self.state
+        model = state['model']
+        topics = np.full(len(tokens), -1)
+        with_text = [i for i, row_tokens in enumerate(tokens) if row_tokens]
+        if not with_text:
+            return topics.tolist()
+
+        counts = self.hasher.transform(tokens[i] for i in with_text)
+        state['documents'] += len(with_text)
+        state['document_frequencies'] += np.bincount(counts.indices, minlength=state['n_features'])
+        idf = np.log((1 + state['documents']) / (1 + state['document_frequencies'])) + 1
+        vectors = normalize(counts.multiply(idf).tocsr())
+
+        # The first fit needs at least one message per topic
+        if not state['fitted'] and len(with_text) < model.n_clusters:
+            return topics.tolist()
+        model.partial_fit(vectors)
+        state['fitted'] = True
+        labels = model.predict(vectors)
+        topics[with_text] = labels
+        for i, label in zip(with_text, labels):
+            state['topic_sizes'][label] += 1
+            state['topic_terms'][label].update(tokens[i])
+        return topics.tolist()
+
+    def _write_topics(self):
+        path = os.path.join(self.directory, 'topics.csv')
+        with open(f"{path}.tmp", 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(('topic', 'messages', 'top_terms'))
+            for topic, (size, topic_terms) in enumerate(zip(self.state['topic_sizes'], self.state['topic_terms'])):
+                writer.writerow((topic, size, ' '.join(term for term, _ in topic_terms.top(self.top_terms))))
+        os.replace(f"{path}.tmp", path)
@@ -0,0 +1,220 @@
+import json
+import logging
+import os
+from datetime import date, datetime, timezone
+from io import BytesIO
+import metrics
+
+# Schema files of the BigQuery tables, shared with terraform/modules/bigquery
+SCHEMA_DIR = os.getenv(
+    "SCHEMA_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'terraform', 'modules', 'bigquery'),
+)
+
+_schema_cache = {}
+
+
+def load_table_schema(table_type):
+    """
+    Loads the BigQuery schema of a table type from its JSON file.
+
+    Args:
+        table_type (str): One of 'chat_config', 'chat_history', 'chat_info', 'user_info', 'message_deletions'.
+
+    Returns:
+        list: The schema fields as dictionaries with 'name', 'type' and 'mode' keys.
+    """
+    if table_type not in _schema_cache:
+        with open(os.path.join(SCHEMA_DIR, f"{table_type}.json")) as f:
+            _schema_cache[table_type] = json.load(f)
+    return _schema_cache[table_type]
+
+
+# Converters raise TypeError or ValueError for values they cannot coerce
+
+def _to_int(value):
+    return int(value)
+
+
+def _to_float(value):
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return float(value)
+
+
+def _to_timestamp(value):
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, tz=timezone.utc)
+    if isinstance(value, str):
+        try:
+            return datetime.strptime(value, '%Y-%m-%d %H:%M:%S %z')
+        except ValueError:
+            return datetime.fromisoformat(value)
+    raise TypeError(f"cannot convert {type(value).__name__} to a timestamp")
+
+
+def _to_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, str):
+        return date.fromisoformat(value)
+    return value
+
+
+def _to_str(value):
+    return value if isinstance(value, str) else str(value)
+
+
+_CONVERTERS = {
+    'INTEGER': _to_int,
+    'INT64': _to_int,
+    'FLOAT': _to_float,
+    'FLOAT64': _to_float,
+    'BOOLEAN': bool,
+    'BOOL': bool,
+    'STRING': _to_str,
+    'TIMESTAMP': _to_timestamp,
+    'DATE': _to_date,
+}
+
+# Rough in-memory size of non-string values, used for the flush threshold
+_FIXED_SIZE = 8
+
+
+def _field_converter(field):
+    """
+    Returns the function coercing values of a schema field, including RECORD and REPEATED fields.
+    """
+    if field['type'] in ('RECORD', 'STRUCT'):
+        subfields = [(subfield['name'], _field_converter(subfield)) for subfield in field['fields']]
+
+        def converter(value):
+            if not isinstance(value, dict):
+                raise TypeError(f"cannot convert {type(value).__name__} to a record")
+            return {
+                name: (convert(value[name]) if value.get(name) is not None else None)
+                for name, convert in subfields
+            }
+    else:
+        converter = _CONVERTERS[field['type']]
+    if field.get('mode') == 'REPEATED':
+        return (lambda c: lambda values: [c(v) for v in values or []])(converter)
+    return converter
+
+
+class ColumnarBuffer:
+    """
+    Accumulates rows column by column, typed from a BigQuery schema file.
+
+    Values are coerced to the schema type as they are added. A value that cannot be
+    coerced becomes NULL rather than failing the whole load, and is counted in
+    `coercion_failures` by column; the first failure of each column is logged.
+    The buffer is encoded to Parquet (via an Arrow RecordBatch) in one pass when
+    flushed.
+    """
+
+    def __init__(self, table_type):
+        self.fields = load_table_schema(table_type)
+        self._columns = {field['name']: [] for field in self.fields}
+        self._converters = []
+        for field in self.fields:
+            is_string = field['type'] == 'STRING' and field.get('mode') != 'REPEATED'
+            self._converters.append((field['name'], _field_converter(field), is_string))
+        self.rows = 0
+        self.nbytes = 0
+        self._failed_columns = set()
+
+    def __len__(self):
+        return self.rows
+
+    def add(self, row):
+        """
+        Appends a row dictionary. Keys that are not in the schema are ignored.
+        """
+        columns = self._columns
+        nbytes = 0
+        for name, converter, is_string in self._converters:
+            value = row.get(name)
+            if value is not None:
+                try:
+                    value = converter(value)
+                except (TypeError, ValueError, OverflowError) as e:
+                    self._coercion_failed(name, value, e)
+                    value = None
+                nbytes += len(value) if is_string and value is not None else _FIXED_SIZE
+            columns[name].append(value)
+        self.rows += 1
+        self.nbytes += nbytes
+
+    def _coercion_failed(self, name, value, error):
+        metrics.inc('coercion_failures', column=name)
+        if name not in self._failed_columns:
+            self._failed_columns.add(name)
+            logging.warning(f"Writing NULL for {name} value {value!r} of type {type(value).__name__}: {error}")
+
+    def to_record_batch(self):
+        """
+        Builds an Arrow RecordBatch from the buffered columns.
+        """
+        import pyarrow as pa
+
+        arrays = [pa.array(self._columns[field['name']], type=_arrow_type(field)) for field in self.fields]
+        return pa.RecordBatch.from_arrays(arrays, names=[field['name'] for field in self.fields])
+
+    def to_parquet(self):
+        """
+        Encodes the buffered rows as Parquet and resets the buffer.
+
+        Returns:
+            bytes: The Parquet file contents.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        batch = self.to_record_batch()
+        sink = BytesIO()
+        pq.write_table(pa.Table.from_batches([batch]), sink, compression='snappy')
+        self._columns = {name: [] for name in self._columns}
+        self.rows = 0
+        self.nbytes = 0
+        return sink.getvalue()
+
+
+def _arrow_type(field):
+    import pyarrow as pa
+
+    if field['type'] in ('RECORD', 'STRUCT'):
+        base = pa.struct([pa.field(subfield['name'], _arrow_type(subfield)) for subfield in field['fields']])
+        return pa.list_(base) if field.get('mode') == 'REPEATED' else base
+
+    base = {
+        'INTEGER': pa.int64(),
+        'INT64': pa.int64(),
+        'FLOAT': pa.float64(),
+        'FLOAT64': pa.float64(),
+        'BOOLEAN': pa.bool_(),
+        'BOOL': pa.bool_(),
+        'STRING': pa.string(),
+        'TIMESTAMP': pa.timestamp('us', tz='UTC'),
+        'DATE': pa.date32(),
+    }[field['type']]
+    if field.get('mode') == 'REPEATED':
+        return pa.list_(base)
+    return base
+
+
+def bigquery_schema(table_type):
+    """
+    Returns the schema of a table type as BigQuery SchemaField objects.
+    """
+    from google.cloud.bigquery import SchemaField
+
+    def schema_field(field):
+        return SchemaField(
+            field['name'], field['type'], mode=field.get('mode', 'NULLABLE'), description=field.get('description'),
+            fields=[schema_field(subfield) for subfield in field.get('fields', ())],
+        )
+
+    return [schema_field(field) for field in load_table_schema(table_type)]
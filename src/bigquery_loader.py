@@ -1,11 +1,36 @@
 import logging
-from google.cloud.bigquery import LoadJobConfig, SourceFormat 
+import asyncio
+import time
+import metrics
+from google.cloud.bigquery import LoadJobConfig, QueryJobConfig, ScalarQueryParameter, SourceFormat 
+from google.cloud.bigquery.format_options import ParquetOptions
 from google.api_core.exceptions import BadRequest, GoogleAPIError
 import json
-from io import StringIO
+from datetime import timedelta
+from io import BytesIO
+from arrow_encoder import ColumnarBuffer, bigquery_schema, load_table_schema
+from sinks.base import DEFAULT_MAX_ROWS, DEFAULT_MAX_BYTES
 
+# Load formats of BigQueryBatchWriter
+FORMAT_JSON = 'json'
+FORMAT_PARQUET = 'parquet'
+LOAD_FORMATS = (FORMAT_JSON, FORMAT_PARQUET)
 
-async def upload_to_bigquery(client, data, table_type, dataset_id, table_chat_config, table_chat_history, table_chat_info, table_user_info):
+# Retries of failed load jobs, the first after LOAD_RETRY_BACKOFF seconds and doubling
+DEFAULT_LOAD_RETRIES = 3
+LOAD_RETRY_BACKOFF = 2.0
+
+# Rows written with streaming inserts (the stream mode) cannot be changed by DML
+# while they are in the table's streaming buffer. The stream writes rows within
+# seconds of their message being sent or edited, so the rows whose date or
+# edit_date is at most this much older than the buffer's oldest entry may be in it
+STREAMED_ROW_LAG = timedelta(hours=1)
+
+# Condition on a chat_history row (as `target`) of not being streamed after @streamed_after
+NOT_STREAMED = "target.date < @streamed_after AND IFNULL(target.edit_date, 0) < UNIX_SECONDS(@streamed_after)"
+
+
+async def upload_to_bigquery(client, data, table_type, dataset_id, table_chat_config, table_chat_history, table_chat_info, table_user_info, spool=None):
     """
     Uploads data to a BigQuery table.
 
@@ -18,6 +43,7 @@ async def upload_to_bigquery(client, data, table_type, dataset_id, table_chat_co
         table_chat_history: The ID of the table for chat history data.
         table_chat_info: The ID of the table for chat information data.
         table_user_info: The ID of the table for user information data.
+        spool (Spool, optional): Spool the payload is written to before it is loaded.
 
     Raises:
         ValueError: If the data is invalid or the table type is invalid.
@@ -26,14 +52,14 @@ async def upload_to_bigquery(client, data, table_type, dataset_id, table_chat_co
         Exception: If there is any other error when uploading the data.
 
     Returns:
-        None
+        bool: True if the data was loaded, False otherwise.
     """
     try:
         validate_data(data)
 
     except ValueError as e:
         logging.error(f"Invalid data: {e}")
-        return
+        return False
     
     table_id_mapping = {
         'chat_config': table_chat_config,
@@ -46,23 +72,54 @@ async def upload_to_bigquery(client, data, table_type, dataset_id, table_chat_co
     if not table_id:
         raise ValueError(f"Invalid table type: {table_type}")
 
-    json_data = [json.dumps(obj) for obj in data]
-    newline_delimited_data = "\n".join(json_data)
+    payload = b"".join(json.dumps(obj).encode('utf-8') + b"\n" for obj in data)
+    logging.info(f"Sample data (first item): {json.dumps(data[0], indent=2)}")
+    if spool is not None:
+        segment = await asyncio.to_thread(spool.append, table_type, FORMAT_JSON, len(data), payload)
+        return await load_spooled(client, spool, segment, payload, dataset_id, table_id, SourceFormat.NEWLINE_DELIMITED_JSON)
+    return await load_payload(client, payload, dataset_id, table_id)
+
 
+async def load_payload(client, payload, dataset_id, table_id, source_format=SourceFormat.NEWLINE_DELIMITED_JSON, schema=None, retries=0):
+    """
+    Loads an encoded file (newline-delimited JSON or Parquet) into a BigQuery table.
+
+    The load job is submitted and awaited in a worker thread so the event loop
+    keeps running while BigQuery processes it. Failed loads are retried with
+    exponential backoff, except for rejected payloads (BadRequest) which fail the
+    same way every time.
+
+    Args:
+        client: The BigQuery client object.
+        payload (bytes): The encoded rows.
+        dataset_id: The ID of the dataset containing the table.
+        table_id: The ID of the table.
+        source_format: The BigQuery source format of the payload.
+        schema (list, optional): Explicit table schema. Schema autodetection is used when omitted.
+        retries (int): The number of times a failed load is retried.
+
+    Returns:
+        bool: True if the load job succeeded, False otherwise.
+    """
     logging.info(f"Uploading data to BigQuery table: {table_id}")
-    try:
+
+    def run_load():
         table_ref = client.dataset(dataset_id).table(table_id)
         job_config = LoadJobConfig()
-        job_config.source_format = SourceFormat.NEWLINE_DELIMITED_JSON
-        job_config.autodetect = True
-
-        # Create a StringIO object to simulate a file
-        data_file = StringIO(newline_delimited_data)
-
-        logging.info(f"Sample data (first item): {json.dumps(data[0], indent=2)}")
+        job_config.source_format = source_format
+        if source_format == SourceFormat.PARQUET:
+            # REPEATED columns are written as Parquet LISTs, which only match the
+            # table schema with list inference (otherwise they read as field.list[].element)
+            parquet_options = ParquetOptions()
+            parquet_options.enable_list_inference = True
+            job_config.parquet_options = parquet_options
+        if schema:
+            job_config.schema = schema
+        else:
+            job_config.autodetect = True
 
         job = client.load_table_from_file(
-            data_file,
+            BytesIO(payload),
             table_ref,
             location='us-central1',
             job_config=job_config,
@@ -70,18 +127,408 @@ async def upload_to_bigquery(client, data, table_type, dataset_id, table_chat_co
 
         job.result()  # Wait for the job to complete
 
-        logging.info(f"Data uploaded to BigQuery table {table_id} successfully")
+    for attempt in range(retries + 1):
+        if attempt:
+            delay = LOAD_RETRY_BACKOFF * 2 ** (attempt - 1)
+            logging.warning(f"Retrying load into {table_id} in {delay:.0f}s (attempt {attempt + 1} of {retries + 1})")
+            await asyncio.sleep(delay)
+        try:
+            with metrics.timed('load_job_duration_seconds', table=table_id):
+                await asyncio.to_thread(run_load)
+            logging.info(f"Data uploaded to BigQuery table {table_id} successfully")
+            return True
 
-    except BadRequest as e:
-        logging.error(f"Bad request error: {e}")
-        logging.error(f"Error details: {e.errors}")
-    except GoogleAPIError as e:
-        logging.error(f"Error connecting to BigQuery: {e}")
-    except ValueError as e:
-        logging.error(f"Invalid JSON data: {e}")
-    except Exception as e:
-        logging.error(f"Error occurred when uploading data to BigQuery: {e}")
-        logging.error(f"Error type: {type(e)}")
+        except BadRequest as e:
+            logging.error(f"Bad request error: {e}")
+            logging.error(f"Error details: {e.errors}")
+            return False
+        except GoogleAPIError as e:
+            logging.error(f"Error connecting to BigQuery: {e}")
+        except ValueError as e:
+            logging.error(f"Invalid JSON data: {e}")
+            return False
+        except Exception as e:
+            logging.error(f"Error occurred when uploading data to BigQuery: {e}")
+            logging.error(f"Error type: {type(e)}")
+    return False
+
+
+async def load_spooled(client, spool, segment, payload, dataset_id, table_id, source_format, schema=None, retries=DEFAULT_LOAD_RETRIES):
+    """
+    Loads a spooled payload and deletes its segment once the load is confirmed.
+
+    A segment whose load fails stays in the spool for the next run.
+
+    Returns:
+        bool: True if the load job succeeded, False otherwise.
+    """
+    if not await load_payload(client, payload, dataset_id, table_id, source_format, schema, retries=retries):
+        logging.error(f"Keeping {segment} in the spool after its load into {table_id} failed")
+        return False
+    await asyncio.to_thread(spool.remove, segment)
+    return True
+
+
+class BigQueryBatchWriter:
+    """
+    Streams rows to a BigQuery table in bounded chunks.
+
+    Rows are encoded as they arrive and flushed as a chunk once `max_rows` rows or
+    `max_bytes` bytes are buffered. With the 'json' format rows are encoded as
+    newline-delimited JSON and the schema is autodetected; with 'parquet' they are
+    collected into typed columns (see arrow_encoder.ColumnarBuffer) and loaded as
+    Parquet with the explicit schema from the table's schema file. Chunks go through a bounded queue to `workers`
+    upload tasks whose load jobs run in worker threads, so fetching continues while
+    BigQuery loads. When the queue is full `add` waits, which bounds memory to
+    roughly (max_pending + workers + 1) chunks. With a `spool` every chunk is written
+    to it before its load job and only deleted from it once the load succeeded.
+    A chunk that fails for any reason (e.g. the spool's disk is full) is logged and
+    counted in `rows_failed`. If the upload workers stop nonetheless, `add` and
+    `close` raise instead of waiting for them forever.
+
+    Use as an async context manager:
+
+        async with BigQueryBatchWriter(client, 'chat_history', ...) as writer:
+            await writer.add(row)
+    """
+
+    def __init__(self, client, table_type, dataset_id, table_chat_config, table_chat_history, table_chat_info, table_user_info,
+                 max_rows=DEFAULT_MAX_ROWS, max_bytes=DEFAULT_MAX_BYTES, max_pending=2, workers=2, load_format=FORMAT_JSON,
+                 spool=None, retries=DEFAULT_LOAD_RETRIES):
+        table_id_mapping = {
+            'chat_config': table_chat_config,
+            'chat_history': table_chat_history,
+            'chat_info': table_chat_info,
+            'user_info': table_user_info,
+        }
+        self.table_id = table_id_mapping.get(table_type)
+        if not self.table_id:
+            raise ValueError(f"Invalid table type: {table_type}")
+        if load_format not in LOAD_FORMATS:
+            raise ValueError(f"Invalid load format: {load_format}")
+
+        self.client = client
+        self.table_type = table_type
+        self.load_format = load_format
+        self.spool = spool
+        self.retries = retries
+        self.dataset_id = dataset_id
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.rows_added = 0
+        self.rows_loaded = 0
+        self.rows_failed = 0
+        self.bytes_loaded = 0
+        self.encode_seconds = 0.0
+        self._queue = asyncio.Queue(maxsize=max_pending)
+        self._buffer = []
+        self._buffer_rows = 0
+        self._buffer_bytes = 0
+        self._tasks = []
+        if load_format == FORMAT_PARQUET:
+            self._columns = ColumnarBuffer(table_type)
+            self._source_format = SourceFormat.PARQUET
+            self._schema = bigquery_schema(table_type)
+        else:
+            self._columns = None
+            self._source_format = SourceFormat.NEWLINE_DELIMITED_JSON
+            self._schema = None
+
+    async def __aenter__(self):
+        self._tasks = [asyncio.create_task(self._upload_worker()) for _ in range(self.workers)]
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def add(self, row):
+        """
+        Buffers a row, flushing the current chunk when a threshold is reached.
+        """
+        if self._columns is not None:
+            self._columns.add(row)
+            self._buffer_rows = self._columns.rows
+            self._buffer_bytes = self._columns.nbytes
+        else:
+            start = time.perf_counter()
+            line = json.dumps(row).encode('utf-8') + b"\n"
+            self.encode_seconds += time.perf_counter() - start
+            self._buffer.append(line)
+            self._buffer_rows += 1
+            self._buffer_bytes += len(line)
+        self.rows_added += 1
+        if self._buffer_rows >= self.max_rows or self._buffer_bytes >= self.max_bytes:
+            await self.flush()
+
+    async def flush(self):
+        """
+        Hands the buffered chunk to the upload workers.
+        """
+        if not self._buffer_rows:
+            return
+        if self._columns is not None:
+            # Encoding to Parquet is CPU-bound, keep it off the event loop
+            start = time.perf_counter()
+            chunk = (await asyncio.to_thread(self._columns.to_parquet), self._buffer_rows)
+            self.encode_seconds += time.perf_counter() - start
+        else:
+            chunk = (b"".join(self._buffer), self._buffer_rows)
+        self._buffer = []
+        self._buffer_rows = 0
+        self._buffer_bytes = 0
+        await self._put(chunk)
+
+    async def close(self):
+        """
+        Flushes the remaining rows and waits for all pending loads to finish.
+
+        Raises:
+            Exception: The error an upload worker stopped with, if one did.
+        """
+        await self.flush()
+        for _ in self._tasks:
+            await self._put(None)
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+        if any(not task.cancelled() and task.exception() for task in self._tasks):
+            self._raise_stopped_workers()
+        self._tasks = []
+
+    async def _put(self, item):
+        """
+        Queues an item for the upload workers, raising if they all stopped rather than waiting forever.
+        """
+        put = asyncio.ensure_future(self._queue.put(item))
+        while not put.done():
+            running = [task for task in self._tasks if not task.done()]
+            if not running:
+                put.cancel()
+                self._raise_stopped_workers()
+            await asyncio.wait([put, *running], return_when=asyncio.FIRST_COMPLETED)
+        put.result()
+
+    def _raise_stopped_workers(self):
+        # The rows of the chunks left in the queue will not be loaded either
+        self.rows_failed = self.rows_added - self.rows_loaded
+        error = next((task.exception() for task in self._tasks if not task.cancelled() and task.exception()), None)
+        logging.error(f"The upload workers of {self.table_id} stopped: {error!r}")
+        raise RuntimeError(f"The upload workers of {self.table_id} stopped") from error
+
+    async def _upload_worker(self):
+        while True:
+            chunk = await self._queue.get()
+            if chunk is None:
+                return
+            payload, rows = chunk
+            try:
+                loaded = await self._load_chunk(payload, rows)
+            except Exception as e:
+                logging.error(f"Error loading a chunk of {rows} rows into {self.table_id}: {e}", exc_info=True)
+                loaded = False
+            if loaded:
+                self.rows_loaded += rows
+                self.bytes_loaded += len(payload)
+            else:
+                self.rows_failed += rows
+
+    async def _load_chunk(self, payload, rows):
+        if self.spool is not None:
+            segment = await asyncio.to_thread(self.spool.append, self.table_type, self.load_format, rows, payload)
+            return await load_spooled(self.client, self.spool, segment, payload, self.dataset_id, self.table_id,
+                                      self._source_format, self._schema, retries=self.retries)
+        return await load_payload(self.client, payload, self.dataset_id, self.table_id, self._source_format,
+                                  self._schema, retries=self.retries)
+
+
+class BigQueryStagingWriter(BigQueryBatchWriter):
+    """
+    Loads chat_history rows into a staging table and applies them to chat_history on close.
+
+    Rows are loaded in chunks like with BigQueryBatchWriter, but into a staging table
+    created with the schema, partitioning and clustering of chat_history that expires
+    after a day if a run is killed. Subclasses implement `_apply`, a script that runs
+    once every row is loaded and drops the staging table. If the block raised or any
+    chunk failed, nothing is applied and the target is left as it was.
+
+    Applies are serialized through `apply_lock`: DML transactions on the same
+    partition of chat_history would otherwise abort each other. Rows the stream
+    mode may still have in the target's streaming buffer are left as they are (see
+    `_streamed_after`), since DML on them fails.
+    """
+
+    def __init__(self, client, dataset_id, table_id, staging_table_id, apply_lock,
+                 max_rows=DEFAULT_MAX_ROWS, max_bytes=DEFAULT_MAX_BYTES, load_format=FORMAT_JSON):
+        self.target_table_id = table_id
+        self.apply_lock = apply_lock
+        super().__init__(client, 'chat_history', dataset_id, None, staging_table_id, None, None,
+                         max_rows=max_rows, max_bytes=max_bytes, load_format=load_format)
+
+    async def __aenter__(self):
+        await self._query(f"""
+        CREATE OR REPLACE TABLE `{self.dataset_id}.{self.table_id}`
+        LIKE `{self.dataset_id}.{self.target_table_id}`
+        OPTIONS (expiration_timestamp = TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL 1 DAY))
+        """)
+        return await super().__aenter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.close()
+            return
+        # The rows were not all produced: keep what the target table has
+        try:
+            await super().close()
+        finally:
+            await self._drop_staging()
+
+    async def close(self):
+        """
+        Waits for the staged loads and applies the staged rows to the target table.
+        """
+        try:
+            await super().close()
+        except Exception:
+            await self._drop_staging()
+            raise
+        if self.rows_failed:
+            logging.error(f"Not applying {self.table_id} to {self.target_table_id}: {self.rows_failed} rows failed to load")
+            await self._drop_staging()
+            return
+        try:
+            async with self.apply_lock:
+                with metrics.timed('load_job_duration_seconds', table=self.target_table_id):
+                    await self._apply()
+            logging.info(f"Applied {self.rows_loaded} rows of {self.table_id} to {self.target_table_id}")
+        except Exception as e:
+            logging.error(f"Error applying {self.table_id} to {self.target_table_id}: {e}")
+            self.rows_failed += self.rows_loaded
+            self.rows_loaded = 0
+            await self._drop_staging()
+
+    async def _apply(self):
+        raise NotImplementedError
+
+    async def _streamed_after(self):
+        """
+        Returns the time after which rows of the target may be in its streaming buffer.
+
+        Returns:
+            datetime: The time of the buffer's oldest entry minus STREAMED_ROW_LAG, or
+            None if the target has no streaming buffer.
+        """
+        table = await asyncio.to_thread(self.client.get_table, f"{self.dataset_id}.{self.target_table_id}")
+        buffer = table.streaming_buffer
+        if buffer is None or buffer.oldest_entry_time is None:
+            return None
+        streamed_after = buffer.oldest_entry_time - STREAMED_ROW_LAG
+        logging.warning(
+            f"{self.target_table_id} has about {buffer.estimated_rows} streamed rows since {buffer.oldest_entry_time}: "
+            f"rows dated or edited after {streamed_after} are left out of {self.table_id}"
+        )
+        return streamed_after
+
+    async def _drop_staging(self):
+        try:
+            await self._query(f"DROP TABLE IF EXISTS `{self.dataset_id}.{self.table_id}`")
+        except Exception as e:
+            logging.warning(f"Could not drop staging table {self.table_id}: {e}")
+
+    async def _query(self, query, parameters=()):
+        job_config = QueryJobConfig(query_parameters=list(parameters))
+        await asyncio.to_thread(lambda: self.client.query(query, job_config=job_config).result())
+
+
+class BigQueryOverwriteWriter(BigQueryStagingWriter):
+    """
+    Replaces the rows of one chat and date range in chat_history, atomically.
+
+    The rows of the chat within [start_date, end_date] are replaced with the staged
+    rows in one transaction, so a rerun of the range overwrites exactly what the
+    previous run loaded and no dedup lookup is needed. Without staged rows the
+    range is only cleared if `range_complete` was set. Messages with rows in the
+    target's streaming buffer keep those rows, and their staged rows are dropped.
+    """
+
+    def __init__(self, client, dataset_id, table_id, chat_id, start_date, end_date, apply_lock, **kwargs):
+        self.chat_id = int(chat_id)
+        self.start_date = start_date
+        self.end_date = end_date
+        self.range_complete = False
+        staging_table_id = f"{table_id}_staging_{self.chat_id}_{start_date:%Y%m%d%H%M%S}_{end_date:%Y%m%d%H%M%S}"
+        super().__init__(client, dataset_id, table_id, staging_table_id, apply_lock, **kwargs)
+
+    async def _apply(self):
+        if not self.rows_loaded and not self.range_complete:
+            logging.warning(f"Not clearing chat {self.chat_id} from {self.start_date} to {self.end_date}: no rows were fetched")
+            await self._drop_staging()
+            return
+        columns = ", ".join(field['name'] for field in load_table_schema('chat_history'))
+        parameters = [
+            ScalarQueryParameter("chat_id", "INT64", self.chat_id),
+            ScalarQueryParameter("start_date", "TIMESTAMP", self.start_date),
+            ScalarQueryParameter("end_date", "TIMESTAMP", self.end_date),
+        ]
+        streamed_after = await self._streamed_after()
+        keep_streamed = keep_messages = ""
+        if streamed_after is not None:
+            # Streamed rows are kept, and the staged rows of their messages left out
+            keep_streamed = f"AND {NOT_STREAMED}"
+            keep_messages = f"""WHERE NOT EXISTS (
+            SELECT 1 FROM `{self.dataset_id}.{self.target_table_id}` AS target
+            WHERE target.chat_id = @chat_id AND target.date BETWEEN @start_date AND @end_date AND target.id = source.id
+        )"""
+            parameters.append(ScalarQueryParameter("streamed_after", "TIMESTAMP", streamed_after))
+        await self._query(f"""
+        BEGIN TRANSACTION;
+        DELETE FROM `{self.dataset_id}.{self.target_table_id}` AS target
+        WHERE chat_id = @chat_id AND date BETWEEN @start_date AND @end_date {keep_streamed};
+        INSERT INTO `{self.dataset_id}.{self.target_table_id}` ({columns})
+        SELECT {columns} FROM `{self.dataset_id}.{self.table_id}` AS source
+        {keep_messages};
+        COMMIT TRANSACTION;
+        DROP TABLE `{self.dataset_id}.{self.table_id}`;
+        """, parameters)
+
+
+class BigQueryMergeWriter(BigQueryStagingWriter):
+    """
+    Updates columns of existing chat_history rows from the staged rows with one MERGE.
+
+    Rows are matched on chat ID, message ID and date; `start_date` and `end_date`
+    bound the dates of the staged rows so the MERGE only scans those partitions of
+    the target. Staged rows without a match are ignored.
+    """
+
+    def __init__(self, client, dataset_id, table_id, columns, start_date, end_date, apply_lock, **kwargs):
+        self.columns = list(columns)
+        self.start_date = start_date
+        self.end_date = end_date
+        staging_table_id = f"{table_id}_refresh_{start_date:%Y%m%d%H%M%S}_{end_date:%Y%m%d%H%M%S}"
+        super().__init__(client, dataset_id, table_id, staging_table_id, apply_lock, **kwargs)
+
+    async def _apply(self):
+        if not self.rows_loaded:
+            await self._drop_staging()
+            return
+        assignments = ", ".join(f"{column} = source.{column}" for column in self.columns)
+        parameters = [
+            ScalarQueryParameter("start_date", "TIMESTAMP", self.start_date),
+            ScalarQueryParameter("end_date", "TIMESTAMP", self.end_date),
+        ]
+        streamed_after = await self._streamed_after()
+        keep_streamed = ""
+        if streamed_after is not None:
+            keep_streamed = f"AND {NOT_STREAMED}"
+            parameters.append(ScalarQueryParameter("streamed_after", "TIMESTAMP", streamed_after))
+        await self._query(f"""
+        MERGE `{self.dataset_id}.{self.target_table_id}` AS target
+        USING `{self.dataset_id}.{self.table_id}` AS source
+        ON target.chat_id = source.chat_id AND target.id = source.id AND target.date = source.date
+           AND target.date BETWEEN @start_date AND @end_date {keep_streamed}
+        WHEN MATCHED THEN UPDATE SET {assignments};
+        DROP TABLE `{self.dataset_id}.{self.table_id}`;
+        """, parameters)
 
 
 def validate_data(data):
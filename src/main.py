@@ -1,15 +1,25 @@
 import logging
 import os
+import sys
 import asyncio
 import time
 import argparse
+import subprocess
 from datetime import datetime, timedelta, timezone
-from telethon import TelegramClient
-from telethon.sessions import StringSession
+from types import SimpleNamespace
 from dotenv import load_dotenv
-from google.cloud import bigquery
-from telegram_api.chat_config import get_chat_configs, update_processed_date, ensure_chat_config_exists
-from telegram_api.data_processor import DataProcessor
+from telegram_api.message_index import DEDUP_STRATEGIES
+from telegram_api.user_cache import UserInfoCache
+from spool import Spool
+from sinks import create_sink, sink_class, SINK_BIGQUERY
+import metrics
+
+# Telethon, the BigQuery client and the ETL modules built on them are imported
+# by the modes that use them (see import_mode), so a cold start only pays
+# for what its mode runs
+MODES = ('day_ago', 'backload', 'recent', 'import', 'stream', 'refresh', 'analytics')
+# Modes that fetch from Telegram and need CHAT_USERNAMES
+TELEGRAM_MODES = ('day_ago', 'backload', 'recent', 'stream', 'refresh')
 
 # Load environment variables
 load_dotenv()
@@ -18,7 +28,8 @@ load_dotenv()
 api_id = os.getenv("API_ID")
 api_hash = os.getenv("API_HASH")
 phone_number = os.getenv("PHONE_NUMBER")
-chat_usernames = os.getenv("CHAT_USERNAMES").split(',') 
+# Validated by the modes that fetch chats, the others run without it
+chat_usernames = [u for u in os.getenv("CHAT_USERNAMES", "").split(',') if u]
 logging_level = os.getenv("LOGGING_LEVEL", "INFO").upper()
 project_id = os.getenv("PROJECT_ID")
 dataset_id = os.getenv("DATASET_ID")
@@ -26,51 +37,239 @@ table_chat_config = os.getenv("TABLE_CHAT_CONFIG")
 table_chat_history = os.getenv("TABLE_CHAT_HISTORY")
 table_chat_info = os.getenv("TABLE_CHAT_INFO")
 table_user_info = os.getenv("TABLE_USER_INFO")
+table_message_deletions = os.getenv("TABLE_MESSAGE_DELETIONS", "message_deletions")
 mode = os.getenv("MODE")
 backload_start_date = os.getenv("BACKLOAD_START_DATE")
 backload_end_date = os.getenv("BACKLOAD_END_DATE")
+dedup_strategy = os.getenv("DEDUP_STRATEGY", "stop").lower()
+max_concurrent_chats = max(1, int(os.getenv("MAX_CONCURRENT_CHATS", "4")))
+user_cache_path = os.getenv("USER_CACHE_PATH", "cache/user_info.sqlite")
+user_cache_ttl_hours = float(os.getenv("USER_CACHE_TTL_HOURS", "168"))
+flush_max_rows = int(os.getenv("FLUSH_MAX_ROWS", "5000"))
+flush_max_bytes = int(os.getenv("FLUSH_MAX_BYTES", str(8 * 1024 * 1024)))
+load_format = os.getenv("LOAD_FORMAT", "json").lower()
+sink_name = os.getenv("SINK", SINK_BIGQUERY).lower()
+local_sink_path = os.getenv("LOCAL_SINK_PATH", "local/telegram.duckdb")
+backload_shard_days = int(os.getenv("BACKLOAD_SHARD_DAYS", "1"))
+backload_shard_concurrency = max(1, int(os.getenv("BACKLOAD_SHARD_CONCURRENCY", "4")))
+config_commit_interval = float(os.getenv("CONFIG_COMMIT_INTERVAL", "300"))
+write_legacy_columns = os.getenv("WRITE_LEGACY_COLUMNS", "true").lower() in ("1", "true", "yes")
+metrics_file = os.getenv("METRICS_FILE")
+metrics_port = int(os.getenv("METRICS_PORT", "0"))
+metrics_interval = float(os.getenv("METRICS_INTERVAL", "60"))
+export_path = os.getenv("EXPORT_PATH")
+stream_batch_rows = max(1, int(os.getenv("STREAM_BATCH_ROWS", "500")))
+stream_batch_seconds = float(os.getenv("STREAM_BATCH_SECONDS", "2"))
+stream_catchup_interval = float(os.getenv("STREAM_CATCHUP_INTERVAL", "300"))
+refresh_window_days = float(os.getenv("REFRESH_WINDOW_DAYS", "7"))
+spool_dir = os.getenv("SPOOL_DIR", "spool")
+rpc_governor = os.getenv("RPC_GOVERNOR", "true").lower() in ("1", "true", "yes")
+rpc_rate_scale = float(os.getenv("RPC_RATE_SCALE", "1"))
+rpc_max_flood_sleep = float(os.getenv("RPC_MAX_FLOOD_SLEEP", "60"))
+analytics_dir = os.getenv("ANALYTICS_DIR", "analytics")
+analytics_topics = int(os.getenv("ANALYTICS_TOPICS", "10"))
+analytics_chunk_rows = int(os.getenv("ANALYTICS_CHUNK_ROWS", "10000"))
+near_duplicate_index_path = os.getenv("NEAR_DUPLICATE_INDEX_PATH", "cache/near_duplicates.sqlite")
+near_duplicate_cache_mb = int(os.getenv("NEAR_DUPLICATE_CACHE_MB", "256"))
+known_ids_dir = os.getenv("KNOWN_IDS_DIR", "cache/known_ids")
 
 session_string = os.getenv("TELEGRAM_SESSION_STRING")
+# Several accounts: comma-separated session strings, chats are spread across them
+session_strings = [s.strip() for s in os.getenv("TELEGRAM_SESSION_STRINGS", "").split(',') if s.strip()] or [session_string]
 
 # Set up logging
 logging.basicConfig(level=logging_level)
 
-async def main(mode, start_date=None, end_date=None):
+def telegram_client(session, receive_updates):
+    from telethon import TelegramClient
+    from telethon.sessions import StringSession
+
+    return TelegramClient(StringSession(session), api_id, api_hash, receive_updates=receive_updates)
+
+def bigquery_client():
+    from google.cloud import bigquery
+
+    return bigquery.Client(project=project_id)
+
+def import_mode(mode):
+    """
+    Imports the modules a run in `mode` uses beyond the ones main imports itself.
+
+    main() takes its classes from here, so the import path of a mode is the one
+    profile_startup() measures.
+
+    Args:
+        mode (str): The run mode.
+
+    Returns:
+        SimpleNamespace: ClientPool, NearDuplicateIndex, Sink, ChatAnalytics,
+            DataProcessor and StreamIngestor, None for the ones the mode does not use.
+    """
+    imported = SimpleNamespace(ClientPool=None, NearDuplicateIndex=None, Sink=None, ChatAnalytics=None, DataProcessor=None, StreamIngestor=None)
+    # Imports only read the export file, analytics only the sink
+    if mode in TELEGRAM_MODES:
+        from telegram_api.client_pool import ClientPool
+        imported.ClientPool = ClientPool
+    # Only the modes that add messages cluster them
+    if near_duplicate_index_path and mode not in ('refresh', 'analytics'):
+        from telegram_api.near_duplicates import NearDuplicateIndex
+        imported.NearDuplicateIndex = NearDuplicateIndex
+    imported.Sink = sink_class(sink_name)
+    if mode == 'analytics':
+        from analytics import ChatAnalytics
+        imported.ChatAnalytics = ChatAnalytics
+        return imported
+    from telegram_api.data_processor import DataProcessor
+    imported.DataProcessor = DataProcessor
+    if mode == 'stream':
+        from telegram_api.stream import StreamIngestor
+        imported.StreamIngestor = StreamIngestor
+    return imported
+
+def profile_startup(mode, top=25):
+    """
+    Reports the import time of a cold start in `mode`, per module.
+
+    main is imported and import_mode() run in a fresh interpreter under
+    `python -X importtime`. The top-level imports are printed with their
+    cumulative time (including the modules they imported), followed by the
+    modules that took longest on their own. Packages the modules import on
+    first use (numpy, ijson, pyarrow, duckdb, scikit-learn) are not included.
+
+    Args:
+        mode (str): The run mode.
+        top (int): The number of modules listed.
+
+    Returns:
+        int: The exit status of the profiled interpreter, non-zero if an import failed.
+    """
+    code = f"import main\nmain.import_mode({mode!r})"
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True,
+    )
+    timings = []
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        timings.append((int(self_us), int(cumulative_us), name.strip()))
+        # Nested imports are indented below the module importing them
+        if not name.startswith('  '):
+            entries.append((int(cumulative_us), name.strip()))
+    if result.returncode:
+        print(result.stderr.strip().splitlines()[-1], file=sys.stderr)
+
+    total = sum(cumulative_us for cumulative_us, _ in entries)
+    print(f"Cold start in {mode} mode: {len(timings)} modules imported in {total / 1000:.1f} ms")
+    print(f"{'top-level import':<50} {'cumulative ms':>14}")
+    for cumulative_us, name in sorted(entries, reverse=True)[:top // 2]:
+        print(f"{name:<50} {cumulative_us / 1000:>14.1f}")
+    print()
+    print(f"{'module':<50} {'self ms':>9} {'cumulative ms':>14}")
+    for self_us, cumulative_us, name in sorted(timings, reverse=True)[:top]:
+        print(f"{name:<50} {self_us / 1000:>9.1f} {cumulative_us / 1000:>14.1f}")
+    return result.returncode
+
+async def main(mode, start_date=None, end_date=None, dedup_strategy=dedup_strategy, export_path=export_path, import_username=None):
     logging.info(f"Starting Telegram data collection script in {mode} mode")
     
-    last_heartbeat = time.time()
-    last_activity = time.time()
-    heartbeat_interval = 300  # Log heartbeat every 5 minutes
-    inactivity_timeout = 1800  # 30 minutes
+    metrics.install_floodwait_handler()
+    metrics_server = metrics.serve(metrics_port) if metrics_port else None
+    reporter = asyncio.create_task(report_metrics())
+    imported = import_mode(mode)
 
-    client = TelegramClient(StringSession(session_string), api_id, api_hash, receive_updates=False)
+    pool = None
+    if imported.ClientPool is not None:
+        # Only the stream mode listens to updates
+        pool = imported.ClientPool([telegram_client(session, receive_updates=(mode == 'stream')) for session in session_strings])
+        if rpc_governor:
+            pool.install_governors(rate_scale=rpc_rate_scale, max_flood_sleep=rpc_max_flood_sleep)
+    user_cache = None
+    if mode != 'analytics':
+        user_cache = UserInfoCache(user_cache_path, ttl=user_cache_ttl_hours * 3600)
+        user_cache.evict()
+    near_duplicates = None
+    if imported.NearDuplicateIndex is not None:
+        near_duplicates = imported.NearDuplicateIndex(near_duplicate_index_path, cache_mb=near_duplicate_cache_mb)
+    sink = None
     
     try:
-        await client.start(phone=phone_number)
-        logging.info("Telegram client started")
+        if pool is not None:
+            await pool.start(phone=phone_number)
+            logging.info(f"Started {len(pool)} Telegram clients")
         
-        bq_client = bigquery.Client(project=project_id)
-        logging.info("BigQuery client created")
+        if sink_name == SINK_BIGQUERY:
+            bq_client = bigquery_client()
+            logging.info("BigQuery client created")
+            sink = create_sink(
+                sink_name, bq_client=bq_client, dataset_id=dataset_id,
+                table_chat_config=table_chat_config, table_chat_history=table_chat_history,
+                table_chat_info=table_chat_info, table_user_info=table_user_info,
+                load_format=load_format, commit_interval=config_commit_interval,
+                table_message_deletions=table_message_deletions,
+                spool=Spool(spool_dir) if spool_dir else None
+            )
+        else:
+            sink = create_sink(sink_name, path=local_sink_path)
+        logging.info(f"Using {sink.name} sink")
+        # Rows fetched by an earlier run come first, before anything is fetched again
+        await sink.recover()
+
+        if mode == 'analytics':
+            analytics = imported.ChatAnalytics(sink, analytics_dir, n_topics=analytics_topics, chunk_rows=analytics_chunk_rows)
+            start = datetime.strptime(start_date, "%Y-%m-%d").date() if start_date else None
+            days = await analytics.run(start_date=start)
+            logging.info(f"Analytics of {days} days written to {analytics_dir}")
+            return
         
-        data_processor = DataProcessor(
-            client, bq_client, dataset_id, 
-            table_chat_config, table_chat_history, 
-            table_chat_info, table_user_info,
-            is_backloading=(mode == 'backload')
+        data_processor = imported.DataProcessor(
+            pool.clients[0] if pool is not None else None, sink,
+            is_backloading=(mode == 'backload'),
+            dedup_strategy=dedup_strategy,
+            user_cache=user_cache,
+            flush_max_rows=flush_max_rows,
+            flush_max_bytes=flush_max_bytes,
+            shard_concurrency=backload_shard_concurrency,
+            legacy_columns=write_legacy_columns,
+            near_duplicates=near_duplicates,
+            known_ids_dir=known_ids_dir or None
         )
         await data_processor.initialize()
         logging.info("DataProcessor initialized")
+
+        if mode == 'import':
+            chat_config = None
+            if import_username:
+                await sink.ensure_chat_configs([import_username])
+                chat_config = (await sink.get_chat_configs()).get(import_username)
+            logging.info(f"Importing Telegram Desktop export {export_path}")
+            if await data_processor.import_export(export_path, chat_config):
+                logging.info("Import completed")
+            else:
+                logging.error("Some exported messages failed to load")
+            await data_processor.upload_new_data()
+            return
         
         # Ensure chat configs exist for all usernames
-        for username in chat_usernames:
-            ensure_chat_config_exists(bq_client, dataset_id, table_chat_config, username, username)
+        await sink.ensure_chat_configs(chat_usernames)
         
-        chat_configs = await get_chat_configs(bq_client, dataset_id, table_chat_config)
+        chat_configs = await sink.get_chat_configs()
         logging.info(f"Retrieved {len(chat_configs)} chat configs")
         if not chat_configs:
             logging.error("No chat configs found. Exiting.")
             return
 
+        if mode == 'stream':
+            ingestor = imported.StreamIngestor(
+                data_processor, pool, chat_configs, chat_usernames,
+                batch_rows=stream_batch_rows, batch_seconds=stream_batch_seconds,
+                catchup_interval=stream_catchup_interval
+            )
+            await ingestor.run()
+            return
+
         # Determine dates to process
         if mode == 'day_ago':
             today = datetime.now(timezone.utc).date()
@@ -90,56 +289,78 @@ async def main(mode, start_date=None, end_date=None):
         elif mode == 'recent':
             end_date = datetime.now(timezone.utc)
             
-            query = f"""
-            SELECT MAX(date) as last_processed_date
-            FROM `{dataset_id}.{table_chat_history}`
-            """
-            query_job = bq_client.query(query)
-            results = query_job.result()
-            last_processed_date = list(results)[0]['last_processed_date']
-            
-            if last_processed_date:
-                start_date = last_processed_date.replace(tzinfo=timezone.utc) + timedelta(seconds=1)
-                logging.info(f"Last processed date found: {start_date}")
-            else:
-                start_date = end_date - timedelta(days=1)
-                logging.info(f"No last processed date found. Starting from: {start_date}")
-            
-            if start_date > end_date:
-                start_date = end_date - timedelta(days=1)
-                logging.warning(f"Start date was in the future. Adjusted to: {start_date}")
+            # Chats with a watermark resume from their last loaded message (see below);
+            # chats without one start with the last day
+            start_date = end_date - timedelta(days=1)
 
             logging.info(f"Processing recent data from {start_date} to {end_date}")
+        elif mode == 'refresh':
+            end_date = datetime.now(timezone.utc)
+            start_date = end_date - timedelta(days=refresh_window_days)
 
         logging.info(f"Processing data from {start_date} to {end_date}")
 
-        for username in chat_usernames:
-            # Log heartbeat if it's time
-            if time.time() - last_heartbeat >= heartbeat_interval:
-                logging.info(f"ETL Heartbeat: Still running at {datetime.now(timezone.utc)}")
-                last_heartbeat = time.time()
+        shard_days = backload_shard_days if mode == 'backload' else None
+        # Backload and day_ago runs only fetch the days missing from each chat's coverage
+        skip_covered = mode in ('backload', 'day_ago')
 
-            # Check for inactivity
-            if time.time() - last_activity > inactivity_timeout:
-                logging.warning("ETL process seems to be inactive. Possible sleep detected.")
+        semaphore = asyncio.Semaphore(max_concurrent_chats)
+        chat_timings = {}
+        refresh_writer = None
 
-            chat_config = chat_configs.get(username)
-            if not chat_config:
-                logging.warning(f"No chat config found for {username}. Skipping.")
-                continue
+        async def process_chat_worker(username):
+            async with semaphore:
+                chat_config = chat_configs.get(username)
+                if not chat_config:
+                    logging.warning(f"No chat config found for {username}. Skipping.")
+                    chat_timings[username] = ('skipped', 0.0)
+                    return
 
-            await data_processor.process_chat(username, start_date, end_date, chat_config)
-            logging.info(f"Finished processing chat {username}")
-            last_activity = time.time()
+                chat_start = time.perf_counter()
+                status = 'failed'
+                account, client = pool.acquire(username)
+                try:
+                    chat_start_date, min_id = start_date, 0
+                    if mode == 'recent' and chat_config.get('last_message_id'):
+                        min_id = chat_config['last_message_id']
+                        chat_start_date = min(chat_config['last_message_date'].replace(tzinfo=timezone.utc), start_date)
+                        logging.info(f"Resuming {username} after message {min_id} ({chat_config['last_message_date']})")
 
-            # Update processed dates
-            if mode == 'recent':
-                processed_dates = [end_date.date()]
-            else:
-                processed_dates = [start_date.date() + timedelta(days=i) for i in range((end_date.date() - start_date.date()).days + 1)]
+                    while True:
+                        with metrics.labelled(account=account):
+                            if mode == 'refresh':
+                                success = await data_processor.refresh_chat(username, start_date, end_date, refresh_writer, client=client) is not None
+                            else:
+                                success = await data_processor.process_chat(username, chat_start_date, end_date, chat_config, shard_days=shard_days, min_id=min_id, skip_covered=skip_covered, client=client)
+                        if success:
+                            logging.info(f"Finished processing chat {username} with {account}")
+                            status = 'ok'
+                            break
+                        # A flood wait too long to sleep through fails the chat: run it again on a free account
+                        retry = pool.reacquire(username, account)
+                        if retry is None:
+                            break
+                        account, client = retry
+                except Exception as e:
+                    logging.error(f"Error finishing chat {username}: {e}", exc_info=True)
+                finally:
+                    chat_timings[username] = (status, time.perf_counter() - chat_start)
 
-            await update_processed_date(bq_client, dataset_id, table_chat_config, chat_config['id'], processed_dates)
-            logging.info(f"Updated chat config for {username} with processed dates: {processed_dates}")
+        logging.info(f"Processing {len(chat_usernames)} chats with up to {max_concurrent_chats} concurrently")
+        if mode == 'refresh':
+            # The changed messages of all chats are applied with a single MERGE
+            refresh_writer = sink.merge_writer(data_processor.mutable_columns, start_date, end_date, flush_max_rows, flush_max_bytes)
+            async with refresh_writer:
+                await asyncio.gather(*(process_chat_worker(username) for username in chat_usernames))
+            metrics.record_writer(refresh_writer, 'chat_history')
+            logging.info(f"Updated {refresh_writer.rows_loaded} of {refresh_writer.rows_added} changed messages in {sink.name}")
+        else:
+            await asyncio.gather(*(process_chat_worker(username) for username in chat_usernames))
+
+        logging.info("Per-chat timing summary:")
+        for username, (status, elapsed) in sorted(chat_timings.items(), key=lambda item: item[1][1], reverse=True):
+            logging.info(f"  {username}: {status} in {elapsed:.1f}s")
+        pool.log_summary()
 
         await data_processor.upload_new_data()
         logging.info("Data processing and upload completed")
@@ -148,21 +369,74 @@ async def main(mode, start_date=None, end_date=None):
         logging.error(f"An error occurred: {e}", exc_info=True)
     
     finally:
-        await client.disconnect()
-        logging.info("Telegram client disconnected")
-    
-    # Final heartbeat
-    logging.info(f"ETL Heartbeat: Finished running at {datetime.now(timezone.utc)}")
+        if pool is not None:
+            await pool.disconnect()
+            logging.info("Telegram clients disconnected")
+        if user_cache is not None:
+            user_cache.close()
+        if near_duplicates is not None:
+            near_duplicates.close()
+        if sink is not None:
+            # Chat config updates of the chats that finished are committed even if the run failed
+            try:
+                await sink.commit()
+            except Exception as e:
+                logging.error(f"Error committing chat config updates: {e}", exc_info=True)
+            sink.close()
+        reporter.cancel()
+        # Flush the final values so a run shorter than the interval still leaves its metrics
+        log_progress()
+        if metrics_file:
+            metrics.write(metrics_file)
+        if metrics_server is not None:
+            metrics_server.shutdown()
+
+def log_progress():
+    logging.info(
+        f"Progress: {metrics.value('messages_fetched')} messages fetched, "
+        f"{metrics.value('rows_loaded')} rows loaded, {metrics.value('rows_failed')} failed, "
+        f"{metrics.value('rpc_calls')} RPC calls, {metrics.value('floodwait_seconds')}s in flood waits"
+    )
+
+async def report_metrics():
+    """
+    Periodically logs a progress line and writes the metrics file, if configured.
+
+    The metrics replace the former heartbeat log: a stalled job shows up as counters
+    that stop moving rather than as a missing log line.
+    """
+    while True:
+        await asyncio.sleep(metrics_interval)
+        log_progress()
+        if metrics_file:
+            try:
+                metrics.write(metrics_file)
+            except OSError as e:
+                logging.error(f"Error writing metrics to {metrics_file}: {e}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Telegram data collection script")
-    parser.add_argument("mode", choices=['day_ago', 'backload', 'recent'], help="Run mode: 'day_ago', 'backload', or 'recent'", default=mode, nargs='?')
-    parser.add_argument("--start_date", help="Start date for backload (format: YYYY-MM-DD)", default=backload_start_date)
+    parser.add_argument("mode", choices=MODES, help="Run mode: 'day_ago', 'backload', 'recent', 'import', 'stream', 'refresh', or 'analytics'", default=mode, nargs='?')
+    parser.add_argument("--start_date", help="Start date for backload, or of the first analytics run (format: YYYY-MM-DD)", default=backload_start_date)
     parser.add_argument("--end_date", help="End date for backload (format: YYYY-MM-DD)", default=backload_end_date)
+    parser.add_argument("--dedup_strategy", choices=DEDUP_STRATEGIES, help="Stop at the first already loaded message or skip known messages and keep scanning", default=dedup_strategy)
+    parser.add_argument("--export_path", help="Path of the Telegram Desktop JSON export (result.json) to import", default=export_path)
+    parser.add_argument("--username", help="Username of the chat a single-chat export belongs to; its coverage and watermark are updated after the import")
+    parser.add_argument("--profile-startup", action='store_true', help="Report the import time of a cold start in the mode per module instead of running it")
     
     args = parser.parse_args()
     
+    if args.profile_startup:
+        if not args.mode:
+            parser.error("--profile-startup requires a mode")
+        sys.exit(profile_startup(args.mode))
+    if not args.mode:
+        parser.error("A mode is required, as an argument or in MODE")
+    if args.mode in TELEGRAM_MODES and not chat_usernames:
+        parser.error(f"{args.mode} mode requires CHAT_USERNAMES")
     if args.mode == 'backload' and (not args.start_date or not args.end_date):
         parser.error("Backload mode requires both --start_date and --end_date")
+    if args.mode == 'import' and not args.export_path:
+        parser.error("Import mode requires --export_path")
     
-    asyncio.run(main(args.mode, args.start_date, args.end_date))
\ No newline at end of file
+    asyncio.run(main(args.mode, args.start_date, args.end_date, args.dedup_strategy, args.export_path, args.username))
\ No newline at end of file
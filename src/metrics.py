@@ -0,0 +1,264 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = 'telegram_etl_'
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, float('inf'))
+
+# Labels added to every metric recorded in the current context (see `labelled`)
+_context_labels = contextvars.ContextVar('metrics_context_labels', default={})
+
+# name: (type, help)
+METRICS = {
+    'messages_fetched': ('counter', 'Messages fetched from Telegram'),
+    'rpc_calls': ('counter', 'Telegram RPC calls by request type'),
+    'floodwait_seconds': ('counter', 'Seconds spent waiting on Telegram FloodWait errors by request type'),
+    'rpc_throttle_seconds': ('counter', 'Seconds Telegram RPCs waited for the RPC governor by request type'),
+    'user_lookups': ('counter', 'User profile lookups by source'),
+    'rows_loaded': ('counter', 'Rows loaded into the sink'),
+    'bytes_loaded': ('counter', 'Encoded bytes loaded into the sink'),
+    'rows_failed': ('counter', 'Rows whose load failed'),
+    'encode_seconds': ('counter', 'Seconds spent encoding rows for loading'),
+    'coercion_failures': ('counter', 'Values written as NULL because they could not be coerced to their column type, by column'),
+    'load_job_duration_seconds': ('histogram', 'Duration of sink load jobs'),
+    'stage_duration_seconds': ('histogram', 'Duration of ETL stages per chat'),
+    'messages_refreshed': ('counter', 'Loaded messages re-fetched by the refresh mode'),
+    'messages_changed': ('counter', 'Re-fetched messages whose views, forwards, replies, reactions or text changed'),
+    'messages_analyzed': ('counter', 'Messages processed by the analytics mode'),
+    'messages_clustered': ('counter', 'Messages assigned to a near-duplicate cluster'),
+    'near_duplicates': ('counter', 'Messages assigned to the near-duplicate cluster of an earlier message'),
+    'known_ids_fetched': ('counter', 'IDs of known users and chats fetched from the sink by table'),
+    'stream_events': ('counter', 'Telegram update events received by the stream mode by event type'),
+    'stream_latency_seconds': ('histogram', 'Seconds from a message being sent, edited or deleted to its row being written by the stream mode'),
+}
+
+
+class _Registry:
+    """
+    Thread-safe store of labelled counters and histograms.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted({**_context_labels.get(), **labels}.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted({**_context_labels.get(), **labels}.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(DEFAULT_BUCKETS), 0, 0.0]
+            histogram[0][bisect_left(DEFAULT_BUCKETS, value)] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def value(self, name, **labels):
+        """
+        Returns the current value of a counter, summed over the labels not given.
+        """
+        with self._lock:
+            return sum(
+                value for (metric, metric_labels), value in self._counters.items()
+                if metric == name and labels.items() <= dict(metric_labels).items()
+            )
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self):
+        """
+        Renders all metrics in the OpenMetrics text format.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(buckets), count, total) for key, (buckets, count, total) in self._histograms.items()}
+
+        lines = []
+        for name, (metric_type, help_text) in METRICS.items():
+            full_name = PREFIX + name
+            lines.append(f"# TYPE {full_name} {metric_type}")
+            lines.append(f"# HELP {full_name} {help_text}.")
+            if metric_type == 'counter':
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{full_name}_total{_format_labels(labels)} {_format_value(value)}")
+            else:
+                for (metric, labels), (buckets, count, total) in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, bucket_count in zip(DEFAULT_BUCKETS, buckets):
+                        cumulative += bucket_count
+                        le = '+Inf' if bound == float('inf') else repr(float(bound))
+                        lines.append(f"{full_name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{full_name}_count{_format_labels(labels)} {count}")
+                    lines.append(f"{full_name}_sum{_format_labels(labels)} {_format_value(total)}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        f'{key}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for key, value in labels
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = _Registry()
+inc = registry.inc
+observe = registry.observe
+value = registry.value
+render = registry.render
+
+
+@contextmanager
+def labelled(**labels):
+    """
+    Adds labels to every metric recorded within the block, including in the tasks it starts.
+    """
+    token = _context_labels.set({**_context_labels.get(), **labels})
+    try:
+        yield
+    finally:
+        _context_labels.reset(token)
+
+
+@contextmanager
+def timed(name, **labels):
+    """
+    Observes the duration of the enclosed block in a histogram.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def record_writer(writer, table):
+    """
+    Adds the counters of a closed sink writer (see `Sink.writer`) to the metrics.
+    """
+    inc('rows_loaded', writer.rows_loaded, table=table)
+    inc('rows_failed', writer.rows_failed, table=table)
+    inc('bytes_loaded', writer.bytes_loaded, table=table)
+    inc('encode_seconds', writer.encode_seconds, table=table)
+
+
+def write(path):
+    """
+    Writes the current metrics to a file, atomically replacing it.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(render())
+    os.replace(tmp_path, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip('/') not in ('', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+def serve(port, host='0.0.0.0'):
+    """
+    Serves the metrics on http://host:port/metrics from a daemon thread.
+
+    Returns:
+        ThreadingHTTPServer: The server; call `shutdown()` to stop it.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+class FloodWaitLogHandler(logging.Handler):
+    """
+    Counts the FloodWait sleeps Telethon performs on its own.
+
+    Telethon silently sleeps through FloodWait errors shorter than the client's
+    `flood_sleep_threshold` and only logs them, so the log record is the one place
+    those waits are visible. A sleep that is not 'early' follows a failed request
+    that Telethon then sends again, so it is counted in rpc_calls too.
+    """
+
+    def emit(self, record):
+        if isinstance(record.msg, str) and record.msg.startswith('Sleeping') and 'flood wait' in record.msg and len(record.args) >= 4:
+            inc('floodwait_seconds', record.args[1], request=record.args[3])
+            if not record.args[0]:
+                inc('rpc_calls', request=record.args[3])
+
+
+def count_requests(client, account=None):
+    """
+    Counts every request a Telethon client sends in rpc_calls, by request type.
+
+    Wraps the method all requests go through (`get_entity`, `iter_messages`,
+    `get_messages`, `client(...)` alike), so pages, lookups and resolutions are
+    counted as they are sent rather than estimated by their callers. Wrappers
+    installed afterwards (e.g. an RpcGovernor) call it once per attempt, so their
+    retries are counted as well.
+
+    Args:
+        client (telethon.TelegramClient): The client to instrument.
+        account (str, optional): The `account` label of the calls.
+
+    Returns:
+        The client.
+    """
+    call = client._call
+    labels = {'account': account} if account else {}
+
+    async def counted_call(sender, request, ordered=False, flood_sleep_threshold=None):
+        first = request[0] if isinstance(request, (list, tuple)) else request
+        inc('rpc_calls', request=type(first).__name__, **labels)
+        return await call(sender, request, ordered=ordered, flood_sleep_threshold=flood_sleep_threshold)
+
+    client._call = counted_call
+    return client
+
+
+def install_floodwait_handler():
+    """
+    Attaches FloodWaitLogHandler to Telethon's client logger.
+
+    The logger's level is left to the application's logging configuration, and
+    Telethon logs its flood-wait sleeps at INFO: they are only counted while
+    `telethon.client.users` is enabled for INFO (e.g. LOGGING_LEVEL=INFO).
+    """
+    logger = logging.getLogger('telethon.client.users')
+    if not any(isinstance(handler, FloodWaitLogHandler) for handler in logger.handlers):
+        logger.addHandler(FloodWaitLogHandler())
@@ -0,0 +1,47 @@
+from sinks.base import Sink
+
+__all__ = ['Sink', 'SINK_BIGQUERY', 'SINK_DUCKDB', 'SINKS', 'sink_class', 'create_sink']
+
+SINK_BIGQUERY = 'bigquery'
+SINK_DUCKDB = 'duckdb'
+SINKS = (SINK_BIGQUERY, SINK_DUCKDB)
+
+
+def sink_class(name):
+    """
+    Imports the class of the sink selected by name.
+
+    Args:
+        name (str): 'bigquery' or 'duckdb'.
+
+    Returns:
+        type: The Sink subclass.
+
+    Raises:
+        ValueError: If the sink name is unknown.
+    """
+    if name == SINK_BIGQUERY:
+        from sinks.bigquery_sink import BigQuerySink
+        return BigQuerySink
+    if name == SINK_DUCKDB:
+        from sinks.duckdb_sink import DuckDBSink
+        return DuckDBSink
+    raise ValueError(f"Invalid sink: {name}")
+
+
+def create_sink(name, **options):
+    """
+    Creates the sink selected by name.
+
+    Args:
+        name (str): 'bigquery' or 'duckdb'.
+        **options: For 'bigquery': bq_client, dataset_id, table_chat_config, table_chat_history,
+            table_chat_info, table_user_info and optionally load_format. For 'duckdb': path.
+
+    Returns:
+        Sink: The sink instance.
+
+    Raises:
+        ValueError: If the sink name is unknown.
+    """
+    return sink_class(name)(**options)
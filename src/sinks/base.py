@@ -0,0 +1,166 @@
+# Default flush thresholds of the sinks' writers
+DEFAULT_MAX_ROWS = 5000
+DEFAULT_MAX_BYTES = 8 * 1024 * 1024
+
+# `source` of the user_info and chat_info rows built from a Telegram Desktop export. They
+# only hold what the export shows, so they never count as existing users or chats
+EXPORT_SOURCE = 'export'
+
+
+class Sink:
+    """
+    Storage backend of the ETL.
+
+    A sink owns everything the pipeline reads from or writes to the warehouse:
+    message and dimension loads, the dedup and watermark lookups, and the chat
+    configuration. Implementations must be safe to call from concurrent tasks.
+    """
+
+    name = None
+
+    async def recover(self):
+        """
+        Loads the rows an earlier run wrote ahead but did not get loaded. Called before any fetching.
+        """
+
+    async def get_chat_configs(self):
+        """
+        Returns:
+            dict: Chat configurations keyed by username (see chat_config.get_chat_configs).
+        """
+        raise NotImplementedError
+
+    async def ensure_chat_configs(self, usernames):
+        """
+        Creates an empty chat configuration for every username that has none.
+        """
+        raise NotImplementedError
+
+    async def update_processed_dates(self, chat_id, dates):
+        """
+        Records dates as loaded for a chat. May be buffered until `commit`.
+        """
+        raise NotImplementedError
+
+    async def update_watermark(self, chat_id, last_message_id, last_message_date):
+        """
+        Advances a chat's message-ID watermark. Never moves it backwards. May be buffered until `commit`.
+        """
+        raise NotImplementedError
+
+    async def commit(self):
+        """
+        Writes buffered chat configuration updates.
+        """
+
+    async def load_message_index(self, chat_id, start_date, end_date, min_id=0):
+        """
+        Returns:
+            MessageIdIndex: The IDs of messages already loaded for a chat in a date window,
+            above `min_id` if given.
+
+        Raises:
+            Exception: If the lookup fails; an empty index must never stand in for a failed lookup.
+        """
+        raise NotImplementedError
+
+    async def load_mutable_fields(self, chat_id, start_date, end_date, columns):
+        """
+        Returns:
+            list: A dict of 'id' and `columns` for every message loaded for a chat in a date window,
+            with the values of its newest version (by `edit_date`).
+        """
+        raise NotImplementedError
+
+    async def history_days(self, start_date, end_date):
+        """
+        Returns:
+            list: The dates (UTC) within [start_date, end_date) that chat_history has messages on, oldest first.
+        """
+        raise NotImplementedError
+
+    async def read_history(self, start_date, end_date, columns, chunk_rows):
+        """
+        Reads the messages of all chats within [start_date, end_date) in chunks.
+
+        Only the newest version (by `edit_date`) of each message is returned. Memory is
+        bounded by the chunk size, whatever the size of the range.
+
+        Yields:
+            list: Up to `chunk_rows` dicts of `columns`.
+        """
+        raise NotImplementedError
+        yield
+
+    def table_id(self, table_type):
+        """
+        Returns:
+            str: A name identifying a table of the sink across runs, e.g. to key local snapshots of it.
+        """
+        raise NotImplementedError
+
+    async def get_existing_ids(self, table_type, since=None):
+        """
+        Fetches the IDs of the rows of a dimension table ('user_info' or 'chat_info'),
+        except the placeholder rows of exports (`source` EXPORT_SOURCE).
+
+        Args:
+            table_type (str): 'user_info' or 'chat_info'.
+            since (datetime, optional): Only fetch the IDs of the rows added after this time.
+
+        Returns:
+            array: The IDs as signed 64-bit integers (array('q')), unsorted and possibly repeated,
+            or None if `since` is given and the sink cannot tell which rows were added since then.
+        """
+        raise NotImplementedError
+
+    def writer(self, table_type, max_rows, max_bytes):
+        """
+        Returns:
+            An async context manager with `add(row)` that streams rows to a table in chunks
+            and exposes `rows_added`, `rows_loaded`, `rows_failed`, `bytes_loaded` and
+            `encode_seconds` counters.
+        """
+        raise NotImplementedError
+
+    def overwrite_writer(self, chat_id, start_date, end_date, max_rows, max_bytes):
+        """
+        Returns:
+            A writer like `writer('chat_history', ...)` whose rows replace, atomically and only
+            once every row is loaded, the chat's messages within [start_date, end_date].
+            If no row was loaded, the range is only cleared once the producer sets the
+            writer's `range_complete` (get_chat_history does when its scan reaches a
+            message older than the range or the end of the history): an empty fetch
+            alone does not prove the chat has no messages there.
+        """
+        raise NotImplementedError
+
+    def merge_writer(self, columns, start_date, end_date, max_rows, max_bytes):
+        """
+        Returns:
+            A writer like `writer('chat_history', ...)` whose rows, once every row is loaded,
+            update `columns` of the existing chat_history rows with the same chat ID, message
+            ID and date within [start_date, end_date]. Rows without a match are ignored.
+        """
+        raise NotImplementedError
+
+    async def upload_rows(self, table_type, rows):
+        """
+        Loads a list of row dictionaries into a table.
+
+        Returns:
+            bool: True if the rows were loaded, False otherwise.
+        """
+        raise NotImplementedError
+
+    async def stream_rows(self, table_type, rows):
+        """
+        Appends a small batch of rows with low latency, for the stream mode.
+
+        Returns:
+            bool: True if the rows were written, False otherwise.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
@@ -0,0 +1,251 @@
+import asyncio
+import logging
+import time
+from array import array
+import metrics
+from google.cloud.bigquery import QueryJobConfig, ScalarQueryParameter, SourceFormat
+from arrow_encoder import bigquery_schema
+from bigquery_loader import upload_to_bigquery, load_spooled, BigQueryBatchWriter, BigQueryOverwriteWriter, BigQueryMergeWriter, FORMAT_JSON, FORMAT_PARQUET
+from sinks.base import EXPORT_SOURCE, Sink
+from telegram_api.chat_config import get_chat_configs, commit_chat_config_updates, ensure_chat_configs_exist
+from telegram_api.message_index import load_message_index
+
+# Leaves the export placeholder rows out of the IDs of existing users and chats
+_NOT_EXPORTED = f"(source IS NULL OR source != '{EXPORT_SOURCE}')"
+
+
+class BigQuerySink(Sink):
+    """
+    Sink backed by the BigQuery dataset of the production pipeline.
+
+    Processed dates and watermarks are buffered and written for all chats in one
+    MERGE by `commit`, which runs at most every `commit_interval` seconds while
+    updates come in and once more at the end of the run, rather than one DML job
+    per chat.
+
+    With a spool, appended chunks and dimension rows are written ahead to it and
+    only dropped from it once their load job succeeded; `recover` loads what an
+    earlier run left there.
+    """
+
+    name = 'bigquery'
+
+    def __init__(self, bq_client, dataset_id, table_chat_config, table_chat_history, table_chat_info, table_user_info, load_format=FORMAT_JSON, commit_interval=300, table_message_deletions='message_deletions', spool=None):
+        """
+        Parameters:
+        - bq_client: The BigQuery client.
+        - dataset_id: The ID of the BigQuery dataset.
+        - table_chat_config: The name of the BigQuery table for chat configuration.
+        - table_chat_history: The name of the BigQuery table for chat history.
+        - table_chat_info: The name of the BigQuery table for chat information.
+        - table_user_info: The name of the BigQuery table for user information.
+        - load_format: 'json' to load messages as newline-delimited JSON, 'parquet' to load typed Parquet batches.
+        - commit_interval: The maximum number of seconds chat config updates stay buffered.
+        - table_message_deletions: The name of the BigQuery table for messages deleted in streamed chats.
+        - spool: The Spool loads are written ahead to, or None to load straight from memory.
+        """
+        self.bq_client = bq_client
+        self.dataset_id = dataset_id
+        self.table_chat_config = table_chat_config
+        self.table_chat_history = table_chat_history
+        self.table_chat_info = table_chat_info
+        self.table_user_info = table_user_info
+        self.load_format = load_format
+        self.commit_interval = commit_interval
+        self.spool = spool
+        self._pending = {}
+        self._last_commit = time.monotonic()
+        self._apply_lock = asyncio.Lock()
+        self.tables = {
+            'chat_config': table_chat_config,
+            'chat_history': table_chat_history,
+            'chat_info': table_chat_info,
+            'user_info': table_user_info,
+            'message_deletions': table_message_deletions,
+        }
+
+    async def recover(self):
+        if self.spool is None or not len(self.spool):
+            return
+        segments = self.spool.pending()
+        logging.info(f"Loading {len(segments)} spooled segments left by an earlier run")
+        loaded = 0
+        for record in segments:
+            table_type = record['table_type']
+            if record['load_format'] == FORMAT_PARQUET:
+                source_format, schema = SourceFormat.PARQUET, bigquery_schema(table_type)
+            else:
+                source_format, schema = SourceFormat.NEWLINE_DELIMITED_JSON, None
+            payload = await asyncio.to_thread(self.spool.read, record['segment'])
+            if await load_spooled(self.bq_client, self.spool, record['segment'], payload, self.dataset_id, self.tables[table_type], source_format, schema):
+                loaded += 1
+                metrics.inc('rows_loaded', record['rows'], table=self.tables[table_type])
+        logging.info(f"Loaded {loaded} of {len(segments)} spooled segments, {len(self.spool)} remain in the spool")
+
+    async def get_chat_configs(self):
+        return await get_chat_configs(self.bq_client, self.dataset_id, self.table_chat_config)
+
+    async def ensure_chat_configs(self, usernames):
+        if usernames:
+            await ensure_chat_configs_exist(self.bq_client, self.dataset_id, self.table_chat_config, usernames)
+
+    def _buffer_update(self, chat_id, dates=(), last_message_id=None, last_message_date=None):
+        update = self._pending.setdefault(str(chat_id), {'dates': set(), 'last_message_id': None, 'last_message_date': None})
+        update['dates'].update(dates)
+        if last_message_id is not None and (update['last_message_id'] is None or update['last_message_id'] < last_message_id):
+            update['last_message_id'] = last_message_id
+            update['last_message_date'] = last_message_date
+
+    async def update_processed_dates(self, chat_id, dates):
+        self._buffer_update(chat_id, dates=dates)
+        await self._commit_if_due()
+
+    async def update_watermark(self, chat_id, last_message_id, last_message_date):
+        self._buffer_update(chat_id, last_message_id=last_message_id, last_message_date=last_message_date)
+        await self._commit_if_due()
+
+    async def _commit_if_due(self):
+        if time.monotonic() - self._last_commit >= self.commit_interval:
+            await self.commit()
+
+    async def commit(self):
+        pending, self._pending = self._pending, {}
+        self._last_commit = time.monotonic()
+        if not pending:
+            return
+        try:
+            await commit_chat_config_updates(self.bq_client, self.dataset_id, self.table_chat_config, pending)
+            logging.info(f"Committed chat config updates of {len(pending)} chats")
+        except Exception:
+            # Keep the updates for the next commit, merged with any buffered in the meantime
+            for chat_id, update in pending.items():
+                self._buffer_update(chat_id, **update)
+            raise
+
+    async def load_message_index(self, chat_id, start_date, end_date, min_id=0):
+        return await load_message_index(self.bq_client, self.dataset_id, self.table_chat_history, chat_id, start_date, end_date, min_id=min_id)
+
+    async def load_mutable_fields(self, chat_id, start_date, end_date, columns):
+        query = f"""
+        SELECT id, {', '.join(columns)}
+        FROM `{self.dataset_id}.{self.table_chat_history}`
+        WHERE chat_id = @chat_id AND date BETWEEN @start_date AND @end_date
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY id ORDER BY edit_date DESC) = 1
+        """
+        job_config = QueryJobConfig(query_parameters=[
+            ScalarQueryParameter("chat_id", "INT64", int(chat_id)),
+            ScalarQueryParameter("start_date", "TIMESTAMP", start_date),
+            ScalarQueryParameter("end_date", "TIMESTAMP", end_date),
+        ])
+
+        def run_query():
+            return [dict(row.items()) for row in self.bq_client.query(query, job_config=job_config).result()]
+
+        return await asyncio.to_thread(run_query)
+
+    async def history_days(self, start_date, end_date):
+        query = f"""
+        SELECT DISTINCT DATE(date) AS day
+        FROM `{self.dataset_id}.{self.table_chat_history}`
+        WHERE date >= @start_date AND date < @end_date
+        ORDER BY day
+        """
+        job_config = QueryJobConfig(query_parameters=[
+            ScalarQueryParameter("start_date", "TIMESTAMP", start_date),
+            ScalarQueryParameter("end_date", "TIMESTAMP", end_date),
+        ])
+
+        def run_query():
+            return [row['day'] for row in self.bq_client.query(query, job_config=job_config).result()]
+
+        return await asyncio.to_thread(run_query)
+
+    async def read_history(self, start_date, end_date, columns, chunk_rows):
+        query = f"""
+        SELECT {', '.join(columns)}
+        FROM `{self.dataset_id}.{self.table_chat_history}`
+        WHERE date >= @start_date AND date < @end_date
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY chat_id, id ORDER BY edit_date DESC) = 1
+        """
+        job_config = QueryJobConfig(query_parameters=[
+            ScalarQueryParameter("start_date", "TIMESTAMP", start_date),
+            ScalarQueryParameter("end_date", "TIMESTAMP", end_date),
+        ])
+        # Result pages are fetched one at a time as the chunks are consumed
+        pages = await asyncio.to_thread(lambda: self.bq_client.query(query, job_config=job_config).result(page_size=chunk_rows).pages)
+        while True:
+            page = await asyncio.to_thread(lambda: [dict(row.items()) for row in next(pages, ())])
+            if not page:
+                return
+            yield page
+
+    def table_id(self, table_type):
+        return f"{self.dataset_id}.{self.tables[table_type]}"
+
+    async def get_existing_ids(self, table_type, since=None):
+        table = f"`{self.dataset_id}.{self.tables[table_type]}`"
+        job_config = None
+        if since is None:
+            query = f"SELECT id FROM {table} WHERE id IS NOT NULL AND {_NOT_EXPORTED}"
+        else:
+            # Only the rows appended since are read, from the table's change history; it
+            # fails past the time travel window, or if rows were changed by DML since
+            query = f"SELECT id FROM APPENDS(TABLE {table}, @since, NULL) WHERE id IS NOT NULL AND {_NOT_EXPORTED}"
+            job_config = QueryJobConfig(query_parameters=[ScalarQueryParameter("since", "TIMESTAMP", since)])
+
+        def run_query():
+            return array('q', (row['id'] for row in self.bq_client.query(query, job_config=job_config).result()))
+
+        ids = await asyncio.to_thread(run_query)
+        logging.info(f"Fetched {len(ids)} existing IDs from {self.tables[table_type]}")
+        return ids
+
+    def writer(self, table_type, max_rows, max_bytes):
+        return BigQueryBatchWriter(
+            self.bq_client, table_type, self.dataset_id,
+            self.table_chat_config, self.table_chat_history,
+            self.table_chat_info, self.table_user_info,
+            max_rows=max_rows, max_bytes=max_bytes, load_format=self.load_format, spool=self.spool
+        )
+
+    def overwrite_writer(self, chat_id, start_date, end_date, max_rows, max_bytes):
+        return BigQueryOverwriteWriter(
+            self.bq_client, self.dataset_id, self.table_chat_history,
+            chat_id, start_date, end_date, self._apply_lock,
+            max_rows=max_rows, max_bytes=max_bytes, load_format=self.load_format
+        )
+
+    def merge_writer(self, columns, start_date, end_date, max_rows, max_bytes):
+        return BigQueryMergeWriter(
+            self.bq_client, self.dataset_id, self.table_chat_history,
+            columns, start_date, end_date, self._apply_lock,
+            max_rows=max_rows, max_bytes=max_bytes, load_format=self.load_format
+        )
+
+    async def upload_rows(self, table_type, rows):
+        return await upload_to_bigquery(
+            self.bq_client, rows, table_type, self.dataset_id,
+            self.table_chat_config, self.table_chat_history,
+            self.table_chat_info, self.table_user_info, spool=self.spool
+        )
+
+    async def stream_rows(self, table_type, rows):
+        """
+        Writes rows with the streaming insert API.
+
+        Load jobs are limited to 1,500 per table and day, far below the rate of
+        micro-batches of the stream mode; streamed rows are queryable within seconds.
+        They stay in the streaming buffer, where DML cannot change them, for up to 90
+        minutes: the overwrite and merge writers leave them alone (see STREAMED_ROW_LAG).
+        """
+        table = f"{self.dataset_id}.{self.tables[table_type]}"
+        try:
+            with metrics.timed('load_job_duration_seconds', table=self.tables[table_type]):
+                errors = await asyncio.to_thread(self.bq_client.insert_rows_json, table, rows)
+        except Exception as e:
+            logging.error(f"Error streaming {len(rows)} rows into {table}: {e}")
+            return False
+        if errors:
+            logging.error(f"Error streaming {len(rows)} rows into {table}: {errors[:3]}")
+            return False
+        return True
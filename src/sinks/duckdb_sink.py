@@ -0,0 +1,392 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from array import array
+from datetime import date
+import metrics
+from arrow_encoder import ColumnarBuffer, load_table_schema
+from sinks.base import EXPORT_SOURCE, Sink
+from telegram_api.coverage import add_dates
+from telegram_api.message_index import MessageIdIndex
+
+_DUCKDB_TYPES = {
+    'INTEGER': 'BIGINT',
+    'INT64': 'BIGINT',
+    'FLOAT': 'DOUBLE',
+    'FLOAT64': 'DOUBLE',
+    'BOOLEAN': 'BOOLEAN',
+    'BOOL': 'BOOLEAN',
+    'STRING': 'VARCHAR',
+    'TIMESTAMP': 'TIMESTAMPTZ',
+    'DATE': 'DATE',
+}
+
+TABLE_TYPES = ('chat_config', 'chat_history', 'chat_info', 'user_info', 'message_deletions')
+
+# Columns whose type changed: (table, column, old DuckDB type, new type, expression converting the old values)
+_RETYPED_COLUMNS = [
+    # post_author held 0 for posts without a signature, and dropped signatures
+    ('chat_history', 'post_author', 'BIGINT', 'VARCHAR', 'NULL'),
+]
+
+
+class DuckDBSink(Sink):
+    """
+    Sink backed by a local DuckDB database file.
+
+    Tables are created from the same schema files as the BigQuery tables, so the
+    pipeline can run offline (on a laptop, in CI, or as a throughput baseline with
+    no network) against a cheap local warehouse. Requires the `duckdb` and
+    `pyarrow` packages.
+    """
+
+    name = 'duckdb'
+
+    def __init__(self, path):
+        """
+        Parameters:
+        - path: Path of the DuckDB database file, created if missing.
+        """
+        import duckdb
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._conn = duckdb.connect(path)
+        # DuckDB connections are not safe for concurrent use from several threads
+        self._db_lock = threading.Lock()
+        for table_type in TABLE_TYPES:
+            fields = load_table_schema(table_type)
+            columns = ", ".join(f"{field['name']} {_column_type(field)}" for field in fields)
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS {table_type} ({columns})")
+            # Databases created with an older schema get the columns added since
+            for field in fields:
+                self._conn.execute(f"ALTER TABLE {table_type} ADD COLUMN IF NOT EXISTS {field['name']} {_column_type(field)}")
+        for table_type, column, old_type, new_type, expression in _RETYPED_COLUMNS:
+            current = self._conn.execute(
+                "SELECT data_type FROM information_schema.columns WHERE table_name = ? AND column_name = ?", [table_type, column]
+            ).fetchone()
+            if current and current[0] == old_type:
+                self._conn.execute(f"ALTER TABLE {table_type} ALTER {column} TYPE {new_type} USING {expression}")
+
+    def _execute(self, query, params=None):
+        with self._db_lock:
+            return self._conn.execute(query, params or []).fetchall()
+
+    async def _run(self, query, params=None):
+        return await asyncio.to_thread(self._execute, query, params)
+
+    async def get_chat_configs(self):
+        rows = await self._run("SELECT id, username, dates_to_load, last_message_id, last_message_date, coverage FROM chat_config")
+        chat_configs = {}
+        for chat_id, username, dates_to_load, last_message_id, last_message_date, coverage in rows:
+            chat_configs[username or ''] = {
+                'id': str(chat_id),
+                'username': username or '',
+                'dates_to_load': dates_to_load or [date.today()],
+                'last_message_id': last_message_id,
+                'last_message_date': last_message_date,
+                'coverage': [(covered['start_date'], covered['end_date']) for covered in coverage or []],
+            }
+        return chat_configs
+
+    async def ensure_chat_configs(self, usernames):
+        for username in usernames:
+            await self._run(
+                "INSERT INTO chat_config (id, username, dates_to_load) "
+                "SELECT ?, ?, [] WHERE NOT EXISTS (SELECT 1 FROM chat_config WHERE id = ?)",
+                [username, username, username],
+            )
+
+    async def update_processed_dates(self, chat_id, dates):
+        dates = [d if isinstance(d, date) else date.fromisoformat(d) for d in dates]
+
+        def update_coverage():
+            # Read and write under one lock hold so concurrent updates of a chat are not lost
+            with self._db_lock:
+                rows = self._conn.execute("SELECT coverage FROM chat_config WHERE id = ?", [str(chat_id)]).fetchall()
+                if not rows:
+                    return
+                intervals = [(covered['start_date'], covered['end_date']) for covered in rows[0][0] or []]
+                coverage = [{'start_date': start, 'end_date': end} for start, end in add_dates(intervals, dates)]
+                self._conn.execute(
+                    "UPDATE chat_config SET coverage = ?::STRUCT(start_date DATE, end_date DATE)[] WHERE id = ?",
+                    [coverage, str(chat_id)],
+                )
+
+        await asyncio.to_thread(update_coverage)
+
+    async def update_watermark(self, chat_id, last_message_id, last_message_date):
+        await self._run(
+            "UPDATE chat_config SET last_message_id = ?, last_message_date = ? "
+            "WHERE id = ? AND (last_message_id IS NULL OR last_message_id < ?)",
+            [int(last_message_id), last_message_date, str(chat_id), int(last_message_id)],
+        )
+
+    async def load_message_index(self, chat_id, start_date, end_date, min_id=0):
+        rows = await self._run(
+            "SELECT id FROM chat_history WHERE chat_id = ? AND date BETWEEN ? AND ? AND id > ?",
+            [int(chat_id), start_date, end_date, int(min_id)],
+        )
+        return MessageIdIndex(row[0] for row in rows)
+
+    async def load_mutable_fields(self, chat_id, start_date, end_date, columns):
+        rows = await self._run(
+            f"SELECT id, {', '.join(columns)} FROM chat_history WHERE chat_id = ? AND date BETWEEN ? AND ? "
+            "QUALIFY ROW_NUMBER() OVER (PARTITION BY id ORDER BY edit_date DESC) = 1",
+            [int(chat_id), start_date, end_date],
+        )
+        return [dict(zip(('id', *columns), row)) for row in rows]
+
+    async def history_days(self, start_date, end_date):
+        rows = await self._run(
+            "SELECT DISTINCT CAST(timezone('UTC', date) AS DATE) AS day FROM chat_history "
+            "WHERE date >= ? AND date < ? ORDER BY day",
+            [start_date, end_date],
+        )
+        return [row[0] for row in rows]
+
+    async def read_history(self, start_date, end_date, columns, chunk_rows):
+        # A cursor of its own, so the chunks are read without holding the sink's lock
+        cursor = self._conn.cursor()
+        try:
+            await asyncio.to_thread(
+                cursor.execute,
+                f"SELECT {', '.join(columns)} FROM chat_history WHERE date >= ? AND date < ? "
+                "QUALIFY ROW_NUMBER() OVER (PARTITION BY chat_id, id ORDER BY edit_date DESC) = 1",
+                [start_date, end_date],
+            )
+            while True:
+                rows = await asyncio.to_thread(cursor.fetchmany, chunk_rows)
+                if not rows:
+                    return
+                yield [dict(zip(columns, row)) for row in rows]
+        finally:
+            cursor.close()
+
+    def table_id(self, table_type):
+        return f"{os.path.abspath(self.path)}:{table_type}"
+
+    async def get_existing_ids(self, table_type, since=None):
+        # Rows do not record when they were added; scanning a local table is cheap anyway
+        if since is not None:
+            return None
+        rows = await self._run(f"SELECT id FROM {table_type} WHERE id IS NOT NULL AND (source IS NULL OR source != ?)", [EXPORT_SOURCE])
+        ids = array('q', (row[0] for row in rows))
+        logging.info(f"Fetched {len(ids)} existing IDs from {table_type}")
+        return ids
+
+    def writer(self, table_type, max_rows, max_bytes):
+        return DuckDBBatchWriter(self, table_type, max_rows, max_bytes)
+
+    def overwrite_writer(self, chat_id, start_date, end_date, max_rows, max_bytes):
+        return DuckDBOverwriteWriter(self, chat_id, start_date, end_date, max_rows, max_bytes)
+
+    def replace_chat_range(self, staging_table, chat_id, start_date, end_date):
+        """
+        Replaces the messages of a chat within a date range with the rows of a staging table, in one transaction.
+        """
+        with self._db_lock:
+            self._conn.execute("BEGIN TRANSACTION")
+            try:
+                self._conn.execute(
+                    "DELETE FROM chat_history WHERE chat_id = ? AND date BETWEEN ? AND ?",
+                    [int(chat_id), start_date, end_date],
+                )
+                self._conn.execute(f"INSERT INTO chat_history BY NAME SELECT * FROM {staging_table}")
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            finally:
+                self._conn.execute(f"DROP TABLE IF EXISTS {staging_table}")
+
+    def merge_writer(self, columns, start_date, end_date, max_rows, max_bytes):
+        return DuckDBMergeWriter(self, columns, start_date, end_date, max_rows, max_bytes)
+
+    def update_columns(self, staging_table, columns, start_date, end_date):
+        """
+        Updates columns of the chat_history rows matching the rows of a staging table, in one transaction.
+        """
+        assignments = ", ".join(f"{column} = source.{column}" for column in columns)
+        with self._db_lock:
+            self._conn.execute("BEGIN TRANSACTION")
+            try:
+                self._conn.execute(
+                    f"UPDATE chat_history SET {assignments} FROM {staging_table} AS source "
+                    "WHERE chat_history.chat_id = source.chat_id AND chat_history.id = source.id "
+                    "AND chat_history.date = source.date AND chat_history.date BETWEEN ? AND ?",
+                    [start_date, end_date],
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            finally:
+                self._conn.execute(f"DROP TABLE IF EXISTS {staging_table}")
+
+    async def upload_rows(self, table_type, rows):
+        async with self.writer(table_type, max(len(rows), 1), float('inf')) as writer:
+            for row in rows:
+                await writer.add(row)
+        return writer.rows_failed == 0
+
+    async def stream_rows(self, table_type, rows):
+        return await self.upload_rows(table_type, rows)
+
+    def insert_batch(self, table_type, batch):
+        """
+        Appends an Arrow RecordBatch to a table.
+        """
+        with self._db_lock:
+            self._conn.register('_batch', batch)
+            try:
+                self._conn.execute(f"INSERT INTO {table_type} BY NAME SELECT * FROM _batch")
+            finally:
+                self._conn.unregister('_batch')
+
+    def close(self):
+        with self._db_lock:
+            self._conn.close()
+
+
+class DuckDBBatchWriter:
+    """
+    Buffers rows into typed columns and appends them to a DuckDB table in chunks.
+    """
+
+    def __init__(self, sink, table_type, max_rows, max_bytes):
+        self.sink = sink
+        self.table_type = table_type
+        self.table_name = table_type
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.rows_added = 0
+        self.rows_loaded = 0
+        self.rows_failed = 0
+        self.bytes_loaded = 0
+        self.encode_seconds = 0.0
+        self._columns = ColumnarBuffer(table_type)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def add(self, row):
+        self._columns.add(row)
+        self.rows_added += 1
+        if self._columns.rows >= self.max_rows or self._columns.nbytes >= self.max_bytes:
+            await self.flush()
+
+    async def flush(self):
+        rows = self._columns.rows
+        if not rows:
+            return
+        start = time.perf_counter()
+        batch = self._columns.to_record_batch()
+        self.encode_seconds += time.perf_counter() - start
+        self._columns = ColumnarBuffer(self.table_type)
+        try:
+            with metrics.timed('load_job_duration_seconds', table=self.table_type):
+                await asyncio.to_thread(self.sink.insert_batch, self.table_name, batch)
+            self.rows_loaded += rows
+            self.bytes_loaded += batch.nbytes
+        except Exception as e:
+            logging.error(f"Error inserting {rows} rows into {self.table_name}: {e}")
+            self.rows_failed += rows
+
+    async def close(self):
+        await self.flush()
+
+
+class DuckDBStagingWriter(DuckDBBatchWriter):
+    """
+    Stages chat_history rows in a table of their own and applies them to chat_history on close.
+
+    Subclasses implement `_apply`, which runs in a worker thread once every row is
+    staged. Nothing is applied if the block raised or a chunk failed.
+    """
+
+    def __init__(self, sink, table_name, max_rows, max_bytes):
+        super().__init__(sink, 'chat_history', max_rows, max_bytes)
+        self.table_name = table_name
+
+    async def __aenter__(self):
+        await self.sink._run(f"CREATE OR REPLACE TABLE {self.table_name} AS SELECT * FROM chat_history LIMIT 0")
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.close()
+            return
+        await self.sink._run(f"DROP TABLE IF EXISTS {self.table_name}")
+
+    async def close(self):
+        await self.flush()
+        if self.rows_failed:
+            logging.error(f"Not applying {self.table_name} to chat_history: {self.rows_failed} rows failed to load")
+            await self.sink._run(f"DROP TABLE IF EXISTS {self.table_name}")
+            return
+        try:
+            await asyncio.to_thread(self._apply)
+        except Exception as e:
+            logging.error(f"Error applying {self.table_name} to chat_history: {e}")
+            self.rows_failed += self.rows_loaded
+            self.rows_loaded = 0
+
+    def _apply(self):
+        raise NotImplementedError
+
+
+class DuckDBOverwriteWriter(DuckDBStagingWriter):
+    """
+    Stages the rows of one chat and date range and swaps them into chat_history on close.
+    """
+
+    def __init__(self, sink, chat_id, start_date, end_date, max_rows, max_bytes):
+        self.chat_id = int(chat_id)
+        self.start_date = start_date
+        self.end_date = end_date
+        self.range_complete = False
+        # Supergroup and channel IDs are negative, and '-' is not allowed in an unquoted table name
+        chat = f"n{-self.chat_id}" if self.chat_id < 0 else str(self.chat_id)
+        table_name = f"chat_history_staging_{chat}_{start_date:%Y%m%d%H%M%S}_{end_date:%Y%m%d%H%M%S}"
+        super().__init__(sink, table_name, max_rows, max_bytes)
+
+    def _apply(self):
+        if not self.rows_loaded and not self.range_complete:
+            logging.warning(f"Not clearing chat {self.chat_id} from {self.start_date} to {self.end_date}: no rows were fetched")
+            self.sink._execute(f"DROP TABLE IF EXISTS {self.table_name}")
+            return
+        self.sink.replace_chat_range(self.table_name, self.chat_id, self.start_date, self.end_date)
+
+
+class DuckDBMergeWriter(DuckDBStagingWriter):
+    """
+    Stages changed rows and updates the columns of the matching chat_history rows on close.
+    """
+
+    def __init__(self, sink, columns, start_date, end_date, max_rows, max_bytes):
+        self.columns = list(columns)
+        self.start_date = start_date
+        self.end_date = end_date
+        table_name = f"chat_history_refresh_{start_date:%Y%m%d%H%M%S}_{end_date:%Y%m%d%H%M%S}"
+        super().__init__(sink, table_name, max_rows, max_bytes)
+
+    def _apply(self):
+        self.sink.update_columns(self.table_name, self.columns, self.start_date, self.end_date)
+
+
+def _column_type(field):
+    if field['type'] in ('RECORD', 'STRUCT'):
+        column_type = "STRUCT(" + ", ".join(f"{subfield['name']} {_column_type(subfield)}" for subfield in field['fields']) + ")"
+    else:
+        column_type = _DUCKDB_TYPES[field['type']]
+    if field.get('mode') == 'REPEATED':
+        return f"{column_type}[]"
+    return column_type
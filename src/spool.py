@@ -0,0 +1,147 @@
+import gzip
+import json
+import logging
+import os
+import threading
+
+MANIFEST = 'manifest.jsonl'
+
+
+class Spool:
+    """
+    Local write-ahead log of encoded load payloads.
+
+    Every chunk is written to its own segment file before its load job is submitted
+    and the segment is only deleted once the load is confirmed, so rows fetched by a
+    run that is killed or whose loads keep failing are not lost: the next run loads
+    the leftover segments before fetching anything (see Sink.recover).
+
+    Segments are append-only: a segment file is written to a temporary name, synced
+    and renamed, and only then recorded in the manifest, an append-only log of
+    'add' and 'done' records. Files without an 'add' record (a crash mid-write) and
+    files with a 'done' record (a crash before the delete) are removed on open.
+    JSON payloads are stored gzip-compressed, Parquet payloads as they are since
+    Parquet pages are compressed already.
+    """
+
+    def __init__(self, directory):
+        """
+        Opens the spool and recovers its pending segments.
+
+        Args:
+            directory (str): The spool directory, created if missing. Point it at a
+                mounted volume so segments survive a replaced container.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._manifest_path = os.path.join(directory, MANIFEST)
+        self._segments = {}
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._recover()
+
+    def _recover(self):
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn last line from a crash mid-append
+                        continue
+                    if record['op'] == 'add':
+                        self._segments[record['segment']] = record
+                    else:
+                        self._segments.pop(record['segment'], None)
+                    self._seq = max(self._seq, record['seq'])
+        for name in os.listdir(self.directory):
+            if name != MANIFEST and name not in self._segments:
+                os.remove(os.path.join(self.directory, name))
+        self._segments = {name: record for name, record in self._segments.items() if os.path.exists(self._path(name))}
+        self._rewrite_manifest()
+        if self._segments:
+            logging.info(f"Spool {self.directory} holds {len(self._segments)} segments with {self.pending_rows} rows from an earlier run")
+
+    def _path(self, segment):
+        return os.path.join(self.directory, segment)
+
+    def _rewrite_manifest(self):
+        tmp_path = f"{self._manifest_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for record in self._segments.values():
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._manifest_path)
+
+    def _log(self, record):
+        with open(self._manifest_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def __len__(self):
+        return len(self._segments)
+
+    @property
+    def pending_rows(self):
+        return sum(record['rows'] for record in self._segments.values())
+
+    def pending(self):
+        """
+        Returns:
+            list: The manifest records ('segment', 'table_type', 'load_format', 'rows') of the
+            segments not loaded yet, oldest first.
+        """
+        with self._lock:
+            return sorted(self._segments.values(), key=lambda record: record['seq'])
+
+    def append(self, table_type, load_format, rows, payload):
+        """
+        Writes a payload to a new segment. Blocking, call it from a worker thread.
+
+        Args:
+            table_type (str): The table the payload is loaded into.
+            load_format (str): The encoding of the payload ('json' or 'parquet').
+            rows (int): The number of rows in the payload.
+            payload (bytes): The encoded rows.
+
+        Returns:
+            str: The name of the segment.
+        """
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+        compressed = load_format == 'json'
+        segment = f"{seq:010d}.{table_type}.{load_format}{'.gz' if compressed else ''}"
+        tmp_path = self._path(f"{segment}.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(gzip.compress(payload, compresslevel=1) if compressed else payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._path(segment))
+        record = {'op': 'add', 'seq': seq, 'segment': segment, 'table_type': table_type, 'load_format': load_format, 'rows': rows}
+        with self._lock:
+            self._log(record)
+            self._segments[segment] = record
+        return segment
+
+    def read(self, segment):
+        """
+        Returns the payload of a segment.
+        """
+        with open(self._path(segment), 'rb') as f:
+            data = f.read()
+        return gzip.decompress(data) if segment.endswith('.gz') else data
+
+    def remove(self, segment):
+        """
+        Marks a segment as loaded and deletes it. Blocking, call it from a worker thread.
+        """
+        with self._lock:
+            record = self._segments.pop(segment)
+            self._log({'op': 'done', 'seq': record['seq'], 'segment': segment})
+            if not self._segments:
+                # Keep the manifest from growing across runs
+                self._rewrite_manifest()
+        os.remove(self._path(segment))
@@ -54,10 +54,11 @@ async def get_chat_configs(bq_client, dataset_id, table_chat_config):
 
     Returns:
         dict: A dictionary containing chat configurations, where the keys are usernames and the values are dictionaries
-              with the chat configuration details.
+              with the chat configuration details, including the `last_message_id` / `last_message_date` watermark
+              and the `coverage` of fully loaded days as compacted (start_date, end_date) tuples.
     """
     query = f"""
-    SELECT id, username, dates_to_load
+    SELECT id, username, dates_to_load, last_message_id, last_message_date, coverage
     FROM `{dataset_id}.{table_chat_config}`
     """
     
@@ -70,44 +71,76 @@ async def get_chat_configs(bq_client, dataset_id, table_chat_config):
         config['id'] = str(config['id'])
         config['username'] = config['username'] or ''
         config['dates_to_load'] = config['dates_to_load'] or [date.today()]  # Use today's date if empty
+        config['coverage'] = [(covered['start_date'], covered['end_date']) for covered in config['coverage'] or []]
         chat_configs[config['username']] = config
         
     return chat_configs
 
-async def update_processed_date(bq_client, dataset_id, table_chat_config, chat_id, new_dates):
+async def commit_chat_config_updates(bq_client, dataset_id, table_chat_config, updates):
     """
-    Updates the processed dates for a chat configuration in a BigQuery table.
+    Applies the loaded dates and watermarks of many chats in a single MERGE.
+
+    Each chat's dates are added to its `coverage`, which is re-compacted into
+    non-overlapping date intervals (gaps and islands over the covered days), and its
+    watermark is advanced if the new one is newer, so one DML job covers every chat
+    of a run instead of one UPDATE per chat.
 
     Args:
         bq_client (google.cloud.bigquery.Client): The BigQuery client.
         dataset_id (str): The ID of the dataset containing the target table.
         table_chat_config (str): The name of the target table.
-        chat_id (str): The ID of the chat.
-        new_dates (list): A list of new dates to be added to the processed dates.
+        updates (dict): Per chat ID, a dictionary with the fully loaded 'dates' to add and the new
+            'last_message_id' / 'last_message_date' watermark (None to leave it unchanged).
 
     Returns:
         google.cloud.bigquery.job.QueryJob: The query job object.
 
+    Raises:
+        google.cloud.exceptions.GoogleCloudError: If there is an error executing the BigQuery query.
     """
     query = f"""
-    UPDATE `{dataset_id}.{table_chat_config}`
-    SET dates_to_load = ARRAY(
-        SELECT DISTINCT date
-        FROM UNNEST(ARRAY_CONCAT(dates_to_load, @new_dates)) AS date
-        WHERE date <= CURRENT_DATE()
-    )
-    WHERE id = @chat_id
+    MERGE `{dataset_id}.{table_chat_config}` AS target
+    USING (SELECT * FROM UNNEST(@updates)) AS source
+    ON target.id = source.id
+    WHEN MATCHED THEN
+        UPDATE SET
+            coverage = ARRAY(
+                SELECT AS STRUCT MIN(day) AS start_date, MAX(day) AS end_date
+                FROM (
+                    SELECT day, DATE_SUB(day, INTERVAL ROW_NUMBER() OVER (ORDER BY day) DAY) AS island
+                    FROM (
+                        SELECT DISTINCT day
+                        FROM UNNEST(ARRAY_CONCAT(
+                            ARRAY(
+                                SELECT day
+                                FROM UNNEST(target.coverage) AS covered, UNNEST(GENERATE_DATE_ARRAY(covered.start_date, covered.end_date)) AS day
+                            ),
+                            source.dates
+                        )) AS day
+                    )
+                )
+                GROUP BY island
+                ORDER BY start_date
+            ),
+            last_message_id = IF(source.last_message_id > IFNULL(target.last_message_id, -1), source.last_message_id, target.last_message_id),
+            last_message_date = IF(source.last_message_id > IFNULL(target.last_message_id, -1), source.last_message_date, target.last_message_date)
     """
-    
-    new_dates_str = [d.isoformat() if isinstance(d, date) else d for d in new_dates]
-    
+
     job_config = bigquery.QueryJobConfig(
         query_parameters=[
-            bigquery.ArrayQueryParameter("new_dates", "DATE", new_dates_str),
-            bigquery.ScalarQueryParameter("chat_id", "STRING", str(chat_id)),
+            bigquery.ArrayQueryParameter("updates", "STRUCT", [
+                bigquery.StructQueryParameter(
+                    None,
+                    bigquery.ScalarQueryParameter("id", "STRING", str(chat_id)),
+                    bigquery.ArrayQueryParameter("dates", "DATE", sorted(d if isinstance(d, date) else date.fromisoformat(d) for d in update.get('dates', ()))),
+                    bigquery.ScalarQueryParameter("last_message_id", "INT64", update.get('last_message_id')),
+                    bigquery.ScalarQueryParameter("last_message_date", "TIMESTAMP", update.get('last_message_date')),
+                )
+                for chat_id, update in updates.items()
+            ]),
         ]
     )
-    
+
     def run_query():
         query_job = bq_client.query(query, job_config=job_config)
         query_job.result()
@@ -115,41 +148,48 @@ async def update_processed_date(bq_client, dataset_id, table_chat_config, chat_i
 
     return await asyncio.to_thread(run_query)
 
-def ensure_chat_config_exists(bq_client, dataset_id, table_chat_config, chat_id, username):
+async def ensure_chat_configs_exist(bq_client, dataset_id, table_chat_config, usernames):
     """
-    Ensures that a chat configuration exists in a BigQuery table. If the configuration does not exist, it will be inserted with an empty list of dates to load.
+    Ensures that chat configurations exist in a BigQuery table with a single MERGE. Missing configurations are inserted with an empty list of dates to load.
 
     Args:
         bq_client (google.cloud.bigquery.Client): The BigQuery client.
         dataset_id (str): The ID of the dataset containing the target table.
         table_chat_config (str): The name of the target table.
-        chat_id (str): The ID of the chat.
-        username (str): The username associated with the chat.
+        usernames (list): The usernames of the chats, also used as their IDs.
 
     Returns:
-        None
+        google.cloud.bigquery.job.QueryJob: The query job object.
 
     Raises:
         google.cloud.exceptions.GoogleCloudError: If there is an error executing the BigQuery query.
 
     """
-    today = date.today().isoformat()
     query = f"""
     MERGE `{dataset_id}.{table_chat_config}` AS target
-    USING (SELECT @chat_id AS id, @username AS username) AS source
+    USING (SELECT DISTINCT id, username FROM UNNEST(@chats)) AS source
     ON target.id = source.id
     WHEN NOT MATCHED THEN
         INSERT (id, username, dates_to_load)
-        VALUES (@chat_id, @username, [])
+        VALUES (source.id, source.username, [])
     """
-    
+
     job_config = bigquery.QueryJobConfig(
         query_parameters=[
-            bigquery.ScalarQueryParameter("chat_id", "STRING", str(chat_id)),
-            bigquery.ScalarQueryParameter("username", "STRING", username or ''),
-            bigquery.ScalarQueryParameter("today", "DATE", today),
+            bigquery.ArrayQueryParameter("chats", "STRUCT", [
+                bigquery.StructQueryParameter(
+                    None,
+                    bigquery.ScalarQueryParameter("id", "STRING", str(username)),
+                    bigquery.ScalarQueryParameter("username", "STRING", username or ''),
+                )
+                for username in usernames
+            ]),
         ]
     )
-    
-    query_job = bq_client.query(query, job_config=job_config)
-    query_job.result()
\ No newline at end of file
+
+    def run_query():
+        query_job = bq_client.query(query, job_config=job_config)
+        query_job.result()
+        return query_job
+
+    return await asyncio.to_thread(run_query)
@@ -1,116 +1,186 @@
 import logging
-from telegram_api.user_info import get_user_info
-from google.cloud import bigquery
+import asyncio
+from collections import deque
+from contextlib import aclosing
+import metrics
+from telethon.tl.types import User
+from telegram_api.user_info import get_users_info
+from telegram_api.message_index import MessageIdIndex, DEDUP_STOP
+from telegram_api.message_transformer import MessageTransformer, standardize_chat_id
+from telegram_api.near_duplicates import ASSIGN_BATCH_SIZE, assign_clusters
 
-def decode_emoji(emoji_string):
+async def prefetch(source, maxsize=200):
     """
-    Decode Unicode escape sequences to actual emoji characters.
-    """
-    return emoji_string.encode('utf-16', 'surrogatepass').decode('utf-16')
+    Iterates an async iterator from a background task through a bounded buffer.
 
-async def get_message_reactions(message):
-    """
-    Retrieve reactions for a given message and format them as a string.
-    """
-    reaction_str = ""
-    if hasattr(message, 'reactions') and message.reactions:
-        reactions = []
-        for reaction in message.reactions.results:
-            if hasattr(reaction.reaction, 'emoticon'):
-                emoji = decode_emoji(reaction.reaction.emoticon)
-            elif hasattr(reaction.reaction, 'document_id'):
-                emoji = f"CustomEmoji:{reaction.reaction.document_id}"
-            else:
-                emoji = "UnknownEmoji"
-            reactions.append(f"{emoji}:{reaction.count}")
-        reaction_str = ", ".join(reactions)
-    return reaction_str
-
-def standardize_chat_id(chat_id):
-    """
-    Standardize the chat ID by removing the -100 prefix if present.
+    The next page of Telegram messages is requested while the previous one is
+    being transformed; the buffer bound keeps memory flat. Errors raised by the
+    source are re-raised to the consumer.
+
+    Items are handed over in a plain deque, with events only to wait on an empty
+    or a full buffer, at a fraction of the per-item cost of asyncio.Queue.
     """
-    chat_id_str = str(chat_id)
-    if chat_id_str.startswith('-100'):
-        return int(chat_id_str[4:])
-    return int(chat_id)
+    buffer = deque()
+    readable = asyncio.Event()
+    writable = asyncio.Event()
+    done = object()
+
+    async def produce():
+        try:
+            async for item in source:
+                buffer.append(item)
+                readable.set()
+                if len(buffer) >= maxsize:
+                    writable.clear()
+                    await writable.wait()
+            buffer.append(done)
+        except Exception as e:
+            buffer.append(e)
+        readable.set()
 
-async def get_chat_history(client, chat, start_date, end_date, bq_client, dataset_id, table_chat_history):
+    task = asyncio.create_task(produce())
+    try:
+        while True:
+            if not buffer:
+                readable.clear()
+                await readable.wait()
+            item = buffer.popleft()
+            writable.set()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        task.cancel()
+
+async def get_chat_history(client, chat, start_date, end_date, sink, dedup_strategy=DEDUP_STOP, user_cache=None, writer=None, raise_errors=False, min_id=0, legacy_columns=False, near_duplicates=None, existing_users=None):
     """
     Retrieves the chat history from a given chat within a specified date range.
+
+    Already loaded messages are detected against an in-memory index fetched from
+    the sink with a single query per chat and date window. With the 'stop' strategy the scan
+    ends at the first known message; with 'skip' known messages are dropped and
+    the scan continues to the start date.
+
+    Senders are collected while scanning and resolved once at the end through
+    `get_users_info`, backed by `user_cache` when given. Senders already in
+    `existing_users` (e.g. DataProcessor's KnownIdIndex) are not looked up at all.
+
+    When a `writer` (see Sink.writer) is given, rows are streamed to it
+    as they are transformed instead of being collected, so memory stays flat
+    regardless of the date range and the returned message list is empty. Its
+    `scanned_from` is set to the date down to which every message of the range
+    was fetched: `start_date` once the scan reaches a message older than it or
+    the end of the history (with `min_id`, the watermark, below which messages
+    count as loaded), else the date of the loaded message that stopped the
+    'stop' strategy. Its `range_complete` is set when, without `min_id`, the whole
+    range was fetched (see Sink.overwrite_writer).
+
+    With `min_id` (a chat watermark) Telegram only returns newer messages, so only
+    the IDs loaded above the watermark are looked up: the watermark may lag the
+    loaded rows (after a partly failed range, a run killed before its chat config
+    updates were committed, or rows recovered from the spool). The lookup is
+    skipped when `dedup_strategy` is None, for writers that overwrite the whole
+    range (see Sink.overwrite_writer).
+
+    Rows are built by MessageTransformer; `legacy_columns` also fills the legacy
+    str() repr columns (media, buttons, action, reactions). With a `near_duplicates`
+    index (see NearDuplicateIndex) rows are clustered in batches of ASSIGN_BATCH_SIZE
+    and get their duplicate_cluster column before they are added.
+
+    Errors are logged and an empty result is returned, unless `raise_errors` is
+    set, in which case they are re-raised after logging.
+
+    Returns:
+        tuple: (messages, users, watermark) where watermark is the (id, date) of the
+        newest fetched message, or None if nothing was fetched.
     """
     logging.info(f"Fetching chat history for {chat} from {start_date} to {end_date}")
     try:
         messages = []
-        users = {}
+        sender_ids = set()
+        known_users = {}
+        skipped = 0
+        fetched = 0
+        watermark = None
+        chat_label = getattr(chat, 'username', None) or str(chat.id)
+        transformer = MessageTransformer(client, legacy_columns=legacy_columns)
+        pending = []
+
+        async def add_rows(rows):
+            await assign_clusters(near_duplicates, rows)
+            for row in rows:
+                if writer is not None:
+                    await writer.add(row)
+                else:
+                    messages.append(row)
+
+        if dedup_strategy is None:
+            loaded_ids = MessageIdIndex()
+        else:
+            loaded_ids = await sink.load_message_index(standardize_chat_id(chat.id), start_date, end_date, min_id=min_id)
         
-        async for message in client.iter_messages(chat, offset_date=end_date, reverse=False):
-            if message.date < start_date:
-                logging.info(f"Reached message before start date. Stopping.")
-                break
+        # Telethon waits a second between pages of long scans; an RPC governor paces the pages itself
+        wait_time = 0 if getattr(client, 'rpc_governor', None) else None
+        scanned_from, stopped = start_date, False
+        async with aclosing(prefetch(client.iter_messages(chat, offset_date=end_date, min_id=min_id, reverse=False, wait_time=wait_time))) as history:
+            async for message in history:
+                if message.date < start_date:
+                    logging.info(f"Reached message before start date. Stopping.")
+                    break
             
-            if await message_exists_in_bigquery(message.id, message.chat_id, bq_client, dataset_id, table_chat_history):
-                logging.info(f"Message {message.id} already exists in BigQuery. Stopping.")
-                break
+                if message.id in loaded_ids:
+                    if dedup_strategy == DEDUP_STOP:
+                        logging.info(f"Message {message.id} is already loaded. Stopping.")
+                        # Older messages of the range were not scanned
+                        scanned_from, stopped = message.date, True
+                        break
+                    skipped += 1
+                    continue
             
-            reactions = await get_message_reactions(message)
-            
-            # Ensure date fields are properly converted to float
-            edit_date_timestamp = message.edit_date.timestamp() if message.edit_date else 0.0
-            
-            message_data = {
-                'id': message.id,
-                'date': message.date.strftime('%Y-%m-%d %H:%M:%S %z'),
-                'from_user': str(message.from_id.user_id) if hasattr(message.from_id, 'user_id') else None,
-                'text': message.text,
-                'sender': str(message.sender_id) if message.sender_id else None,
-                'chat_id': str(standardize_chat_id(message.chat_id)),
-                'is_reply': bool(message.reply_to_msg_id),
-                'views': message.views if message.views is not None else 0,
-                'forwards': message.forwards if message.forwards is not None else 0,
-                'replies': message.replies.replies if message.replies else 0,
-                'buttons': str(message.buttons),
-                'media': str(message.media) if message.media else None,
-                'mentioned': message.mentioned,
-                'post_author': message.post_author if message.post_author is not None else 0,
-                'edit_date': edit_date_timestamp,  # Should be a float
-                'via_bot': int(message.via_bot_id) if message.via_bot_id is not None else 0,
-                'reply_to_msg_id': message.reply_to.reply_to_msg_id if message.reply_to else 0,
-                'reactions': reactions,  # Now a formatted string of emojis and counts
-                'grouped_id': int(message.grouped_id) if message.grouped_id is not None else 0,
-                'action': str(message.action) if message.action else None,
-            }
-            messages.append(message_data)
+                message_data = transformer.transform(message)
+                fetched += 1
+                # Counted in batches so progress is reported during long scans
+                if fetched % 100 == 0:
+                    metrics.inc('messages_fetched', 100, chat=chat_label)
+                if watermark is None or message.id > watermark[0]:
+                    watermark = (message.id, message.date)
+                if near_duplicates is not None:
+                    pending.append(message_data)
+                    if len(pending) >= ASSIGN_BATCH_SIZE:
+                        await add_rows(pending)
+                        pending = []
+                elif writer is not None:
+                    await writer.add(message_data)
+                else:
+                    messages.append(message_data)
                         
-            if hasattr(message.from_id, 'user_id') and message.from_id.user_id not in users:
-                user_info = await get_user_info(client, message.from_id.user_id)
-                if user_info:
-                    users[str(message.from_id.user_id)] = user_info
+                if hasattr(message.from_id, 'user_id'):
+                    user_id = message.from_id.user_id
+                    if user_id not in sender_ids and (existing_users is None or user_id not in existing_users):
+                        sender_ids.add(user_id)
+                        if isinstance(message.sender, User):
+                            known_users[user_id] = message.sender
+
+        if pending:
+            await add_rows(pending)
+        if writer is not None:
+            writer.scanned_from = scanned_from
+            # Below a watermark the range was not fetched at all
+            writer.range_complete = not stopped and not min_id
+        if fetched % 100:
+            metrics.inc('messages_fetched', fetched % 100, chat=chat_label)
 
-        logging.info(f"Fetched {len(messages)} messages from {start_date} to {end_date}")
-        return messages, users
+        with metrics.timed('stage_duration_seconds', stage='user_lookup', chat=chat_label):
+            users = await get_users_info(client, sender_ids, known_users=known_users, cache=user_cache) if sender_ids else {}
+
+        if skipped:
+            logging.info(f"Skipped {skipped} messages already loaded")
+        logging.info(f"Fetched {fetched} messages from {start_date} to {end_date}")
+        return messages, users, watermark
     except Exception as e:
         logging.error(f"Error getting chat history for {chat}: {e}")
-        return [], {}
-
-async def message_exists_in_bigquery(message_id, chat_id, bq_client, dataset_id, table_chat_history):
-    query = f"""
-    SELECT COUNT(*) as count
-    FROM `{dataset_id}.{table_chat_history}`
-    WHERE id = @message_id AND chat_id = @chat_id
-    """
-    
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("message_id", "INT64", message_id),
-            bigquery.ScalarQueryParameter("chat_id", "INT64", chat_id),
-        ]
-    )
-    
-    query_job = bq_client.query(query, job_config=job_config)
-    results = query_job.result()
-    
-    for row in results:
-        return row['count'] > 0
-    
-    return False
+        if raise_errors:
+            raise
+        return [], {}, None
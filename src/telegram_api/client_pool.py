@@ -0,0 +1,146 @@
+import logging
+import time
+import zlib
+import metrics
+from telegram_api.rpc_governor import RpcGovernor
+
+
+class ClientPool:
+    """
+    Telegram clients of several accounts that chats are spread across.
+
+    Every chat has a home account picked from a hash of its username, so the same
+    chat always runs on the same account (and reuses its entity cache) across runs.
+    An account in a FloodWait is taken out of rotation until the wait expires: its
+    chats run on the next free account instead. Flood waits are read from the
+    bookkeeping Telethon keeps per client (`_flood_waited_requests`, the time each
+    waited request is allowed again), so both the waits Telethon sleeps through and
+    the ones it raises are seen. On an account with an RpcGovernor, waits the
+    governor sleeps through (up to its `max_flood_sleep`) are too short to move
+    chats for and are ignored.
+    """
+
+    def __init__(self, clients, names=None):
+        """
+        Args:
+            clients (list): The Telegram clients, one per account.
+            names (list, optional): The names of the accounts in logs and metrics.
+                Defaults to 'account0', 'account1', ...
+        """
+        if not clients:
+            raise ValueError("A client pool needs at least one client")
+        self.clients = list(clients)
+        self.names = list(names) if names else [f"account{i}" for i in range(len(self.clients))]
+        for client, name in zip(self.clients, self.names):
+            metrics.count_requests(client, account=name)
+        self.chats = [0] * len(self.clients)
+        self.rotations = [0] * len(self.clients)
+        self.wait_seconds = [0.0] * len(self.clients)
+        self._waited_until = [0.0] * len(self.clients)
+        self._started = time.monotonic()
+
+    def __len__(self):
+        return len(self.clients)
+
+    async def start(self, **kwargs):
+        for name, client in zip(self.names, self.clients):
+            await client.start(**kwargs)
+            logging.info(f"Telegram client of {name} started")
+
+    async def disconnect(self):
+        for client in self.clients:
+            await client.disconnect()
+
+    def home(self, username):
+        """
+        Returns the index of the account a chat is assigned to.
+        """
+        # crc32 rather than hash() since str hashes change with every interpreter run
+        return zlib.crc32(username.lower().encode('utf-8')) % len(self.clients)
+
+    def flood_wait_until(self, index, now=None):
+        """
+        Returns the time.time() at which the account's current flood waits end, 0 if it has none.
+        """
+        now = now or time.time()
+        client = self.clients[index]
+        waits = getattr(client, '_flood_waited_requests', None) or {}
+        governor = getattr(client, 'rpc_governor', None)
+        slept_through = governor.max_flood_sleep if governor is not None else 0
+        until = max((until for until in waits.values() if until - now > slept_through), default=0.0)
+        if until > now and until > self._waited_until[index]:
+            # Only count the part of the wait not counted yet
+            self.wait_seconds[index] += until - max(now, self._waited_until[index])
+            self._waited_until[index] = until
+        return until if until > now else 0.0
+
+    def acquire(self, username):
+        """
+        Picks the account that processes a chat.
+
+        Returns:
+            tuple: (name, client) of the chat's home account, or of the next account
+            in order that is not in a flood wait. If all accounts wait, the one whose
+            wait ends first.
+        """
+        now = time.time()
+        home = self.home(username)
+        order = [(home + offset) % len(self.clients) for offset in range(len(self.clients))]
+        waits = {index: self.flood_wait_until(index, now) for index in order}
+        index = next((index for index in order if not waits[index]), None)
+        if index is None:
+            index = min(order, key=waits.get)
+        if index != home:
+            self.rotations[home] += 1
+            logging.info(f"{self.names[home]} is in a flood wait for {waits[home] - now:.0f}s, processing {username} with {self.names[index]}")
+        self.chats[index] += 1
+        return self.names[index], self.clients[index]
+
+    def reacquire(self, username, account):
+        """
+        Picks another account for a chat that failed on `account`.
+
+        A flood wait too long to sleep through fails the chat on the account it
+        started on; the chat can then run again on an account that is free.
+
+        Returns:
+            tuple: (name, client) of the next account in order that is not in a flood
+            wait, or None if `account` is not in a flood wait or no other account is free.
+        """
+        now = time.time()
+        index = self.names.index(account)
+        if not self.flood_wait_until(index, now):
+            return None
+        order = [(index + offset) % len(self.clients) for offset in range(1, len(self.clients))]
+        free = next((other for other in order if not self.flood_wait_until(other, now)), None)
+        if free is None:
+            return None
+        self.rotations[index] += 1
+        self.chats[free] += 1
+        logging.info(f"{account} went into a flood wait while processing {username}, retrying it with {self.names[free]}")
+        return self.names[free], self.clients[free]
+
+    def install_governors(self, **kwargs):
+        """
+        Paces the requests of every account with its own RpcGovernor (kwargs are passed to it).
+        """
+        for client in self.clients:
+            RpcGovernor(**kwargs).install(client)
+
+    def log_summary(self):
+        """
+        Logs the chats, RPC calls, effective RPC rate and flood waits of every account.
+        """
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        logging.info("Per-account summary:")
+        for index, name in enumerate(self.names):
+            self.flood_wait_until(index)
+            rpc_calls = metrics.value('rpc_calls', account=name)
+            logging.info(
+                f"  {name}: {self.chats[index]} chats, {rpc_calls} RPC calls ({rpc_calls / elapsed:.2f}/s), "
+                f"{metrics.value('floodwait_seconds', account=name)}s in flood waits, "
+                f"{self.wait_seconds[index]:.0f}s out of rotation, {self.rotations[index]} chats moved away"
+            )
+            governor = getattr(self.clients[index], 'rpc_governor', None)
+            if governor is not None:
+                governor.log_summary(name)
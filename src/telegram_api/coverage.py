@@ -0,0 +1,88 @@
+from datetime import datetime, time, timedelta, timezone
+
+ONE_DAY = timedelta(days=1)
+
+
+def merge_intervals(intervals):
+    """
+    Compacts date intervals into sorted, non-overlapping, non-adjacent intervals.
+
+    Args:
+        intervals (iterable): (start_date, end_date) tuples, both ends inclusive.
+
+    Returns:
+        list: The compacted (start_date, end_date) tuples, oldest first.
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + ONE_DAY:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def add_dates(intervals, dates):
+    """
+    Returns the compacted coverage of `intervals` extended with single dates.
+    """
+    return merge_intervals(list(intervals) + [(d, d) for d in dates])
+
+
+def find_gaps(intervals, start_date, end_date):
+    """
+    Calculates the date ranges within [start_date, end_date] that are not covered.
+
+    Args:
+        intervals (iterable): The covered (start_date, end_date) tuples.
+        start_date (date): The first date of the requested range.
+        end_date (date): The last date of the requested range.
+
+    Returns:
+        list: The missing (start_date, end_date) tuples, oldest first.
+    """
+    gaps = []
+    cursor = start_date
+    for start, end in merge_intervals(intervals):
+        if end < cursor:
+            continue
+        if start > end_date:
+            break
+        if start > cursor:
+            gaps.append((cursor, start - ONE_DAY))
+        cursor = end + ONE_DAY
+        if cursor > end_date:
+            return gaps
+    if cursor <= end_date:
+        gaps.append((cursor, end_date))
+    return gaps
+
+
+def complete_dates(start, end, today=None):
+    """
+    Returns the dates fully covered by the datetime range [start, end].
+
+    Only past days count: the current day (UTC) is never complete since more
+    messages may still arrive.
+    """
+    today = today or datetime.now(timezone.utc).date()
+    first = start.date() if start.time() == time.min else start.date() + ONE_DAY
+    last = end.date() if end.time() == time.max else end.date() - ONE_DAY
+    last = min(last, today - ONE_DAY)
+    return [first + timedelta(days=i) for i in range((last - first).days + 1)]
+
+
+def gap_ranges(intervals, start, end):
+    """
+    Calculates the datetime sub-ranges of [start, end] whose days are not covered.
+
+    Returns:
+        list: (range_start, range_end) datetime tuples, clipped to [start, end], newest first.
+    """
+    ranges = []
+    for gap_start, gap_end in find_gaps(intervals, start.date(), end.date()):
+        range_start = max(start, datetime.combine(gap_start, time.min, tzinfo=start.tzinfo))
+        range_end = min(end, datetime.combine(gap_end, time.max, tzinfo=end.tzinfo))
+        ranges.append((range_start, range_end))
+    return ranges[::-1]
@@ -1,138 +1,476 @@
 import logging
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
 from telegram_api.chat_info import get_chat_info
 from telegram_api.chat_history import get_chat_history
-from bigquery_loader import upload_to_bigquery
+from telegram_api.message_index import DEDUP_STOP, DEDUP_SKIP
+from telegram_api.known_ids import KnownIdIndex
+from telegram_api.coverage import complete_dates, gap_ranges
+from telegram_api.message_transformer import MessageTransformer, MUTABLE_COLUMNS, LEGACY_MUTABLE_COLUMNS, mutable_hash, standardize_chat_id
+from telegram_api.near_duplicates import ASSIGN_BATCH_SIZE, assign_clusters
+from telegram_api.desktop_export import iter_export_chats, message_date, export_message_row, export_user_info, export_chat_info
+from sinks.base import DEFAULT_MAX_ROWS, DEFAULT_MAX_BYTES
+import metrics
+
+# No Telegram message is older than this
+TELEGRAM_EPOCH = datetime(2013, 8, 1, tzinfo=timezone.utc)
+
+# Messages requested per GetMessagesRequest when refreshing, the most Telegram returns
+REFRESH_BATCH_SIZE = 100
+
+
+def split_date_range(start_date, end_date, shard_days):
+    """
+    Splits a datetime range into consecutive shards of `shard_days` days.
+
+    Returns:
+    - A list of (shard_start, shard_end) tuples covering [start_date, end_date], newest shard first.
+    """
+    shards = []
+    shard_start = start_date
+    while shard_start <= end_date:
+        shard_end = min(shard_start + timedelta(days=shard_days) - timedelta(microseconds=1), end_date)
+        shards.append((shard_start, shard_end))
+        shard_start = shard_end + timedelta(microseconds=1)
+    return shards[::-1]
 
 
 class DataProcessor:
-    def __init__(self, client, bq_client, dataset_id, table_chat_config, table_chat_history, table_chat_info, table_user_info, is_backloading=False):
+    def __init__(self, client, sink, is_backloading=False, dedup_strategy=DEDUP_STOP, user_cache=None, flush_max_rows=DEFAULT_MAX_ROWS, flush_max_bytes=DEFAULT_MAX_BYTES, shard_concurrency=4, legacy_columns=False, near_duplicates=None, known_ids_dir=None):
         """
         Initializes the DataProcessor class.
 
         Parameters:
         - client: The Telegram client.
-        - bq_client: The BigQuery client.
-        - dataset_id: The ID of the BigQuery dataset.
-        - table_chat_config: The name of the BigQuery table for chat configuration.
-        - table_chat_history: The name of the BigQuery table for chat history.
-        - table_chat_info: The name of the BigQuery table for chat information.
-        - table_user_info: The name of the BigQuery table for user information.
+        - sink: The storage backend (see sinks.Sink) messages, users and chats are loaded into.
         - is_backloading: A boolean indicating if the data processing is for backloading.
+        - dedup_strategy: 'stop' to end a chat scan at the first already loaded message, 'skip' to skip it and keep scanning.
+        - user_cache: An optional persistent UserInfoCache shared across runs.
+        - flush_max_rows: The number of buffered messages that triggers a load job.
+        - flush_max_bytes: The encoded size of buffered messages that triggers a load job.
+        - shard_concurrency: The number of date shards of one chat fetched concurrently when sharding.
+        - legacy_columns: Also fill the legacy str() repr columns of chat_history (media, buttons, action, reactions).
+        - near_duplicates: An optional persistent NearDuplicateIndex filling the duplicate_cluster column of fetched,
+          imported and streamed messages.
+        - known_ids_dir: An optional directory the indexes of existing user and chat IDs are saved in, so that
+          each run only fetches the IDs added since the previous one (see KnownIdIndex).
         """
         self.client = client
-        self.bq_client = bq_client
-        self.dataset_id = dataset_id
-        self.table_chat_config = table_chat_config
-        self.table_chat_history = table_chat_history
-        self.table_chat_info = table_chat_info
-        self.table_user_info = table_user_info
-        self.existing_users = set()
-        self.existing_chats = set()
+        self.sink = sink
+        self.existing_users = KnownIdIndex(os.path.join(known_ids_dir, 'user_info.ids') if known_ids_dir else None)
+        self.existing_chats = KnownIdIndex(os.path.join(known_ids_dir, 'chat_info.ids') if known_ids_dir else None)
         self.new_users = {}
         self.new_chats = {}
+        # Placeholder rows of the users and chats seen in exports (see import_export). They are
+        # loaded but never become known, so Telegram runs still fetch the real profiles
+        self.export_users = {}
+        self.export_chats = {}
+        self._exported = set()
         self.is_backloading = is_backloading
+        self.dedup_strategy = dedup_strategy
+        self.user_cache = user_cache
+        self.flush_max_rows = flush_max_rows
+        self.flush_max_bytes = flush_max_bytes
+        self.shard_concurrency = shard_concurrency
+        self.legacy_columns = legacy_columns
+        self.near_duplicates = near_duplicates
+        self.mutable_columns = MUTABLE_COLUMNS + (LEGACY_MUTABLE_COLUMNS if legacy_columns else ())
+        # Guards new_users/new_chats when several chats are processed concurrently
+        self._lock = asyncio.Lock()
+        # Serializes the adds of concurrently refreshed chats to a shared merge writer
+        self._refresh_lock = asyncio.Lock()
 
     async def initialize(self):
         """
-        Initializes the data processor by fetching existing users and chats from BigQuery.
+        Initializes the data processor by fetching existing users and chats from the sink.
         """
         await self._get_existing_users()
         await self._get_existing_chats()
 
     async def _get_existing_users(self):
         """
-        Fetches existing users from BigQuery and stores them in the `existing_users` set.
+        Refreshes the `existing_users` index from the sink.
         """
         try:
-            query = f"SELECT CAST(id AS STRING) AS id FROM `{self.dataset_id}.{self.table_user_info}`"
-            query_job = self.bq_client.query(query)
-            results = query_job.result()
-            self.existing_users = {row['id'] for row in results}
-            logging.info(f"Fetched {len(self.existing_users)} existing users")
+            await self.existing_users.refresh(self.sink, 'user_info')
+            logging.info(f"Known users: {len(self.existing_users)}")
         except Exception as e:
             logging.error(f"Error fetching existing users: {e}", exc_info=True)
 
     async def _get_existing_chats(self):
         """
-        Fetches existing chats from BigQuery and stores them in the `existing_chats` set.
+        Refreshes the `existing_chats` index from the sink.
         """
         try:
-            query = f"SELECT CAST(id AS STRING) AS id FROM `{self.dataset_id}.{self.table_chat_info}`"
-            query_job = self.bq_client.query(query)
-            results = query_job.result()
-            self.existing_chats = {row['id'] for row in results}
-            logging.info(f"Fetched {len(self.existing_chats)} existing chats")
+            await self.existing_chats.refresh(self.sink, 'chat_info')
+            logging.info(f"Known chats: {len(self.existing_chats)}")
         except Exception as e:
             logging.error(f"Error fetching existing chats: {e}", exc_info=True)
 
-    async def process_chat(self, username, start_date, end_date, chat_config):
+    async def process_chat(self, username, start_date, end_date, chat_config, shard_days=None, min_id=0, skip_covered=False, client=None):
         """
-        Processes a chat by fetching its history, uploading messages to BigQuery, and updating chat info if needed.
+        Processes a chat by fetching its history, loading messages into the sink, and updating chat info if needed.
 
         Parameters:
         - username: The username of the chat.
         - start_date: The start date for fetching chat history.
         - end_date: The end date for fetching chat history.
         - chat_config: The configuration for the chat.
+        - shard_days: If set, the range is split into shards of this many days that are fetched
+          concurrently (see `_process_shards`).
+        - min_id: The chat's message-ID watermark; only newer messages are fetched.
+        - skip_covered: Only fetch the sub-ranges whose days are not in the chat config's `coverage`.
+        - client: The Telegram client to fetch the chat with (e.g. from a ClientPool), defaults to the processor's client.
 
-        Note: This function is asynchronous and should be awaited.
+        The fully loaded past days of every successfully processed range or shard are added to
+        the chat's coverage: only the days the scan reached, since the 'stop' dedup strategy
+        ends it at the first loaded message. Unsharded runs also advance the chat's watermark to the newest
+        loaded message on success.
+
+        Returns:
+        - True if the chat was processed successfully, False otherwise.
+
+        Note: This function is asynchronous and should be awaited. It is safe to run
+        several calls concurrently on the same DataProcessor.
         """
+        client = client or self.client
         try:
-            chat = await self.client.get_entity(username)
+            chat = await client.get_entity(username)
             chat_id = str(chat.id)
 
             logging.info(f"Processing chat for {username} from {start_date} to {end_date}")
 
-            messages, users = await get_chat_history(
-                self.client, chat, start_date, end_date, 
-                self.bq_client, self.dataset_id, self.table_chat_history
-            )
-
-            for user_id, user_info in users.items():
-                user_id_str = str(user_id)
-                if user_id_str not in self.existing_users and user_id_str not in self.new_users:
-                    self.new_users[user_id_str] = user_info
+            if skip_covered:
+                ranges = gap_ranges(chat_config.get('coverage') or [], start_date, end_date)
+                if not ranges:
+                    logging.info(f"{username} is already loaded from {start_date} to {end_date}")
+                else:
+                    logging.info(f"Fetching {len(ranges)} missing ranges of {username}: {', '.join(f'{range_start.date()} - {range_end.date()}' for range_start, range_end in ranges)}")
+            else:
+                ranges = [(start_date, end_date)]
 
-            if messages:
-                logging.info(f"Uploading {len(messages)} messages to BigQuery for {username}")
-                await upload_to_bigquery(
-                    self.bq_client, messages, 'chat_history', self.dataset_id, 
-                    self.table_chat_config, self.table_chat_history, 
-                    self.table_chat_info, self.table_user_info
-                )
+            if shard_days:
+                shards = [shard for range_start, range_end in ranges for shard in split_date_range(range_start, range_end, shard_days)]
+                success = await self._process_shards(client, username, chat, shards, chat_config)
             else:
-                logging.warning(f"No messages found for {username} in the specified date range")
+                success = True
+                for range_start, range_end in ranges:
+                    range_success, watermark, scanned_from = await self._process_range(client, username, chat, range_start, range_end, min_id=min_id)
+                    if not range_success:
+                        success = False
+                        continue
+                    await self.sink.update_processed_dates(chat_config['id'], complete_dates(scanned_from, range_end))
+                    if watermark:
+                        await self.sink.update_watermark(chat_config['id'], *watermark)
+                        logging.info(f"Advanced watermark of {username} to message {watermark[0]} at {watermark[1]}")
 
             # Update chat info if needed
-            if chat_id not in self.existing_chats and chat_id not in self.new_chats:
-                chat_info = await get_chat_info(self.client, chat)
-                if chat_info:
-                    self.new_chats[chat_id] = chat_info
+            async with self._lock:
+                if chat_id not in self.existing_chats and chat_id not in self.new_chats:
+                    chat_info = await get_chat_info(client, chat)
+                    if chat_info:
+                        self.new_chats[chat_id] = chat_info
 
             logging.info(f"Finished processing chat for {username}")
+            return success
 
         except Exception as e:
             logging.error(f"Error processing chat {username}: {e}", exc_info=True)
+            return False
+
+    async def catch_up(self, client, username, chat, chat_config, start_date, end_date, min_id=0):
+        """
+        Loads the messages a chat received since its watermark and advances the watermark.
+
+        Used by the stream mode to fill the gaps left while no updates were received.
+        Loaded messages are skipped rather than ending the fetch: messages streamed
+        above the watermark may sit above a gap that still has to be fetched.
+
+        Parameters:
+        - client: The Telegram client to fetch the chat with.
+        - username: The username of the chat.
+        - chat: The chat entity.
+        - chat_config: The configuration for the chat.
+        - start_date: The oldest date to fetch back to.
+        - end_date: The newest date to fetch.
+        - min_id: The chat's message-ID watermark; only newer messages are fetched.
+
+        Returns:
+        - The (success, watermark) of the range as returned by `_process_range`.
+        """
+        success, watermark, _ = await self._process_range(client, username, chat, start_date, end_date, min_id=min_id, skip_loaded=True)
+        if success and watermark:
+            await self.sink.update_watermark(chat_config['id'], *watermark)
+        return success, watermark
+
+    async def refresh_chat(self, username, start_date, end_date, writer, client=None):
+        """
+        Re-reads the loaded messages of a chat within a date range and writes the ones that changed.
+
+        Views, forwards, replies, reactions and edits are frozen at the moment a message
+        is first loaded. The IDs loaded within the range are re-fetched by ID in batches
+        of REFRESH_BATCH_SIZE, and only the messages whose mutable columns hash differently
+        from their stored newest version are added to the writer, so the cost of the write
+        is proportional to the number of changes rather than to the size of the range.
+
+        Parameters:
+        - username: The username of the chat.
+        - start_date: The start of the range to refresh.
+        - end_date: The end of the range to refresh.
+        - writer: The writer the changed rows are added to, typically shared by all chats
+          (see Sink.merge_writer).
+        - client: The Telegram client to fetch the chat with, defaults to the processor's client.
+
+        Returns:
+        - The number of changed messages, or None if the refresh failed.
+        """
+        client = client or self.client
+        try:
+            chat = await client.get_entity(username)
+            chat_id = standardize_chat_id(chat.id)
+            stored = await self.sink.load_mutable_fields(chat_id, start_date, end_date, self.mutable_columns)
+            hashes = {row['id']: mutable_hash(row, self.mutable_columns) for row in stored}
+            del stored
+            ids = sorted(hashes, reverse=True)
+
+            transformer = MessageTransformer(client, legacy_columns=self.legacy_columns)
+            changed = []
+            deleted = 0
+            with metrics.timed('stage_duration_seconds', stage='refresh', chat=username):
+                for i in range(0, len(ids), REFRESH_BATCH_SIZE):
+                    messages = await client.get_messages(chat, ids=ids[i:i + REFRESH_BATCH_SIZE])
+                    for message in messages:
+                        # Deleted messages come back empty
+                        if message is None or getattr(message, 'date', None) is None:
+                            deleted += 1
+                            continue
+                        row = transformer.transform(message)
+                        if mutable_hash(row, self.mutable_columns) != hashes[message.id]:
+                            changed.append(row)
+
+            async with self._refresh_lock:
+                for row in changed:
+                    await writer.add(row)
+        except Exception as e:
+            logging.error(f"Error refreshing chat {username}: {e}", exc_info=True)
+            return None
+
+        metrics.inc('messages_refreshed', len(ids), chat=username)
+        metrics.inc('messages_changed', len(changed), chat=username)
+        logging.info(f"Refreshed {len(ids)} messages of {username} from {start_date} to {end_date}: {len(changed)} changed, {deleted} deleted")
+        return len(changed)
+
+    async def _process_range(self, client, username, chat, start_date, end_date, min_id=0, overwrite=False, skip_loaded=False):
+        """
+        Fetches the history of a chat for one date range and streams it to the sink.
+
+        With `overwrite` the fetched messages replace the chat's messages of the range
+        in the sink (see Sink.overwrite_writer) and no dedup lookup is made. With
+        `skip_loaded` loaded messages are skipped whatever the dedup strategy.
+
+        Returns:
+        - A (success, watermark, scanned_from) tuple: success is True if the history was fetched
+          and every chunk was loaded, watermark the (id, date) of the newest fetched message or
+          None, and scanned_from the date down to which the range was fully fetched (see
+          get_chat_history), or None on failure.
+        """
+        try:
+            # Messages are streamed to the sink in chunks while the history is fetched
+            with metrics.timed('stage_duration_seconds', stage='chat_history', chat=username):
+                if overwrite:
+                    writer = self.sink.overwrite_writer(standardize_chat_id(chat.id), start_date, end_date, self.flush_max_rows, self.flush_max_bytes)
+                else:
+                    writer = self.sink.writer('chat_history', self.flush_max_rows, self.flush_max_bytes)
+                async with writer:
+                    _, users, watermark = await get_chat_history(
+                        client, chat, start_date, end_date, self.sink,
+                        dedup_strategy=None if overwrite else DEDUP_SKIP if skip_loaded else self.dedup_strategy, user_cache=self.user_cache,
+                        writer=writer, raise_errors=True, min_id=min_id,
+                        legacy_columns=self.legacy_columns, near_duplicates=self.near_duplicates,
+                        existing_users=self.existing_users
+                    )
+        except Exception:
+            return False, None, None
+        metrics.record_writer(writer, 'chat_history')
+
+        async with self._lock:
+            for user_id, user_info in users.items():
+                user_id_str = str(user_id)
+                if user_id_str not in self.existing_users and user_id_str not in self.new_users:
+                    self.new_users[user_id_str] = user_info
+
+        if writer.rows_added:
+            logging.info(f"Loaded {writer.rows_loaded} of {writer.rows_added} messages into {self.sink.name} for {username} from {start_date} to {end_date}")
+        else:
+            logging.warning(f"No messages found for {username} from {start_date} to {end_date}")
+
+        return writer.rows_failed == 0, watermark, writer.scanned_from
+
+    async def _process_shards(self, client, username, chat, shards, chat_config):
+        """
+        Fetches a chat's history as concurrent date shards.
+
+        Every shard replaces the chat's messages of its date range in the sink, so a
+        rerun of a shard is an idempotent overwrite rather than a dedup against what is
+        already loaded. Each shard's fully loaded days are added to the chat's coverage as soon as the
+        shard is loaded, so a rerun of a killed job only fetches the unfinished shards.
+
+        Returns:
+        - True if every shard was processed successfully, False otherwise.
+        """
+        logging.info(f"Fetching {username} in {len(shards)} shards")
+
+        semaphore = asyncio.Semaphore(self.shard_concurrency)
+
+        async def process_shard(shard_start, shard_end):
+            async with semaphore:
+                success, _, scanned_from = await self._process_range(client, username, chat, shard_start, shard_end, overwrite=True)
+                if not success:
+                    logging.error(f"Shard {shard_start.date()} - {shard_end.date()} of {username} failed")
+                    return False
+                await self.sink.update_processed_dates(chat_config['id'], complete_dates(scanned_from, shard_end))
+                return True
+
+        results = await asyncio.gather(*(process_shard(*shard) for shard in shards), return_exceptions=True)
+        failed = [result for result in results if result is not True]
+        if failed:
+            logging.error(f"{len(failed)} of {len(shards)} shards of {username} failed")
+        return not failed
+
+    async def import_export(self, path, chat_config=None):
+        """
+        Loads the messages of a Telegram Desktop JSON export into the sink.
+
+        The export is stream-parsed and loaded chat by chat without any Telegram
+        call, which makes it the cheapest way to backfill years of history. Messages
+        already in the sink are skipped, so re-importing an export is harmless.
+        Senders and chats that are not known yet are loaded as placeholder rows with the
+        little the export describes (user names only hold the display name). Placeholders
+        do not count as known users and chats, so the profiles are still fetched the first
+        time a Telegram-backed run sees them.
+
+        Parameters:
+        - path: Path of the export's result.json.
+        - chat_config: The configuration of the chat, for single-chat exports of a configured
+          chat. The fully covered days between the first and last exported message are then
+          added to its coverage and its watermark is advanced to the newest message.
+
+        Returns:
+        - True if every message was loaded successfully, False otherwise.
+        """
+        success = True
+        chats = 0
+        first_date = None
+        for chat, messages in iter_export_chats(path):
+            if 'id' not in chat:
+                logging.warning(f"Skipping exported chat {chat.get('name')} without an ID")
+                continue
+            chats += 1
+            chat_id = str(chat['id'])
+            name = chat.get('name') or chat_id
+            if chat_id not in self.existing_chats and chat_id not in self.new_chats and ('chat_info', chat_id) not in self._exported:
+                self.export_chats[chat_id] = export_chat_info(chat)
+
+            try:
+                index = await self.sink.load_message_index(chat_id, TELEGRAM_EPOCH, datetime.now(timezone.utc))
+            except Exception as e:
+                # Without the loaded IDs every message would be loaded again
+                logging.error(f"Skipping exported chat {name}: could not fetch its loaded messages: {e}")
+                success = False
+                continue
+            first_date = last_date = watermark = None
+            skipped = 0
+            pending = []
+            with metrics.timed('stage_duration_seconds', stage='import', chat=name):
+                async with self.sink.writer('chat_history', self.flush_max_rows, self.flush_max_bytes) as writer:
+                    for message in messages:
+                        if message.get('type') not in ('message', 'service'):
+                            continue
+                        metrics.inc('messages_fetched', source='export')
+                        date = message_date(message)
+                        first_date = min(first_date or date, date)
+                        last_date = max(last_date or date, date)
+                        if watermark is None or message['id'] > watermark[0]:
+                            watermark = (message['id'], date)
+                        if message['id'] in index:
+                            skipped += 1
+                            continue
+                        row = export_message_row(message, chat_id)
+                        if self.near_duplicates is not None:
+                            pending.append(row)
+                            if len(pending) >= ASSIGN_BATCH_SIZE:
+                                await self._add_clustered(writer, pending)
+                                pending = []
+                        else:
+                            await writer.add(row)
+                        user_info = export_user_info(message)
+                        if user_info and user_info['id'] not in self.existing_users and user_info['id'] not in self.new_users \
+                                and ('user_info', user_info['id']) not in self._exported:
+                            self.export_users[user_info['id']] = user_info
+                    if pending:
+                        await self._add_clustered(writer, pending)
+            metrics.record_writer(writer, 'chat_history')
+            logging.info(f"Imported {writer.rows_loaded} of {writer.rows_added} messages of {name} into {self.sink.name}, skipped {skipped} already loaded")
+            success = success and writer.rows_failed == 0
+
+        if chat_config is None or not first_date:
+            return success
+        if chats != 1:
+            logging.warning(f"Not recording coverage of {chat_config['username']}: the export holds {chats} chats")
+        elif success:
+            # Only the days strictly between the first and last exported message are known to be complete
+            await self.sink.update_processed_dates(chat_config['id'], complete_dates(first_date, last_date))
+            await self.sink.update_watermark(chat_config['id'], *watermark)
+            logging.info(f"Advanced watermark of {chat_config['username']} to message {watermark[0]} at {watermark[1]}")
+        return success
+
+    async def _add_clustered(self, writer, rows):
+        await assign_clusters(self.near_duplicates, rows)
+        for row in rows:
+            await writer.add(row)
 
     async def upload_new_data(self):
         """
-        Uploads new chats and users to BigQuery.
+        Uploads new chats and users to the sink.
+
+        Uploaded chats and users become existing ones, so the method can be called
+        repeatedly (e.g. by the stream mode) without loading them twice. Export
+        placeholders are uploaded once, but do not become existing ones, and are
+        skipped if the real profile was fetched meanwhile.
 
         Note: This function is asynchronous and should be awaited.
         """
         try:
             if self.new_chats:
-                logging.info(f"Uploading {len(self.new_chats)} new chats to BigQuery")
-                await upload_to_bigquery(
-                    self.bq_client, list(self.new_chats.values()), 'chat_info', self.dataset_id,
-                    self.table_chat_config, self.table_chat_history, self.table_chat_info, self.table_user_info
-                )
+                logging.info(f"Uploading {len(self.new_chats)} new chats to {self.sink.name}")
+                success = await self.sink.upload_rows('chat_info', list(self.new_chats.values()))
+                metrics.inc('rows_loaded' if success else 'rows_failed', len(self.new_chats), table='chat_info')
+                if success:
+                    self.existing_chats.update(self.new_chats)
+                    self.new_chats = {}
 
             if self.new_users:
-                logging.info(f"Uploading {len(self.new_users)} new users to BigQuery")
-                await upload_to_bigquery(
-                    self.bq_client, list(self.new_users.values()), 'user_info', self.dataset_id,
-                    self.table_chat_config, self.table_chat_history, self.table_chat_info, self.table_user_info
-                )
+                logging.info(f"Uploading {len(self.new_users)} new users to {self.sink.name}")
+                success = await self.sink.upload_rows('user_info', list(self.new_users.values()))
+                metrics.inc('rows_loaded' if success else 'rows_failed', len(self.new_users), table='user_info')
+                if success:
+                    self.existing_users.update(self.new_users)
+                    self.new_users = {}
+
+            for table_type, placeholders, existing, new in (
+                ('chat_info', self.export_chats, self.existing_chats, self.new_chats),
+                ('user_info', self.export_users, self.existing_users, self.new_users),
+            ):
+                for entity_id in [entity_id for entity_id in placeholders if entity_id in existing or entity_id in new]:
+                    del placeholders[entity_id]
+                if not placeholders:
+                    continue
+                logging.info(f"Uploading {len(placeholders)} {table_type} placeholders of exports to {self.sink.name}")
+                success = await self.sink.upload_rows(table_type, list(placeholders.values()))
+                metrics.inc('rows_loaded' if success else 'rows_failed', len(placeholders), table=table_type)
+                if success:
+                    self._exported.update((table_type, entity_id) for entity_id in placeholders)
+                    placeholders.clear()
         except Exception as e:
-            logging.error(f"Error uploading new data: {e}", exc_info=True)
\ No newline at end of file
+            logging.error(f"Error uploading new data: {e}", exc_info=True)
@@ -0,0 +1,278 @@
+from datetime import datetime, timezone
+from telegram_api.message_transformer import reaction_emoji
+from telegram_api.user_info import _empty_user_info
+from sinks.base import EXPORT_SOURCE
+
+# Prefixes of chat objects: a single-chat export is the chat itself, a full account
+# export lists chats under "chats" and "left_chats"
+CHAT_PREFIXES = ('', 'chats.list.item', 'left_chats.list.item')
+
+_SCALAR_EVENTS = ('string', 'number', 'boolean', 'null')
+
+# Text entity types rendered like Telethon's markdown parse mode
+_MARKDOWN_DELIMITERS = {
+    'bold': '**',
+    'italic': '__',
+    'strikethrough': '~~',
+    'code': '`',
+    'pre': '```',
+}
+
+# Export media types of files, all of which are Telegram documents
+_DOCUMENT_MEDIA = ('animation', 'video_file', 'video_message', 'voice_message', 'audio_file', 'sticker')
+
+# Export service actions whose name differs from the MessageAction constructor (see message_transformer.type_name)
+_ACTION_TYPES = {
+    'create_group': 'chat_create',
+    'create_channel': 'channel_create',
+    'edit_group_title': 'chat_edit_title',
+    'edit_group_photo': 'chat_edit_photo',
+    'delete_group_photo': 'chat_delete_photo',
+    'invite_members': 'chat_add_user',
+    'remove_members': 'chat_delete_user',
+    'join_group_by_link': 'chat_joined_by_link',
+    'join_group_by_request': 'chat_joined_by_request',
+    'migrate_to_supergroup': 'chat_migrate_to',
+    'migrate_from_group': 'channel_migrate_from',
+    'topic_created': 'topic_create',
+    'topic_edit': 'topic_edit',
+}
+
+
+def iter_export_chats(path):
+    """
+    Stream-parses a Telegram Desktop JSON export (result.json).
+
+    The file is read incrementally with ijson, so memory stays flat regardless of
+    its size. Works with single-chat exports and full account exports. Requires
+    the `ijson` package.
+
+    Args:
+        path (str): Path of the export's result.json.
+
+    Yields:
+        tuple: (chat, messages) where chat is a dict of the chat's scalar fields
+        ('id', 'name', 'type', ...) and messages an iterator over its message
+        dicts. The messages must be consumed before the next chat is requested;
+        unconsumed messages are skipped.
+    """
+    import ijson
+
+    with open(path, 'rb') as f:
+        events = ijson.parse(f, use_float=True)
+        chat = None
+        chat_prefix = None
+        for prefix, event, value in events:
+            parent, _, key = prefix.rpartition('.')
+            if event == 'start_map' and prefix in CHAT_PREFIXES:
+                chat = {}
+                chat_prefix = prefix
+            elif chat is None or parent != chat_prefix:
+                continue
+            elif event in _SCALAR_EVENTS:
+                chat[key] = value
+            elif event == 'start_array' and key == 'messages':
+                messages = _iter_messages(events, prefix)
+                yield chat, messages
+                for _ in messages:
+                    pass
+
+
+def _iter_messages(events, array_prefix):
+    """
+    Builds the message objects of a messages array from the parser events.
+    """
+    import ijson
+
+    item_prefix = f"{array_prefix}.item"
+    for prefix, event, value in events:
+        if prefix == array_prefix and event == 'end_array':
+            return
+        if prefix != item_prefix or event != 'start_map':
+            continue
+        builder = ijson.ObjectBuilder()
+        builder.event(event, value)
+        depth = 1
+        for _, event, value in events:
+            builder.event(event, value)
+            if event in ('start_map', 'start_array'):
+                depth += 1
+            elif event in ('end_map', 'end_array'):
+                depth -= 1
+                if depth == 0:
+                    break
+        yield builder.value
+
+
+def _peer_id(from_id):
+    """
+    Converts an export peer reference ('user123', 'channel123', 'chat123') to a marked peer ID.
+    """
+    if not from_id:
+        return None
+    for kind, mark in (('user', ''), ('channel', '-100'), ('chat', '-')):
+        if from_id.startswith(kind):
+            return int(f"{mark}{from_id[len(kind):]}")
+    return None
+
+
+def message_date(message, key='date'):
+    """
+    Returns the UTC datetime of a date field of an export message.
+
+    The `*_unixtime` fields are used when present, since the plain ones are in the
+    exporting machine's local time.
+    """
+    unixtime = message.get(f"{key}_unixtime")
+    if unixtime is not None:
+        return datetime.fromtimestamp(int(unixtime), tz=timezone.utc)
+    value = message.get(key)
+    if not value:
+        return None
+    return datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+
+
+def export_text(message):
+    """
+    Renders the text of an export message the way Telethon's markdown parse mode does.
+
+    Like Telethon, delimiters are not escaped and the language of `pre` blocks is
+    dropped. Exports split the text into consecutive parts of one type each, so
+    overlapping entities cannot be nested: where Telethon would render
+    `**bold __both__**`, an export renders the parts it has, one after the other.
+    """
+    entities = message.get('text_entities')
+    if entities is None:
+        text = message.get('text', '')
+        if isinstance(text, str):
+            return text
+        entities = [part if isinstance(part, dict) else {'type': 'plain', 'text': part} for part in text]
+    parts = []
+    for entity in entities:
+        text = entity.get('text', '')
+        entity_type = entity.get('type')
+        delimiter = _MARKDOWN_DELIMITERS.get(entity_type)
+        if delimiter:
+            parts.append(f"{delimiter}{text}{delimiter}")
+        elif entity_type == 'text_link':
+            parts.append(f"[{text}]({entity.get('href')})")
+        elif entity_type == 'mention_name':
+            parts.append(f"[{text}](tg://user?id={entity.get('user_id')})")
+        else:
+            parts.append(text)
+    return ''.join(parts)
+
+
+def export_media_columns(message):
+    """
+    Extracts the structured media columns (see message_transformer.media_columns) of an export message.
+
+    Exports do not contain the Telegram file IDs, so media_file_id is always None.
+    """
+    if 'photo' in message:
+        return 'photo', None, message.get('photo_file_size'), 'image/jpeg', None
+    if 'file' in message or message.get('media_type') in _DOCUMENT_MEDIA:
+        duration = message.get('duration_seconds')
+        return 'document', None, message.get('file_size'), message.get('mime_type'), float(duration) if duration is not None else None
+    if 'poll' in message:
+        return 'poll', None, None, None, None
+    if 'contact_information' in message:
+        return 'contact', None, None, None, None
+    if 'place_name' in message:
+        return 'venue', None, None, None, None
+    if 'live_location_period_seconds' in message:
+        return 'geo_live', None, None, None, None
+    if 'location_information' in message:
+        return 'geo', None, None, None, None
+    if 'game_title' in message:
+        return 'game', None, None, None, None
+    if 'invoice_information' in message:
+        return 'invoice', None, None, None, None
+    return None, None, None, None, None
+
+
+def export_reaction_counts(message):
+    return [
+        {'emoji': reaction_emoji(reaction), 'count': reaction.get('count', 0)}
+        for reaction in message.get('reactions') or []
+    ]
+
+
+def export_message_row(message, chat_id):
+    """
+    Maps an export message onto the chat_history row shape of MessageTransformer.transform.
+
+    Fields that exports do not contain (views, forwards, replies, grouped_id, the
+    via bot's ID) are set to the same defaults as for messages without them.
+
+    Args:
+        message (dict): The export message.
+        chat_id (str): The standardized ID of the chat.
+
+    Returns:
+        dict: The row.
+    """
+    date = message_date(message)
+    edit_date = message_date(message, 'edited')
+    from_id = message.get('from_id') or message.get('actor_id')
+    sender_id = _peer_id(from_id)
+    reply_to_msg_id = message.get('reply_to_message_id')
+    media_type, media_file_id, media_size, media_mime_type, media_duration = export_media_columns(message)
+    action = message.get('action')
+    return {
+        'id': message['id'],
+        'date': date.isoformat(' ', 'seconds')[:19] + ' +0000',
+        'from_user': str(sender_id) if from_id and from_id.startswith('user') else None,
+        'text': export_text(message),
+        'sender': str(sender_id) if sender_id else None,
+        'chat_id': chat_id,
+        'is_reply': bool(reply_to_msg_id),
+        'views': 0,
+        'forwards': 0,
+        'replies': 0,
+        'mentioned': False,
+        'post_author': message.get('author'),
+        'edit_date': edit_date.timestamp() if edit_date else 0.0,
+        'via_bot': 0,
+        'reply_to_msg_id': reply_to_msg_id or 0,
+        'grouped_id': 0,
+        'media_type': media_type,
+        'media_file_id': media_file_id,
+        'media_size': media_size,
+        'media_mime_type': media_mime_type,
+        'media_duration': media_duration,
+        'reaction_counts': export_reaction_counts(message),
+        'button_types': [button.get('type') for row in message.get('inline_bot_buttons') or [] for button in row],
+        'action_type': _ACTION_TYPES.get(action, action) if action else None,
+    }
+
+
+def export_user_info(message):
+    """
+    Builds the user_info row of the sender of an export message, or None if it is not a user.
+
+    Exports only contain the sender's display name, which is stored as first name. The
+    row is marked as an export placeholder, to be superseded by the profile fetched from
+    Telegram the first time the user is seen there.
+    """
+    from_id = message.get('from_id') or message.get('actor_id')
+    if not from_id or not from_id.startswith('user'):
+        return None
+    user_info = _empty_user_info(_peer_id(from_id))
+    user_info['first_name'] = message.get('from') or message.get('actor') or None
+    user_info['source'] = EXPORT_SOURCE
+    return user_info
+
+
+def export_chat_info(chat):
+    """
+    Builds the chat_info row of an export chat, marked as an export placeholder like the users.
+    """
+    return {
+        'id': str(chat['id']),
+        'name': chat.get('name') or '',
+        'username': '',
+        'description': '',
+        'members_count': 0,
+        'source': EXPORT_SOURCE,
+    }
@@ -0,0 +1,173 @@
+import json
+import logging
+import os
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta, timezone
+import metrics
+
+# Snapshots older than this are rebuilt from a full scan: BigQuery keeps the change
+# history deltas are read from for its time travel window only (7 days at most)
+MAX_DELTA_AGE = timedelta(days=6)
+
+# A delta starts this long before the snapshot it updates, so rows that were still
+# in flight then (e.g. in BigQuery's streaming buffer) are not missed; IDs fetched
+# twice are merged
+SNAPSHOT_OVERLAP = timedelta(hours=2)
+
+# IDs added during a run that are held in a set before being merged into the array
+MERGE_THRESHOLD = 65536
+
+# Format of the snapshot files; snapshots of another version are rebuilt from a full scan.
+# 2: the IDs of export placeholder rows are left out
+SNAPSHOT_VERSION = 2
+
+
+class KnownIdIndex:
+    """
+    Compact index of the IDs of a dimension table (user_info or chat_info), persisted between runs.
+
+    IDs are kept in a sorted array of signed 64-bit integers, like MessageIdIndex,
+    so a lookup is a binary search and the memory cost is 8 bytes per ID instead of
+    a Python string in a set. IDs may be checked and added as strings or integers.
+    IDs added during the run are held in a set and merged into the array in bulk.
+
+    With a `path`, the array is saved after every refresh with the time of the
+    snapshot and the table it was read from, and the next refresh only fetches the
+    IDs added to the table since (see Sink.get_existing_ids). The whole table is
+    read again when the snapshot is missing, of another table or format version,
+    or older than MAX_DELTA_AGE, or when the sink cannot tell which rows were
+    added. IDs deleted from the table stay known until then.
+    """
+
+    def __init__(self, path=None):
+        """
+        Args:
+            path (str, optional): Path of the snapshot file. Point it at a mounted volume to keep
+                the index across executions. Without it every refresh reads the whole table.
+        """
+        self.path = path
+        self._ids = array('q')
+        self._added = set()
+
+    def __len__(self):
+        return len(self._ids) + len(self._added)
+
+    def __contains__(self, entity_id):
+        try:
+            entity_id = int(entity_id)
+        except (TypeError, ValueError):
+            return False
+        if entity_id in self._added:
+            return True
+        i = bisect_left(self._ids, entity_id)
+        return i < len(self._ids) and self._ids[i] == entity_id
+
+    def add(self, entity_id):
+        """
+        Adds an ID to the index if it is not already present.
+        """
+        self.update((entity_id,))
+
+    def update(self, ids):
+        """
+        Adds IDs (e.g. the keys of a dictionary of loaded rows) to the index.
+        """
+        for entity_id in ids:
+            if entity_id not in self:
+                self._added.add(int(entity_id))
+        if len(self._added) >= MERGE_THRESHOLD:
+            self._merge()
+
+    def _merge(self, ids=None):
+        """
+        Merges the IDs added since the last merge, and the array `ids` if given, into the sorted array.
+        """
+        import numpy as np
+
+        new = np.fromiter(self._added, dtype=np.int64, count=len(self._added))
+        if ids is not None:
+            new = np.concatenate((new, np.frombuffer(ids, dtype=np.int64)))
+        new = np.unique(new)
+        known = np.frombuffer(self._ids, dtype=np.int64)
+        if len(known):
+            # Only the new IDs are sorted; they are inserted into the sorted array in one pass
+            positions = np.searchsorted(known, new)
+            missing = known[np.minimum(positions, len(known) - 1)] != new
+            new = np.insert(known, positions[missing], new[missing])
+        merged = array('q')
+        merged.frombytes(new.tobytes())
+        self._ids = merged
+        self._added = set()
+
+    async def refresh(self, sink, table_type):
+        """
+        Brings the index up to date with a dimension table of the sink and saves the snapshot.
+
+        Args:
+            sink (Sink): The sink to read the table from.
+            table_type (str): 'user_info' or 'chat_info'.
+
+        Returns:
+            int: The number of IDs fetched from the sink.
+        """
+        source = f"{sink.name}:{sink.table_id(table_type)}"
+        started = datetime.now(timezone.utc)
+        since = self._load(source, started) if self.path else None
+        ids = None
+        if since is not None:
+            try:
+                ids = await sink.get_existing_ids(table_type, since=since)
+            except Exception as e:
+                logging.warning(f"Could not fetch the {table_type} IDs added since {since}, reading the whole table: {e}")
+        if ids is None:
+            ids = await sink.get_existing_ids(table_type)
+            # The table replaces the snapshot, IDs added during the run are kept
+            self._ids = array('q')
+        else:
+            logging.info(f"Fetched {len(ids)} {table_type} IDs added since {since}")
+        self._merge(ids)
+        metrics.inc('known_ids_fetched', len(ids), table=table_type)
+        if self.path:
+            self._save(source, started - SNAPSHOT_OVERLAP)
+        return len(ids)
+
+    def _load(self, source, now):
+        """
+        Loads the saved snapshot of `source` into the index.
+
+        Returns:
+            datetime: The time the next delta starts at, or None if there is no usable snapshot.
+        """
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'rb') as f:
+                header = json.loads(f.readline())
+                data = f.read()
+            version, saved_source, count, since = header.get('version'), header['source'], header['count'], datetime.fromisoformat(header['since'])
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Ignoring unreadable known ID snapshot {self.path}: {e}")
+            return None
+        if version != SNAPSHOT_VERSION or saved_source != source or len(data) != count * 8 or now - since > MAX_DELTA_AGE:
+            logging.info(f"Known ID snapshot {self.path} of {saved_source} from {since} is not usable for {source}")
+            return None
+        self._ids = array('q')
+        self._ids.frombytes(data)
+        logging.info(f"Loaded {len(self._ids)} known IDs of {source} from {self.path}")
+        return since
+
+    def _save(self, source, since):
+        """
+        Atomically writes the sorted array, after a JSON header line, to the snapshot file.
+        """
+        if self._added:
+            self._merge()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps({'version': SNAPSHOT_VERSION, 'source': source, 'since': since.isoformat(), 'count': len(self._ids)}).encode('utf-8') + b'\n')
+            self._ids.tofile(f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,94 @@
+import logging
+from array import array
+from bisect import bisect_left, insort
+import asyncio
+
+DEDUP_STOP = 'stop'
+DEDUP_SKIP = 'skip'
+DEDUP_STRATEGIES = (DEDUP_STOP, DEDUP_SKIP)
+
+
+class MessageIdIndex:
+    """
+    Compact in-memory index of message IDs already loaded for a single chat.
+
+    IDs are kept in a sorted array of signed 64-bit integers, so a lookup is a
+    binary search and the memory cost is 8 bytes per loaded message.
+    """
+
+    def __init__(self, message_ids=()):
+        self._ids = array('q', sorted(set(message_ids)))
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, message_id):
+        i = bisect_left(self._ids, message_id)
+        return i < len(self._ids) and self._ids[i] == message_id
+
+    def add(self, message_id):
+        """
+        Adds a message ID to the index if it is not already present.
+        """
+        if message_id not in self:
+            insort(self._ids, message_id)
+
+    @property
+    def min_id(self):
+        return self._ids[0] if self._ids else None
+
+    @property
+    def max_id(self):
+        return self._ids[-1] if self._ids else None
+
+
+async def load_message_index(bq_client, dataset_id, table_chat_history, chat_id, start_date, end_date, min_id=0):
+    """
+    Fetches the IDs of messages already loaded for a chat within a date window.
+
+    Args:
+        bq_client (google.cloud.bigquery.Client): The BigQuery client.
+        dataset_id (str): The ID of the dataset containing the chat history table.
+        table_chat_history (str): The name of the chat history table.
+        chat_id (int): The standardized ID of the chat.
+        start_date (datetime): The start of the date window.
+        end_date (datetime): The end of the date window.
+        min_id (int): Only fetch the IDs above this one, e.g. a chat watermark.
+
+    Returns:
+        MessageIdIndex: The index of loaded message IDs.
+
+    Raises:
+        Exception: If the lookup fails. An empty index would make every loaded message
+            look new and load the range again, so the caller must fail the chat instead.
+    """
+    from google.cloud import bigquery
+
+    query = f"""
+    SELECT id
+    FROM `{dataset_id}.{table_chat_history}`
+    WHERE chat_id = @chat_id AND date BETWEEN @start_date AND @end_date AND id > @min_id
+    """
+
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter("chat_id", "INT64", int(chat_id)),
+            bigquery.ScalarQueryParameter("start_date", "TIMESTAMP", start_date),
+            bigquery.ScalarQueryParameter("end_date", "TIMESTAMP", end_date),
+            bigquery.ScalarQueryParameter("min_id", "INT64", int(min_id)),
+        ]
+    )
+
+    def run_query():
+        query_job = bq_client.query(query, job_config=job_config)
+        return [row['id'] for row in query_job.result()]
+
+    try:
+        message_ids = await asyncio.to_thread(run_query)
+    except Exception as e:
+        logging.error(f"Error fetching loaded message IDs for chat {chat_id}: {e}", exc_info=True)
+        raise
+
+    index = MessageIdIndex(message_ids)
+    logging.info(f"Loaded {len(index)} existing message IDs for chat {chat_id} from {start_date} to {end_date}")
+    return index
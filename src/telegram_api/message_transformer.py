@@ -0,0 +1,383 @@
+import re
+import sys
+from array import array
+from datetime import datetime, timezone
+from telethon.extensions import markdown
+from telethon.tl.tlobject import TLObject
+from telethon.tl.types import (
+    PeerUser, ReactionEmoji, ReactionCustomEmoji, MessageEntityTextUrl, MessageEntityMentionName,
+    Photo, Document, DocumentAttributeVideo, DocumentAttributeAudio,
+)
+
+_MARKDOWN_DELIMITERS = {entity_type: delimiter for delimiter, entity_type in markdown.DEFAULT_DELIMITERS.items()}
+
+_type_names = {}
+_tl_formatters = {}
+# Values pretty_format renders with repr()
+_PLAIN_TYPES = frozenset((int, bool, float, str, bytes, datetime))
+
+# Characters outside the Basic Multilingual Plane take two UTF-16 code units
+_ASTRAL = re.compile('[\U00010000-\U0010ffff]')
+
+# 'HH:MM:' for every minute of the day and 'SS +0000' for every second of a minute
+_MINUTES = [f"{minute // 60:02d}:{minute % 60:02d}:" for minute in range(24 * 60)]
+_SECONDS = [f"{second:02d} +0000" for second in range(60)]
+
+def standardize_chat_id(chat_id):
+    """
+    Standardize the chat ID by removing the -100 prefix if present.
+    """
+    chat_id_str = str(chat_id)
+    if chat_id_str.startswith('-100'):
+        return int(chat_id_str[4:])
+    return int(chat_id)
+
+def unparse_markdown(text, entities):
+    """
+    Renders message text with its entities exactly like Telethon's markdown parse mode.
+
+    `markdown.unparse` converts the whole text to UTF-16 surrogates character by
+    character in Python, which dominates the transform of messages with entities.
+    Text within the Basic Multilingual Plane needs no conversion at all, other text
+    is converted with a single encode, and the delimiters are joined in one pass.
+    """
+    if not text or not entities:
+        return text
+
+    insert_at = []
+    for i, entity in enumerate(entities):
+        start = entity.offset
+        end = entity.offset + entity.length
+        delimiter = _MARKDOWN_DELIMITERS.get(type(entity))
+        if delimiter:
+            insert_at.append((start, i, delimiter))
+            insert_at.append((end, -i, delimiter))
+        else:
+            url = None
+            if isinstance(entity, MessageEntityTextUrl):
+                url = entity.url
+            elif isinstance(entity, MessageEntityMentionName):
+                url = f"tg://user?id={entity.user_id}"
+            if url:
+                insert_at.append((start, i, '['))
+                insert_at.append((end, -i, f"]({url})"))
+    if not insert_at:
+        return text
+    # Ties of offset and index only occur for entity 0, whose start sorts first either way
+    insert_at.sort()
+
+    astral = not text.isascii() and _ASTRAL.search(text) is not None
+    if astral:
+        # Telegram entity offsets count UTF-16 code units, read in the machine's byte order
+        units = array('H')
+        units.frombytes(text.encode('utf-16-le' if sys.byteorder == 'little' else 'utf-16-be'))
+        text = ''.join(map(chr, units))
+
+    parts = []
+    last = 0
+    for at, _, what in insert_at:
+        # Never split a surrogate pair
+        while astral and 1 < at < len(text) and '\ud800' <= text[at - 1] <= '\udbff' and '\ud800' <= text[at] <= '\udfff':
+            at += 1
+        parts.append(text[last:at])
+        parts.append(what)
+        last = max(last, at)
+    parts.append(text[last:])
+    text = ''.join(parts)
+
+    if astral:
+        return text.encode('utf-16', 'surrogatepass').decode('utf-16')
+    return text
+
+def type_name(obj, prefix):
+    """
+    Returns the snake_case name of a TL object's constructor without `prefix`,
+    e.g. 'web_page' for MessageMediaWebPage with prefix 'MessageMedia'.
+    """
+    cls = obj.__class__
+    name = _type_names.get(cls)
+    if name is None:
+        name = cls.__name__
+        if name.startswith(prefix):
+            name = name[len(prefix):]
+        name = re.sub(r'(?<!^)(?=[A-Z])', '_', name).lower()
+        _type_names[cls] = name
+    return name
+
+def _tl_formatter(obj):
+    """
+    Compiles the function formatting the objects of a TL object's class like
+    pretty_format, from the fields of its to_dict in their order, or returns None
+    if the class does not keep its to_dict values in attributes of the same name.
+    """
+    cls = obj.__class__
+    if cls in _tl_formatters:
+        return _tl_formatters[cls]
+    values = obj.to_dict()
+    fields = [(name, isinstance(value, list)) for name, value in values.items() if name != '_']
+    formatter = None
+    if all(name.isidentifier() and hasattr(obj, name) for name, _ in fields):
+        # One f-string per class, with a replacement field per TL field
+        parts = ', '.join(
+            f"{name}={{{'[]' if vector else 'None'!r} if (value := obj.{name}) is None "
+            f"else repr(value) if value.__class__ in _PLAIN_TYPES else tl_repr(value)}}"
+            for name, vector in fields
+        )
+        formatter = eval(f"lambda obj: f{values.get('_', 'dict') + '(' + parts + ')'!r}", globals())
+    _tl_formatters[cls] = formatter
+    return formatter
+
+def tl_repr(obj):
+    """
+    Returns the same string as str() of a TL object, i.e. TLObject.pretty_format.
+
+    pretty_format converts the whole object tree with to_dict first and formats it
+    through nested generators. The attributes are read directly instead, by a
+    formatter compiled once per class; to_dict renders unset vectors as [].
+    """
+    formatter = _tl_formatters.get(obj.__class__)
+    if formatter is None:
+        if not isinstance(obj, TLObject):
+            if isinstance(obj, (str, bytes)):
+                return repr(obj)
+            if isinstance(obj, dict):
+                return f"{obj.get('_', 'dict')}({', '.join(f'{key}={tl_repr(value)}' for key, value in obj.items() if key != '_')})"
+            if hasattr(obj, '__iter__'):
+                return f"[{', '.join([tl_repr(value) for value in obj])}]"
+            return repr(obj)
+        formatter = _tl_formatter(obj)
+        if formatter is None:
+            return TLObject.pretty_format(obj)
+    return formatter(obj)
+
+def media_columns(media):
+    """
+    Extracts the structured media columns of a message.
+
+    Returns:
+        tuple: (media_type, media_file_id, media_size, media_mime_type, media_duration),
+        with None for the values the media does not have.
+    """
+    if not media:
+        return None, None, None, None, None
+    media_type = type_name(media, 'MessageMedia')
+    photo = getattr(media, 'photo', None)
+    if isinstance(photo, Photo):
+        sizes = [max(size.sizes) if hasattr(size, 'sizes') else getattr(size, 'size', 0) for size in photo.sizes]
+        return media_type, photo.id, max(sizes, default=None), 'image/jpeg', None
+    document = getattr(media, 'document', None)
+    if isinstance(document, Document):
+        duration = None
+        for attribute in document.attributes:
+            if isinstance(attribute, (DocumentAttributeVideo, DocumentAttributeAudio)):
+                duration = float(attribute.duration)
+                break
+        return media_type, document.id, document.size, document.mime_type, duration
+    return media_type, None, None, None, None
+
+def button_types(reply_markup):
+    """
+    Returns the types of the buttons of a reply markup, row by row ('url', 'callback', ...).
+    """
+    if reply_markup is None:
+        return []
+    return [
+        type_name(button, 'KeyboardButton') or 'text'
+        for row in getattr(reply_markup, 'rows', ())
+        for button in row.buttons
+    ]
+
+def reaction_emoji(reaction):
+    """
+    Returns the emoji a reaction is recorded under: its emoticon, "CustomEmoji:<document_id>"
+    for custom emoji, or "UnknownEmoji".
+
+    Args:
+        reaction: A Telethon reaction, or a reaction of a Telegram Desktop export (dict).
+
+    Returns:
+        str: The emoji.
+    """
+    if isinstance(reaction, ReactionEmoji):
+        return reaction.emoticon
+    if isinstance(reaction, dict):
+        if reaction.get('type') == 'custom_emoji':
+            return f"CustomEmoji:{reaction.get('document_id')}"
+        return reaction.get('emoji') or "UnknownEmoji"
+    if isinstance(reaction, ReactionCustomEmoji):
+        return f"CustomEmoji:{reaction.document_id}"
+    return "UnknownEmoji"
+
+def reaction_counts(reactions):
+    """
+    Returns the reactions of a message as a list of {'emoji', 'count'} records.
+    """
+    if not reactions:
+        return []
+    return [
+        {'emoji': result.reaction.emoticon if result.reaction.__class__ is ReactionEmoji else reaction_emoji(result.reaction), 'count': result.count}
+        for result in reactions.results
+    ]
+
+def format_reactions(reactions):
+    """
+    Formats the reactions of a message as "emoji:count" pairs separated by commas.
+    """
+    return _join_reactions(reaction_counts(reactions))
+
+def _join_reactions(counts):
+    if not counts:
+        return ""
+    return ", ".join([f"{reaction['emoji']}:{reaction['count']}" for reaction in counts])
+
+# chat_history columns in the order of the rows, with the values of a message without them
+_ROW_TEMPLATE = {
+    'id': None, 'date': None, 'from_user': None, 'text': None, 'sender': None, 'chat_id': None,
+    'is_reply': False, 'views': 0, 'forwards': 0, 'replies': 0, 'mentioned': None, 'post_author': None,
+    'edit_date': 0.0, 'via_bot': 0, 'reply_to_msg_id': 0, 'grouped_id': 0,
+    'media_type': None, 'media_file_id': None, 'media_size': None, 'media_mime_type': None, 'media_duration': None,
+    'reaction_counts': None, 'button_types': None, 'action_type': None,
+}
+_LEGACY_ROW_TEMPLATE = {**_ROW_TEMPLATE, 'buttons': 'None', 'media': None, 'reactions': None, 'action': None}
+
+# chat_history columns that can change after a message is first loaded
+MUTABLE_COLUMNS = ('text', 'views', 'forwards', 'replies', 'edit_date', 'reaction_counts')
+LEGACY_MUTABLE_COLUMNS = ('reactions',)
+
+_MUTABLE_NORMALIZERS = {
+    'text': lambda value: value or '',
+    'views': lambda value: int(value or 0),
+    'forwards': lambda value: int(value or 0),
+    'replies': lambda value: int(value or 0),
+    'edit_date': lambda value: float(value or 0.0),
+    'reaction_counts': lambda value: tuple((reaction['emoji'], int(reaction['count'] or 0)) for reaction in value or ()),
+    'reactions': lambda value: value or '',
+}
+
+def mutable_hash(row, columns=MUTABLE_COLUMNS):
+    """
+    Hashes the mutable columns of a chat_history row.
+
+    Values are normalized first, so a row fresh from MessageTransformer and the same
+    row read back from a sink (NULLs for zeros, records as dicts) hash the same.
+    """
+    return hash(tuple(_MUTABLE_NORMALIZERS[column](row.get(column)) for column in columns))
+
+class MessageTransformer:
+    """
+    Turns the Telethon messages of one chat into chat_history rows.
+
+    Reads the raw TL fields instead of the convenience properties of the custom
+    Message class, computes the chat ID once per chat and formats timestamps without
+    strftime. Media, buttons, actions and reactions are stored as structured columns;
+    the str() reprs of the legacy `media`, `buttons`, `action` and `reactions` columns
+    are only built when `legacy_columns` is set, the media and action ones with
+    tl_repr. Rows are plain dicts, the form every sink writer consumes, copied from a
+    template holding the default of each column.
+    """
+
+    def __init__(self, client, legacy_columns=False):
+        """
+        Args:
+            client: The Telegram client the messages were fetched with; its parse mode
+                decides how message text with entities is rendered.
+            legacy_columns (bool): Also fill the legacy repr columns.
+        """
+        self.chat_id = None
+        self.legacy_columns = legacy_columns
+        self._parse_mode = client.parse_mode
+        self._days = {}
+        self._row = _LEGACY_ROW_TEMPLATE if legacy_columns else _ROW_TEMPLATE
+
+    def format_date(self, date):
+        """
+        Formats a message date as 'YYYY-MM-DD HH:MM:SS +0000'.
+
+        Telethon dates are UTC: the date part is formatted once per day and the
+        time of day is looked up from precomputed strings.
+        """
+        if date.tzinfo is not timezone.utc:
+            return date.strftime('%Y-%m-%d %H:%M:%S %z')
+        day = date.toordinal()
+        day_str = self._days.get(day)
+        if day_str is None:
+            day_str = self._days[day] = date.strftime('%Y-%m-%d ')
+        return day_str + _MINUTES[date.hour * 60 + date.minute] + _SECONDS[date.second]
+
+    def transform(self, message):
+        """
+        Builds the chat_history row of a message.
+
+        Returns:
+            dict: The row, with the columns of the chat_history table.
+        """
+        if self.chat_id is None:
+            self.chat_id = str(standardize_chat_id(message.chat_id))
+
+        from_id = message.from_id
+        reply_to = message.reply_to
+        reply_to_msg_id = getattr(reply_to, 'reply_to_msg_id', None) if reply_to is not None else None
+        replies = message.replies
+        edit_date = message.edit_date
+        media = message.media
+        action = message.action
+        if self._parse_mode is markdown:
+            text = unparse_markdown(message.message, message.entities)
+        else:
+            text = message.text
+        reactions = reaction_counts(message.reactions)
+        reply_markup = message.reply_markup
+        if from_id.__class__ is PeerUser:
+            # Telethon's sender_id of a message from a user is the user's ID
+            from_user = str(from_id.user_id)
+            sender = from_user if from_id.user_id else None
+        else:
+            sender_id = message.sender_id
+            from_user = None
+            sender = str(sender_id) if sender_id else None
+
+        # Copying the template of the row is much cheaper than building a dict of
+        # all the columns; only the columns that differ from their default are set
+        row = self._row.copy()
+        row['id'] = message.id
+        row['date'] = self.format_date(message.date)
+        row['text'] = text
+        row['chat_id'] = self.chat_id
+        row['mentioned'] = message.mentioned
+        row['reaction_counts'] = reactions
+        row['button_types'] = button_types(reply_markup) if reply_markup else []
+        if from_user is not None:
+            row['from_user'] = from_user
+        if sender is not None:
+            row['sender'] = sender
+        if reply_to_msg_id:
+            row['is_reply'] = True
+            row['reply_to_msg_id'] = reply_to_msg_id
+        if message.views:
+            row['views'] = message.views
+        if message.forwards:
+            row['forwards'] = message.forwards
+        if replies:
+            row['replies'] = replies.replies
+        if message.post_author is not None:
+            row['post_author'] = message.post_author
+        if edit_date:
+            row['edit_date'] = edit_date.timestamp()
+        if message.via_bot_id:
+            row['via_bot'] = message.via_bot_id
+        if message.grouped_id:
+            row['grouped_id'] = message.grouped_id
+        if media:
+            row['media_type'], row['media_file_id'], row['media_size'], row['media_mime_type'], row['media_duration'] = media_columns(media)
+        if action:
+            row['action_type'] = type_name(action, 'MessageAction')
+        if self.legacy_columns:
+            if reply_markup:
+                # Message.buttons is only ever set when the message has a reply markup
+                row['buttons'] = str(message.buttons)
+            if media:
+                row['media'] = tl_repr(media)
+            row['reactions'] = _join_reactions(reactions)
+            if action:
+                row['action'] = tl_repr(action)
+        return row
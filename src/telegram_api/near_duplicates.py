@@ -0,0 +1,284 @@
+import asyncio
+import logging
+import os
+import random
+import re
+import sqlite3
+import threading
+import metrics
+from telegram_api.message_transformer import standardize_chat_id
+
+# Messages shorter than this (after normalization) are too generic to cluster,
+# e.g. "thanks" or "+1"
+MIN_TEXT_LENGTH = 30
+
+# Bytes per shingle; shingles start at word boundaries, so one spans about two words
+SHINGLE_SIZE = 12
+
+# Texts with fewer words (e.g. without spaces, like Chinese) are shingled at every byte
+MIN_WORDS = 8
+
+# 64 MinHash permutations in 16 bands of 4 rows: messages are near-duplicates when
+# any band matches, which is likely from a Jaccard similarity of about 0.5 on
+# (1 - (1 - 0.5 ** 4) ** 16 = 0.64, 0.6 -> 0.89, 0.7 -> 0.99) and rare below 0.2 (0.03)
+NUM_PERM = 64
+BANDS = 16
+
+# Messages assigned at once while ingesting, about a page of history
+ASSIGN_BATCH_SIZE = 100
+
+# SQLite page cache; the index takes about 300 bytes per clustered message
+DEFAULT_CACHE_MB = 256
+
+# Assignments after which the index is committed to disk
+COMMIT_EVERY = 50000
+
+_SEED = 20240101
+_NON_WORD = re.compile(r'\W+')
+
+
+def normalize_text(text):
+    """
+    Lowercases a message text and collapses everything but letters and digits into single spaces.
+    """
+    return _NON_WORD.sub(' ', text.lower()).strip()
+
+
+class NearDuplicateIndex:
+    """
+    Persistent MinHash/LSH index assigning near-identical message texts to clusters.
+
+    Every text is reduced to a MinHash signature of its shingles, the
+    SHINGLE_SIZE bytes starting at each word, computed with numpy. The signature
+    is cut into bands and every band is hashed into a key; the SQLite table of
+    band keys maps each key to the cluster of the first message that produced it.
+    A message joins the oldest cluster any of its band keys points to, or founds a
+    new cluster, so an assignment costs BANDS B-tree lookups, logarithmic in the
+    size of the index, and no signature is ever compared against the others. Only
+    the first message of every cluster is indexed: copies are matched against the
+    text that founded their cluster, and floods of copies do not grow the index.
+    Assigning messages again (a range backloaded or overwritten again) returns
+    their earlier clusters and founds none: every band key of a founder points to
+    its own cluster, and a copy's oldest match is still the cluster it joined.
+    Messages are assigned in batches (see `assign_many`): their signatures are
+    computed together and their keys looked up together.
+
+    A cluster is identified by its first message as '<chat_id>:<message_id>', which
+    stays globally unique if the index file is lost. "First" is the order messages
+    are ingested in, not their dates. Texts shorter than MIN_TEXT_LENGTH are not
+    clustered. Assignments are committed every COMMIT_EVERY messages and on close,
+    so a crash only forgets the assignments since the last commit (copies of
+    those messages then found new clusters).
+    """
+
+    def __init__(self, path, num_perm=NUM_PERM, bands=BANDS, cache_mb=DEFAULT_CACHE_MB):
+        """
+        Opens (and creates if needed) the index database.
+
+        Args:
+            path (str): Path of the SQLite file. Point it at a mounted volume to keep clustering across executions.
+            num_perm (int): The number of MinHash permutations of a new index.
+            bands (int): The number of LSH bands of a new index; must divide `num_perm`.
+            cache_mb (int): The SQLite page cache in MiB.
+        """
+        import numpy as np
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        # Batches are assigned from worker threads, one at a time
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # The band keys are random, so lookups and inserts hit pages all over the index
+        self._conn.execute(f"PRAGMA cache_size=-{cache_mb * 1024}")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS bands (key INTEGER PRIMARY KEY, cluster INTEGER NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS clusters (id INTEGER PRIMARY KEY, cluster_id TEXT NOT NULL)")
+        # An existing index keeps the parameters it was built with, or no band would match again
+        meta = dict(self._conn.execute("SELECT name, value FROM meta"))
+        if meta and (meta['num_perm'], meta['bands']) != (num_perm, bands):
+            logging.warning(f"Near-duplicate index {path} was built with {meta['num_perm']} permutations in {meta['bands']} bands, keeping them")
+        num_perm = meta.get('num_perm', num_perm)
+        bands = meta.get('bands', bands)
+        if num_perm % bands:
+            raise ValueError(f"{bands} bands do not divide {num_perm} permutations")
+        self._conn.executemany("INSERT OR IGNORE INTO meta (name, value) VALUES (?, ?)", [('num_perm', num_perm), ('bands', bands)])
+        self._conn.commit()
+
+        self.num_perm = num_perm
+        self.bands = bands
+        # Python's Mersenne Twister is reproducible across versions, so the hash
+        # functions of an index are the same in every run
+        rng = random.Random(_SEED)
+        self._shingle_weights = np.array([rng.getrandbits(64) | 1 for _ in range(SHINGLE_SIZE)], dtype=np.uint64)
+        self._a = np.array([rng.getrandbits(64) | 1 for _ in range(num_perm)], dtype=np.uint64)
+        self._b = np.array([rng.getrandbits(64) for _ in range(num_perm)], dtype=np.uint64)
+        self._band_weights = np.array([rng.getrandbits(64) | 1 for _ in range(num_perm // bands)], dtype=np.uint64)
+        self._band_salts = np.array([rng.getrandbits(64) for _ in range(bands)], dtype=np.uint64)
+        self._next_cluster = self._conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM clusters").fetchone()[0]
+        self._pending = 0
+        self.assigned = 0
+        self.duplicates = 0
+
+    def signatures(self, texts):
+        """
+        Computes the MinHash signatures of normalized texts at once.
+
+        All texts are shingled and hashed together, so the numpy overhead is paid
+        once per batch rather than once per message.
+
+        Returns:
+            numpy.ndarray: One row of `num_perm` values per text.
+        """
+        import numpy as np
+
+        # Every text is followed by padding, so its last words get full shingles too
+        encoded = [text.encode('utf-8') for text in texts]
+        data = np.frombuffer(bytes(SHINGLE_SIZE - 1).join(encoded) + bytes(SHINGLE_SIZE - 1), dtype=np.uint8)
+        lengths = np.array([len(text) for text in encoded])
+        offsets = np.concatenate(([0], np.cumsum(lengths + SHINGLE_SIZE - 1)[:-1]))
+        windows = np.lib.stride_tricks.sliding_window_view(data, SHINGLE_SIZE)
+
+        segment = np.repeat(np.arange(len(texts)), lengths + SHINGLE_SIZE - 1)[:len(windows)]
+        in_text = np.arange(len(windows)) - offsets[segment] < lengths[segment]
+        word_start = np.zeros(len(windows), dtype=bool)
+        word_start[offsets] = True
+        word_start[1:] |= data[:len(windows) - 1] == 32
+        word_start &= in_text
+        few_words = np.add.reduceat(word_start, offsets) < MIN_WORDS
+        positions = np.flatnonzero(word_start | (in_text & few_words[segment]))
+
+        # Multiply-shift hashing of every shingle to 32 bits (uint64 arithmetic wraps around)
+        shingles = (windows[positions] * self._shingle_weights).sum(axis=1, dtype=np.uint64) >> np.uint64(32)
+        # a * x + b mod 2**64 ordered by its high bits is the multiply-shift hash of x with
+        # a and b, so the minimum over each permutation needs no modulo
+        hashes = np.multiply.outer(shingles, self._a) + self._b
+        return np.minimum.reduceat(hashes, np.searchsorted(positions, offsets), axis=0)
+
+    def band_keys(self, signatures):
+        """
+        Returns the LSH band keys of signatures, one row of `bands` signed 64-bit integers
+        (for SQLite) per signature.
+        """
+        import numpy as np
+
+        rows = signatures.reshape(len(signatures), self.bands, -1)
+        keys = (rows * self._band_weights).sum(axis=2, dtype=np.uint64) ^ self._band_salts
+        return keys.view(np.int64)
+
+    def assign_many(self, messages):
+        """
+        Assigns messages to the clusters of their near-duplicates, founding new clusters
+        for the ones that have none.
+
+        Messages of the same batch are clustered with each other as well, in order.
+        Blocking and thread-safe, call it from a worker thread (see `assign_clusters`).
+
+        Args:
+            messages (list): (chat_id, message_id, text) tuples.
+
+        Returns:
+            list: The cluster ID of every message, '<chat_id>:<message_id>' of the
+            cluster's first message, or None if its text is too short to cluster.
+        """
+        clusters = [None] * len(messages)
+        indexed, texts = [], []
+        for i, (_, _, text) in enumerate(messages):
+            text = normalize_text(text) if text else ''
+            if len(text) >= MIN_TEXT_LENGTH:
+                indexed.append(i)
+                texts.append(text)
+        if not texts:
+            return clusters
+
+        keys = self.band_keys(self.signatures(texts)).tolist()
+        with self._lock:
+            self._assign(messages, indexed, keys, clusters)
+        return clusters
+
+    def _assign(self, messages, indexed, keys, clusters):
+        known = self._lookup_bands({key for message_keys in keys for key in message_keys})
+        cluster_ids = self._lookup_clusters(set(known.values()))
+        new_clusters, new_bands = [], []
+        for i, message_keys in zip(indexed, keys):
+            matches = [known[key] for key in message_keys if key in known]
+            if matches:
+                cluster = min(matches)
+                self.duplicates += 1
+            else:
+                chat_id, message_id, _ = messages[i]
+                cluster = self._next_cluster
+                self._next_cluster += 1
+                cluster_ids[cluster] = f"{standardize_chat_id(chat_id)}:{message_id}"
+                new_clusters.append((cluster, cluster_ids[cluster]))
+                # Only the first message of a cluster is indexed
+                for key in message_keys:
+                    if key not in known:
+                        known[key] = cluster
+                        new_bands.append((key, cluster))
+            clusters[i] = cluster_ids[cluster]
+        self._conn.executemany("INSERT INTO clusters (id, cluster_id) VALUES (?, ?)", new_clusters)
+        self._conn.executemany("INSERT INTO bands (key, cluster) VALUES (?, ?)", new_bands)
+
+        self.assigned += len(indexed)
+        self._pending += len(indexed)
+        if self._pending >= COMMIT_EVERY:
+            self._conn.commit()
+            self._pending = 0
+
+    def _select_in(self, query, values):
+        values = list(values)
+        # Stay well below SQLite's bound-parameter limit
+        for i in range(0, len(values), 500):
+            chunk = values[i:i + 500]
+            yield from self._conn.execute(query.format(placeholders=",".join("?" * len(chunk))), chunk)
+
+    def _lookup_bands(self, keys):
+        """
+        Returns a dictionary mapping the known band keys among `keys` to the rowid of their cluster.
+        """
+        return dict(self._select_in("SELECT key, cluster FROM bands WHERE key IN ({placeholders})", keys))
+
+    def _lookup_clusters(self, rowids):
+        """
+        Returns a dictionary mapping cluster rowids to their cluster IDs.
+        """
+        return dict(self._select_in("SELECT id, cluster_id FROM clusters WHERE id IN ({placeholders})", rowids))
+
+    def assign(self, chat_id, message_id, text):
+        """
+        Assigns a single message, see `assign_many`.
+        """
+        return self.assign_many([(chat_id, message_id, text)])[0]
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+            self._pending = 0
+
+    def close(self):
+        self.commit()
+        if self.assigned:
+            logging.info(f"Assigned {self.assigned} messages to near-duplicate clusters, {self.duplicates} of them to an existing cluster")
+        self._conn.close()
+
+
+async def assign_clusters(index, rows):
+    """
+    Fills the duplicate_cluster column of chat_history rows from a near-duplicate index.
+
+    The index is updated in a worker thread, so the event loop keeps fetching
+    and transforming messages meanwhile.
+    """
+    clusters = await asyncio.to_thread(index.assign_many, [(row['chat_id'], row['id'], row['text']) for row in rows])
+    clustered = duplicates = 0
+    for row, cluster in zip(rows, clusters):
+        row['duplicate_cluster'] = cluster
+        if cluster is not None:
+            clustered += 1
+            duplicates += cluster != f"{row['chat_id']}:{row['id']}"
+    metrics.inc('messages_clustered', clustered)
+    metrics.inc('near_duplicates', duplicates)
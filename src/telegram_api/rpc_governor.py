@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import time
+from telethon import errors
+import metrics
+
+# Starting requests per second of every request type; the rate of a type adapts
+# to the flood waits Telegram answers it with (see TokenBucket)
+DEFAULT_RATES = {
+    'GetHistoryRequest': 5.0,
+    'GetMessagesRequest': 5.0,
+    'GetUsersRequest': 2.0,
+    'GetFullUserRequest': 3.0,
+    'GetFullChannelRequest': 1.0,
+    'ResolveUsernameRequest': 1.0,
+}
+DEFAULT_RATE = 3.0
+
+# Requests a type can send at once after being idle
+BURST = 5
+
+# Successful requests after which a type's rate is raised again
+INCREASE_AFTER = 20
+
+
+class TokenBucket:
+    """
+    Paces one request type of one account.
+
+    The rate is tuned AIMD-style: it is halved on every flood wait (down to
+    `min_rate`) and raised by 10% after INCREASE_AFTER successful requests in a row
+    (up to `max_rate`), so it settles just below the rate Telegram tolerates.
+    """
+
+    def __init__(self, rate, min_rate=None, max_rate=None):
+        self.rate = rate
+        self.min_rate = min_rate or rate / 32
+        self.max_rate = max_rate or rate * 8
+        self.tokens = BURST
+        self.blocked_until = 0.0
+        self.calls = 0
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0.0
+        self.throttle_seconds = 0.0
+        self._updated = time.monotonic()
+        self._successes = 0
+
+    def reserve(self, now=None):
+        """
+        Takes a token and returns the seconds to wait before the request may be sent.
+
+        Tokens may go negative: concurrent callers queue up behind each other.
+        """
+        if now is None:
+            now = time.monotonic()
+        self.tokens = min(BURST, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self.tokens -= 1
+        self.calls += 1
+        delay = max(-self.tokens / self.rate if self.tokens < 0 else 0.0, self.blocked_until - now)
+        self.throttle_seconds += delay
+        return delay
+
+    def on_success(self):
+        self._successes += 1
+        if self._successes >= INCREASE_AFTER:
+            self._successes = 0
+            self.rate = min(self.max_rate, self.rate * 1.1)
+
+    def on_flood_wait(self, seconds, now=None):
+        if now is None:
+            now = time.monotonic()
+        self._successes = 0
+        self.flood_waits += 1
+        self.flood_wait_seconds += seconds
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = min(self.tokens, 0)
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+
+class RpcGovernor:
+    """
+    Central pacing of the Telegram RPCs of one account.
+
+    Installed on a client, it wraps the method every Telethon request goes through
+    (`get_entity`, `iter_messages`, `get_messages`, `client(...)` alike), so each
+    request waits for a token of its type's bucket before it is sent. FloodWait
+    errors are handled here instead of by Telethon (the client's
+    `flood_sleep_threshold` is set to 0, so Telethon raises every one of them):
+    the bucket's rate is lowered, the type is blocked for the wait and the request
+    is sent again. Waits longer than `max_flood_sleep`, or than the
+    `flood_sleep_threshold` a request was sent with, are raised, like Telethon does
+    above its threshold; the chat then fails on this account and is run again
+    on a free one (see ClientPool.reacquire).
+    """
+
+    def __init__(self, rates=None, rate_scale=1.0, max_flood_sleep=60):
+        """
+        Args:
+            rates (dict, optional): Starting requests per second by request type, on top of DEFAULT_RATES.
+            rate_scale (float): Factor applied to every starting rate.
+            max_flood_sleep (float): Longest flood wait in seconds slept through before it is raised.
+        """
+        self.rates = {**DEFAULT_RATES, **(rates or {})}
+        self.rate_scale = rate_scale
+        self.max_flood_sleep = max_flood_sleep
+        self.buckets = {}
+        self.started = time.monotonic()
+
+    def bucket(self, request_type):
+        bucket = self.buckets.get(request_type)
+        if bucket is None:
+            bucket = self.buckets[request_type] = TokenBucket(self.rates.get(request_type, DEFAULT_RATE) * self.rate_scale)
+        return bucket
+
+    def install(self, client):
+        """
+        Routes the client's requests through the governor.
+
+        Returns:
+            The client, with the governor as its `rpc_governor` attribute.
+        """
+        call = client._call
+        # Flood waits are slept through here, never by Telethon, so each one lowers
+        # the rate of its type and is counted once
+        client.flood_sleep_threshold = 0
+
+        async def governed_call(sender, request, ordered=False, flood_sleep_threshold=None):
+            return await self.call(
+                call, sender, request=request, ordered=ordered, flood_sleep_threshold=0,
+                max_flood_sleep=flood_sleep_threshold,
+            )
+
+        client._call = governed_call
+        client.rpc_governor = self
+        return client
+
+    async def call(self, call, *args, request=None, max_flood_sleep=None, **kwargs):
+        """
+        Sends a request through `call` once its type's bucket allows it, sleeping through flood waits.
+
+        Args:
+            call: The wrapped request method, called with `args`, the request and `kwargs`.
+            request: The request, or a list of requests sent together.
+            max_flood_sleep (float, optional): Longest flood wait slept through for this
+                request. Defaults to the governor's `max_flood_sleep`.
+        """
+        if max_flood_sleep is None:
+            max_flood_sleep = self.max_flood_sleep
+        first = request[0] if isinstance(request, (list, tuple)) else request
+        request_type = type(first).__name__
+        bucket = self.bucket(request_type)
+        while True:
+            delay = bucket.reserve()
+            if delay > 0:
+                metrics.inc('rpc_throttle_seconds', delay, request=request_type)
+                await asyncio.sleep(delay)
+            # A flood wait may have started while this request was queued
+            blocked = bucket.blocked_until - time.monotonic()
+            if blocked > 0:
+                await asyncio.sleep(blocked)
+            try:
+                result = await call(*args, request, **kwargs)
+            except errors.FloodWaitError as e:
+                # Telegram answers FLOOD_WAIT_0 on test servers
+                seconds = max(e.seconds, 1)
+                bucket.on_flood_wait(seconds)
+                metrics.inc('floodwait_seconds', seconds, request=request_type)
+                if seconds > max_flood_sleep:
+                    logging.warning(f"{request_type} is in a flood wait for {seconds}s, giving up")
+                    raise
+                logging.info(f"{request_type} is in a flood wait for {seconds}s, lowered its rate to {bucket.rate:.2f}/s")
+                continue
+            bucket.on_success()
+            return result
+
+    def log_summary(self, name):
+        """
+        Logs the calls, flood waits and effective rate of every request type.
+        """
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        for request_type, bucket in sorted(self.buckets.items()):
+            logging.info(
+                f"    {name} {request_type}: {bucket.calls} calls at {bucket.calls / elapsed:.2f}/s, "
+                f"{bucket.flood_waits} flood waits ({bucket.flood_wait_seconds:.0f}s), "
+                f"{bucket.throttle_seconds:.0f}s throttled, rate now {bucket.rate:.2f}/s"
+            )
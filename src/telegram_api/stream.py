@@ -0,0 +1,348 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+import metrics
+from telethon import events
+from telethon.tl.types import User
+from telegram_api.chat_info import get_chat_info
+from telegram_api.message_transformer import MessageTransformer, standardize_chat_id
+from telegram_api.near_duplicates import assign_clusters
+from telegram_api.user_info import get_users_info
+
+# Seconds between checks of the clients' connections
+WATCHDOG_INTERVAL = 5
+
+
+def _transport_connected(client):
+    """
+    Returns whether a client's connection is currently up.
+
+    `is_connected()` stays True while Telethon reconnects on its own, so the
+    sender's transport state is checked when available.
+    """
+    sender = getattr(client, '_sender', None)
+    if sender is not None and hasattr(sender, '_transport_connected'):
+        return sender._transport_connected()
+    return client.is_connected()
+
+
+class StreamIngestor:
+    """
+    Loads the messages of the configured chats in near real time from Telegram update events.
+
+    New, edited and deleted messages arrive through `NewMessage`, `MessageEdited` and
+    `MessageDeleted` handlers on the account each chat is assigned to (see
+    ClientPool.home). New and edited messages go through MessageTransformer into
+    chat_history (an edit adds a row with the message's new version and `edit_date`);
+    deletions go to message_deletions. Rows are micro-batched and written with
+    `Sink.stream_rows` once `batch_rows` rows are buffered or every `batch_seconds`.
+
+    Updates are not delivered while a client is disconnected, so on start, after
+    every reconnect and every `catchup_interval` seconds the chats are caught up
+    from their watermark with a regular history fetch. Events of a chat arriving
+    during its catch-up are held back: new messages are only kept if the catch-up
+    did not load them, edits unless the catch-up fetched the message after them.
+
+    A chat's watermark only moves over new messages written without a gap in their
+    IDs, so a restart resumes exactly where the stream stopped and never skips
+    messages it missed. Edits never move it. Gaps (messages missed while updates
+    were lost, or service messages, which are not NewMessage events) hold the
+    watermark back until the next catch-up, which fetches everything above it and
+    skips the messages streamed already.
+    """
+
+    def __init__(self, processor, pool, chat_configs, usernames, batch_rows=500, batch_seconds=2.0, catchup_interval=300):
+        """
+        Args:
+            processor (DataProcessor): Provides the sink, the user cache and the known users and chats.
+            pool (ClientPool): The clients to receive updates with.
+            chat_configs (dict): The chat configurations keyed by username.
+            usernames (list): The usernames of the chats to stream.
+            batch_rows (int): The number of buffered rows that triggers a write.
+            batch_seconds (float): The maximum number of seconds rows stay buffered.
+            catchup_interval (float): Seconds between catch-up fetches of all chats.
+        """
+        self.processor = processor
+        self.sink = processor.sink
+        self.pool = pool
+        self.chat_configs = chat_configs
+        self.usernames = usernames
+        self.batch_rows = batch_rows
+        self.batch_seconds = batch_seconds
+        self.catchup_interval = catchup_interval
+        self.chats = {}
+        self._rows = []
+        self._deletions = []
+        self._senders = {}
+        self._transformers = {}
+        self._last_ids = {}
+        self._streamed = {}
+        self._held = {}
+        self._full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+
+    async def run(self):
+        """
+        Streams until cancelled or until every client is disconnected.
+        """
+        await self._resolve_chats()
+        if not self.chats:
+            logging.error("None of the chats to stream could be resolved")
+            return
+        self._add_handlers()
+        await self.catch_up(list(self.chats))
+
+        tasks = [
+            asyncio.create_task(self._flush_loop()),
+            asyncio.create_task(self._watchdog()),
+        ]
+        try:
+            await asyncio.gather(*(client.disconnected for client in self.pool.clients))
+        finally:
+            for task in tasks:
+                task.cancel()
+            await self.flush()
+
+    async def _resolve_chats(self):
+        for username in self.usernames:
+            chat_config = self.chat_configs.get(username)
+            if not chat_config:
+                logging.warning(f"No chat config found for {username}. Skipping.")
+                continue
+            index = self.pool.home(username)
+            client = self.pool.clients[index]
+            try:
+                chat = await client.get_entity(username)
+            except Exception as e:
+                logging.error(f"Could not resolve {username}: {e}")
+                continue
+            chat_id = standardize_chat_id(chat.id)
+            self.chats[chat_id] = {'username': username, 'chat': chat, 'client': client, 'account': self.pool.names[index], 'config': chat_config}
+            self._last_ids[chat_id] = chat_config.get('last_message_id') or 0
+            self._transformers[chat_id] = MessageTransformer(client, legacy_columns=self.processor.legacy_columns)
+            if str(chat_id) not in self.processor.existing_chats:
+                chat_info = await get_chat_info(client, chat)
+                if chat_info:
+                    self.processor.new_chats[str(chat_id)] = chat_info
+        logging.info(f"Streaming {len(self.chats)} chats")
+
+    def _add_handlers(self):
+        for client in self.pool.clients:
+            chats = [entry['chat'] for entry in self.chats.values() if entry['client'] is client]
+            if not chats:
+                continue
+            client.add_event_handler(self._on_new_message, events.NewMessage(chats=chats))
+            client.add_event_handler(self._on_message_edited, events.MessageEdited(chats=chats))
+            client.add_event_handler(self._on_message_deleted, events.MessageDeleted(chats=chats))
+
+    async def _on_new_message(self, event):
+        chat_id = standardize_chat_id(event.chat_id)
+        metrics.inc('stream_events', event='new_message')
+        if chat_id in self._held:
+            self._held[chat_id].append((event.message, False))
+        elif event.message.id > self._last_ids.get(chat_id, 0):
+            self._add_message(chat_id, event.message, event.message.date, new=True)
+
+    async def _on_message_edited(self, event):
+        chat_id = standardize_chat_id(event.chat_id)
+        metrics.inc('stream_events', event='message_edited')
+        if chat_id in self._held:
+            self._held[chat_id].append((event.message, True))
+        else:
+            self._add_message(chat_id, event.message, event.message.edit_date or event.message.date)
+
+    async def _on_message_deleted(self, event):
+        metrics.inc('stream_events', event='message_deleted')
+        # Telegram only tells which chat a deletion belongs to for channels and supergroups
+        chat_id = standardize_chat_id(event.chat_id) if event.chat_id else None
+        received = datetime.now(timezone.utc)
+        deleted_at = received.isoformat(' ', 'seconds')[:19] + ' +0000'
+        for message_id in event.deleted_ids:
+            self._deletions.append(({'chat_id': chat_id, 'message_id': message_id, 'deleted_at': deleted_at}, received))
+        self._signal_if_full()
+
+    def _add_message(self, chat_id, message, event_date, new=False):
+        transformer = self._transformers.get(chat_id)
+        if transformer is None:
+            return
+        self._rows.append((transformer.transform(message), chat_id, message.id, message.date, event_date, new))
+        if hasattr(message.from_id, 'user_id'):
+            user_id = message.from_id.user_id
+            if str(user_id) not in self.processor.existing_users:
+                self._senders.setdefault(chat_id, {})[user_id] = message.sender if isinstance(message.sender, User) else None
+        self._signal_if_full()
+
+    def _signal_if_full(self):
+        if len(self._rows) + len(self._deletions) >= self.batch_rows:
+            self._full.set()
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.batch_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Error writing streamed rows: {e}", exc_info=True)
+
+    async def flush(self):
+        """
+        Writes the buffered rows, the new senders, and advances the chats' watermarks.
+
+        Rows whose write fails are kept for the next flush.
+        """
+        async with self._flush_lock:
+            rows, self._rows = self._rows, []
+            deletions, self._deletions = self._deletions, []
+            senders, self._senders = self._senders, {}
+
+            await self._write_users(senders)
+
+            if rows:
+                index = self.processor.near_duplicates
+                # Rows kept from a failed write were clustered already
+                unclustered = [row for row, *_ in rows if 'duplicate_cluster' not in row]
+                if index is not None and unclustered:
+                    try:
+                        await assign_clusters(index, unclustered)
+                    except Exception as e:
+                        # The rows are still written, without their cluster
+                        logging.error(f"Error clustering streamed rows: {e}", exc_info=True)
+                if await self.sink.stream_rows('chat_history', [row for row, *_ in rows]):
+                    self._observe_latency(rows, 'chat_history', lambda entry: entry[4])
+                    await self._advance_watermarks(rows)
+                else:
+                    metrics.inc('rows_failed', len(rows), table='chat_history')
+                    self._rows = rows + self._rows
+
+            if deletions:
+                if await self.sink.stream_rows('message_deletions', [row for row, _ in deletions]):
+                    self._observe_latency(deletions, 'message_deletions', lambda entry: entry[1])
+                else:
+                    metrics.inc('rows_failed', len(deletions), table='message_deletions')
+                    self._deletions = deletions + self._deletions
+
+    def _observe_latency(self, entries, table, event_time):
+        now = datetime.now(timezone.utc)
+        metrics.inc('rows_loaded', len(entries), table=table)
+        for entry in entries:
+            metrics.observe('stream_latency_seconds', (now - event_time(entry)).total_seconds(), table=table)
+
+    async def _advance_watermarks(self, rows):
+        """
+        Moves the chats' watermarks over the written new messages that follow them without a gap.
+        """
+        chat_ids = set()
+        for _, chat_id, message_id, message_date, _, new in rows:
+            if new and message_id > self._last_ids.get(chat_id, 0):
+                self._streamed.setdefault(chat_id, {})[message_id] = message_date
+                chat_ids.add(chat_id)
+        for chat_id in chat_ids:
+            streamed = self._streamed[chat_id]
+            last_id = self._last_ids.get(chat_id, 0)
+            last_date = None
+            while last_id + 1 in streamed:
+                last_id += 1
+                last_date = streamed.pop(last_id)
+            if last_date is not None:
+                self._last_ids[chat_id] = last_id
+                await self.sink.update_watermark(self.chats[chat_id]['config']['id'], last_id, last_date)
+
+    async def _write_users(self, senders):
+        for chat_id, known_users in senders.items():
+            user_ids = [user_id for user_id in known_users if str(user_id) not in self.processor.existing_users]
+            if not user_ids:
+                continue
+            client = self.chats[chat_id]['client']
+            users = await get_users_info(
+                client, user_ids, known_users={user_id: user for user_id, user in known_users.items() if user},
+                cache=self.processor.user_cache,
+            )
+            if await self.sink.stream_rows('user_info', list(users.values())):
+                metrics.inc('rows_loaded', len(users), table='user_info')
+                self.processor.existing_users.update(users)
+            else:
+                metrics.inc('rows_failed', len(users), table='user_info')
+
+    async def catch_up(self, chat_ids):
+        """
+        Fetches the messages the chats received since their last loaded message.
+        """
+        await self.flush()
+        for chat_id in chat_ids:
+            entry = self.chats[chat_id]
+            self._held[chat_id] = []
+            # New messages written above the watermark, which the catch-up skips as loaded
+            streamed = dict(self._streamed.get(chat_id, {}))
+            success = False
+            try:
+                end_date = datetime.now(timezone.utc)
+                min_id = self._last_ids.get(chat_id, 0)
+                # Chats never loaded before start with the last day, like the recent mode
+                start_date = end_date - timedelta(days=1)
+                if min_id and entry['config'].get('last_message_date'):
+                    start_date = min(entry['config']['last_message_date'].replace(tzinfo=timezone.utc), start_date)
+                with metrics.labelled(account=entry['account']):
+                    success, watermark = await self.processor.catch_up(
+                        entry['client'], entry['username'], entry['chat'], entry['config'], start_date, end_date, min_id=min_id
+                    )
+                if success:
+                    await self._advance_after_catch_up(chat_id, watermark, streamed)
+                else:
+                    logging.error(f"Catch-up of {entry['username']} failed, retrying at the next catch-up")
+            finally:
+                for message, edited in self._held.pop(chat_id, []):
+                    if not edited:
+                        if message.id > self._last_ids.get(chat_id, 0):
+                            self._add_message(chat_id, message, message.date, new=True)
+                        continue
+                    fetched = success and min_id < message.id <= self._last_ids.get(chat_id, 0) and message.id not in streamed
+                    if fetched and message.edit_date and message.edit_date < end_date:
+                        # The catch-up loaded the message with this edit already
+                        continue
+                    self._add_message(chat_id, message, message.edit_date or message.date)
+        await self.processor.upload_new_data()
+
+    async def _advance_after_catch_up(self, chat_id, watermark, streamed):
+        """
+        Moves a chat's watermark after a successful catch-up.
+
+        Every message above the watermark is loaded then: fetched by the catch-up
+        (up to `watermark`) or streamed before it (`streamed`), so the watermark moves
+        to the newest of them.
+        """
+        candidates = list(streamed.items()) + ([watermark] if watermark else [])
+        last_id, last_date = max(candidates, default=(0, None))
+        if last_id <= self._last_ids.get(chat_id, 0):
+            return
+        self._last_ids[chat_id] = last_id
+        self._streamed[chat_id] = {
+            message_id: message_date for message_id, message_date in self._streamed.get(chat_id, {}).items() if message_id > last_id
+        }
+        if watermark is None or last_id > watermark[0]:
+            await self.sink.update_watermark(self.chats[chat_id]['config']['id'], last_id, last_date)
+
+    async def _watchdog(self):
+        connected = {client: True for client in self.pool.clients}
+        last_catch_up = time.monotonic()
+        while True:
+            await asyncio.sleep(WATCHDOG_INTERVAL)
+            reconnected = []
+            for client in self.pool.clients:
+                is_connected = _transport_connected(client)
+                if is_connected and not connected[client]:
+                    reconnected.append(client)
+                connected[client] = is_connected
+            try:
+                if time.monotonic() - last_catch_up >= self.catchup_interval:
+                    last_catch_up = time.monotonic()
+                    await self.catch_up(list(self.chats))
+                elif reconnected:
+                    logging.info(f"{len(reconnected)} clients reconnected, catching up their chats")
+                    await self.catch_up([chat_id for chat_id, entry in self.chats.items() if entry['client'] in reconnected])
+            except Exception as e:
+                logging.error(f"Error catching up: {e}", exc_info=True)
@@ -0,0 +1,91 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+
+
+class UserInfoCache:
+    """
+    Persistent SQLite cache of user profiles keyed by user ID.
+
+    Entries younger than `ttl` seconds are fresh and are used as is. Older entries
+    are stale: they are refreshed from Telegram when the user is seen again and
+    are evicted once they are older than `evict_after` seconds.
+    """
+
+    def __init__(self, path, ttl=7 * 24 * 3600, evict_after=30 * 24 * 3600):
+        """
+        Opens (and creates if needed) the cache database.
+
+        Args:
+            path (str): Path of the SQLite file. Point it at a mounted volume to share the cache across executions.
+            ttl (float): Age in seconds after which an entry is considered stale.
+            evict_after (float): Age in seconds after which an entry is deleted.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self.evict_after = evict_after
+        self._conn = sqlite3.connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_info (id INTEGER PRIMARY KEY, info TEXT NOT NULL, fetched_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get_many(self, user_ids):
+        """
+        Looks up several users at once.
+
+        Args:
+            user_ids (iterable): The user IDs to look up.
+
+        Returns:
+            tuple: (fresh, stale) dictionaries mapping user ID to the cached user info.
+        """
+        fresh, stale = {}, {}
+        user_ids = [int(user_id) for user_id in user_ids]
+        cutoff = time.time() - self.ttl
+        # Stay well below SQLite's bound-parameter limit
+        for i in range(0, len(user_ids), 500):
+            chunk = user_ids[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self._conn.execute(
+                f"SELECT id, info, fetched_at FROM user_info WHERE id IN ({placeholders})", chunk
+            )
+            for user_id, info, fetched_at in rows:
+                target = fresh if fetched_at >= cutoff else stale
+                target[user_id] = json.loads(info)
+        return fresh, stale
+
+    def put_many(self, user_infos):
+        """
+        Stores or refreshes user infos.
+
+        Args:
+            user_infos (dict): Mapping of user ID to user info dictionary.
+        """
+        now = time.time()
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO user_info (id, info, fetched_at) VALUES (?, ?, ?)",
+            [(int(user_id), json.dumps(info), now) for user_id, info in user_infos.items()],
+        )
+        self._conn.commit()
+
+    def evict(self):
+        """
+        Deletes entries older than `evict_after` seconds.
+
+        Returns:
+            int: The number of deleted entries.
+        """
+        cursor = self._conn.execute("DELETE FROM user_info WHERE fetched_at < ?", (time.time() - self.evict_after,))
+        self._conn.commit()
+        if cursor.rowcount:
+            logging.info(f"Evicted {cursor.rowcount} expired users from the user cache")
+        return cursor.rowcount
+
+    def close(self):
+        self._conn.close()
@@ -1,4 +1,38 @@
-from telethon.tl.functions.users import GetFullUserRequest
+import logging
+import metrics
+from telethon.tl.functions.users import GetFullUserRequest, GetUsersRequest
+from telethon.tl.types import User
+
+# Maximum number of users resolved by a single GetUsersRequest
+USERS_BATCH_SIZE = 200
+
+def _empty_user_info(user_id):
+    return {
+        'id': str(user_id),
+        'first_name': None,
+        'last_name': None,
+        'username': None,
+        'phone': 0,
+        'bot': False,
+        'verified': False,
+        'scam': False,
+        'access_hash': 0,
+        'bio': None,
+    }
+
+def _build_user_info(user, full_user=None):
+    return {
+        'id': user.id,
+        'first_name': user.first_name or None,
+        'last_name': user.last_name or None,
+        'username': user.username or None,
+        'phone': int(user.phone) if user.phone is not None else 0,
+        'bot': bool(user.bot),
+        'verified': bool(user.verified),
+        'scam': bool(user.scam),
+        'access_hash': str(user.access_hash) if hasattr(user, 'access_hash') else None,
+        'bio': full_user.full_user.about if full_user is not None else None,
+    }
 
 async def get_user_info(client, user_id):
     """
@@ -27,46 +61,95 @@ async def get_user_info(client, user_id):
     try:
         user = await client.get_entity(user_id)
         full_user = await client(GetFullUserRequest(user))
-        
-        user_info = {
-            'id': str(user_id),
-            'first_name': None,
-            'last_name': None,
-            'username': None,
-            'phone': None,
-            'bot': None,
-            'verified': None,
-            'scam': None,
-            'access_hash': None,
-            'bio': None,
-        }
-        
-        if user:
-            user_info.update({
-                'id': user.id,
-                'first_name': user.first_name or None,
-                'last_name': user.last_name or None,
-                'username': user.username or None,
-                'phone': int(user.phone) if user.phone is not None else 0,
-                'bot': bool(user.bot),
-                'verified': bool(user.verified),
-                'scam': bool(user.scam),
-                'access_hash': str(user.access_hash) if hasattr(user, 'access_hash') else None,
-                'bio': full_user.full_user.about if hasattr(user, 'about') else None,
-            })
-        
-        return user_info
+        return _build_user_info(user, full_user)
     except Exception as e:
-        return {
-            'id': str(user_id),
-            'first_name': None,
-            'last_name': None,
-            'username': None,
-            'phone': 0,
-            'bot': False,
-            'verified': False,
-            'scam': False,
-            'access_hash': 0,
-            'bio': None,
-        }
-    
+        return _empty_user_info(user_id)
+
+async def _resolve_users(client, user_ids):
+    """
+    Resolves user entities in batches of GetUsersRequest.
+    """
+    users = {}
+    user_ids = list(user_ids)
+    for i in range(0, len(user_ids), USERS_BATCH_SIZE):
+        input_users = []
+        for user_id in user_ids[i:i + USERS_BATCH_SIZE]:
+            try:
+                input_users.append(await client.get_input_entity(user_id))
+            except Exception as e:
+                logging.debug(f"Could not resolve input entity for user {user_id}: {e}")
+        if not input_users:
+            continue
+        try:
+            for user in await client(GetUsersRequest(input_users)):
+                if isinstance(user, User):
+                    users[user.id] = user
+        except Exception as e:
+            logging.error(f"Error resolving a batch of {len(input_users)} users: {e}")
+    return users
+
+async def get_users_info(client, user_ids, known_users=None, cache=None):
+    """
+    Retrieves information about several users, using a persistent cache when given.
+
+    Fresh cache entries are returned without any Telegram call. Missing and stale
+    users are resolved in batches with GetUsersRequest (or taken from `known_users`,
+    e.g. the senders Telethon attached to fetched messages), and GetFullUserRequest
+    is only issued for those users to refresh their bio. Users whose GetFullUserRequest
+    fails are returned without a bio (or with their stale one) but are not cached.
+
+    Args:
+        client: The Telegram client instance.
+        user_ids (iterable): The IDs of the users.
+        known_users (dict, optional): Already resolved User entities keyed by user ID.
+        cache (UserInfoCache, optional): The persistent user cache.
+
+    Returns:
+        dict: User info dictionaries (see `get_user_info`) keyed by the string user ID.
+    """
+    user_ids = {int(user_id) for user_id in user_ids}
+    known_users = known_users or {}
+    if cache is not None:
+        fresh, stale = cache.get_many(user_ids)
+    else:
+        fresh, stale = {}, {}
+
+    to_fetch = user_ids - fresh.keys()
+    entities = {user_id: known_users[user_id] for user_id in to_fetch if user_id in known_users}
+    entities.update(await _resolve_users(client, to_fetch - entities.keys()))
+
+    fetched = {}
+    failed = {}
+    for user_id in to_fetch:
+        user = entities.get(user_id)
+        if user is None:
+            continue
+        try:
+            full_user = await client(GetFullUserRequest(user))
+        except Exception as e:
+            logging.debug(f"Could not fetch full user {user_id}: {e}")
+            failed[user_id] = e
+            full_user = None
+        user_info = _build_user_info(user, full_user)
+        if full_user is None and user_id in stale:
+            # Keep the last known bio rather than blanking it
+            user_info['bio'] = stale[user_id].get('bio')
+        fetched[user_id] = user_info
+
+    if failed:
+        # Not cached, so their bios are fetched again the next time they are seen
+        logging.warning(f"Could not fetch the full profile of {len(failed)} users, not caching them: {next(iter(failed.values()))}")
+    if cache is not None:
+        complete = {user_id: user_info for user_id, user_info in fetched.items() if user_id not in failed}
+        if complete:
+            cache.put_many(complete)
+
+    metrics.inc('user_lookups', len(fresh), source='cache')
+    metrics.inc('user_lookups', len(fetched), source='telegram')
+    logging.info(f"Resolved {len(user_ids)} users: {len(fresh)} from cache, {len(fetched)} fetched from Telegram")
+
+    users = {}
+    for user_id in user_ids:
+        user_info = fresh.get(user_id) or fetched.get(user_id) or stale.get(user_id) or _empty_user_info(user_id)
+        users[str(user_id)] = user_info
+    return users
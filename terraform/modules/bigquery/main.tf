@@ -16,6 +16,18 @@ resource "google_bigquery_table" "chat_history" {
   table_id            = var.table_chat_history
   schema              = file("${path.module}/chat_history.json")
   deletion_protection = false
+  clustering          = ["chat_id"]
+
+  time_partitioning {
+    type  = "DAY"
+    field = "date"
+  }
+
+  # Partitioning and clustering cannot be added in place: an unmigrated table would
+  # be destroyed and recreated empty. See "Partitioning" in the README.
+  lifecycle {
+    prevent_destroy = true
+  }
 }
 
 resource "google_bigquery_table" "chat_info" {
@@ -32,6 +44,13 @@ resource "google_bigquery_table" "user_info" {
   deletion_protection = false
 }
 
+resource "google_bigquery_table" "message_deletions" {
+  dataset_id          = google_bigquery_dataset.dataset.dataset_id
+  table_id            = var.table_message_deletions
+  schema              = file("${path.module}/message_deletions.json")
+  deletion_protection = false
+}
+
 resource "google_bigquery_dataset_iam_member" "dataset_writer" {
   dataset_id = google_bigquery_dataset.dataset.dataset_id
   role       = "roles/bigquery.dataEditor"
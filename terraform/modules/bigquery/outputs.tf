@@ -14,6 +14,10 @@ output "table_user_info" {
   value = google_bigquery_table.user_info.table_id
 }
 
+output "table_message_deletions" {
+  value = google_bigquery_table.message_deletions.table_id
+}
+
 output "dataset_id" {
   value = google_bigquery_dataset.dataset.dataset_id
 }
\ No newline at end of file
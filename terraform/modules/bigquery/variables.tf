@@ -34,6 +34,12 @@ variable "table_user_info" {
   type        = string 
 }
 
+variable "table_message_deletions" {
+  description = "The BigQuery table name for messages deleted in the streamed chats."
+  type        = string
+  default     = "message_deletions"
+}
+
 variable "labels" {
   description = "A map of labels to assign to the tables created by this module."
   type        = map(string)
@@ -0,0 +1,239 @@
+"""
+Synthetic-load benchmark of the ETL hot path.
+
+Runs each stage against FakeTelegramClient / FakeBigQueryClient (no network, no
+credentials) in its own subprocess, so peak RSS is measured per stage, and reports
+messages/sec, wall time and peak RSS. The time the fakes spend building their
+synthetic messages is left out, so the figures are those of the ETL itself.
+Messages are transformed with the legacy repr columns, as WRITE_LEGACY_COLUMNS
+defaults to, unless --legacy_columns 0 is given:
+
+- fetch_transform: get_chat_history collecting rows in memory
+- load_json: upload_to_bigquery of the fetched rows
+- process_chat_json / process_chat_parquet: DataProcessor.process_chat streaming to the sink
+- main: main() end to end in backload mode over several chats, spread across
+  --accounts fake accounts (the first of which starts in a FloodWait when there
+  are several)
+
+Usage (from the repository root):
+
+    python tests/benchmarks/bench_etl.py --messages 20000
+    python tests/benchmarks/bench_etl.py --output bench.json
+    python tests/benchmarks/bench_etl.py --compare bench.json --tolerance 0.2
+
+With --compare the script exits with status 1 if any stage's messages/sec dropped
+by more than the tolerance against the saved results.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, '..', '..', 'src')
+sys.path.insert(0, SRC)
+sys.path.insert(0, HERE)
+
+STAGES = ('fetch_transform', 'load_json', 'process_chat_json', 'process_chat_parquet', 'main')
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def make_clients(args, usernames=()):
+    from fakes import FakeTelegramClient, FakeBigQueryClient, chat_config_rows
+
+    client = FakeTelegramClient(
+        messages_per_chat=args.messages, users=args.users, span=timedelta(days=args.days),
+        page_latency=args.page_latency, rpc_latency=args.rpc_latency,
+    )
+    bq_client = FakeBigQueryClient(chat_configs=chat_config_rows(usernames), load_latency=args.load_latency)
+    return client, bq_client
+
+
+def make_sink(bq_client, load_format='json'):
+    from sinks import create_sink
+
+    return create_sink(
+        'bigquery', bq_client=bq_client, dataset_id='bench',
+        table_chat_config='chat_config', table_chat_history='chat_history',
+        table_chat_info='chat_info', table_user_info='user_info', load_format=load_format,
+    )
+
+
+async def fetch_history(args, client, bq_client):
+    from telegram_api.chat_history import get_chat_history
+
+    chat = await client.get_entity('bench')
+    start_date = client.end - timedelta(days=args.days)
+    messages, users, _ = await get_chat_history(client, chat, start_date, client.end, make_sink(bq_client), legacy_columns=bool(args.legacy_columns))
+    return messages, users
+
+
+async def run_stage(stage, args):
+    """
+    Runs one stage and returns (messages processed, extra metrics).
+    """
+    client, bq_client = make_clients(args)
+
+    if stage == 'fetch_transform':
+        messages, users = await fetch_history(args, client, bq_client)
+        return len(messages), {'users': len(users), 'rpc_calls': client.rpc_calls, 'build_seconds': client.build_seconds}
+
+    if stage == 'load_json':
+        from bigquery_loader import upload_to_bigquery
+
+        messages, _ = await fetch_history(args, client, bq_client)
+        start = time.perf_counter()
+        await upload_to_bigquery(bq_client, messages, 'chat_history', 'bench', 'chat_config', 'chat_history', 'chat_info', 'user_info')
+        # Only the load itself is timed for this stage
+        return len(messages), {'elapsed_override': time.perf_counter() - start, 'bytes_loaded': bq_client.bytes_loaded}
+
+    if stage in ('process_chat_json', 'process_chat_parquet'):
+        from telegram_api.data_processor import DataProcessor
+
+        sink = make_sink(bq_client, 'parquet' if stage.endswith('parquet') else 'json')
+        processor = DataProcessor(client, sink, flush_max_rows=args.flush_rows, legacy_columns=bool(args.legacy_columns))
+        start_date = client.end - timedelta(days=args.days)
+        await processor.process_chat('bench', start_date, client.end, {'id': 'bench'})
+        return args.messages, {'loads': bq_client.loads, 'bytes_loaded': bq_client.bytes_loaded, 'rpc_calls': client.rpc_calls, 'build_seconds': client.build_seconds}
+
+    if stage == 'main':
+        usernames = [f"bench{i}" for i in range(args.chats)]
+        client, bq_client = make_clients(args, usernames)
+        clients = [client] + [make_clients(args)[0] for _ in range(args.accounts - 1)]
+        if args.accounts > 1:
+            clients[0].flood_wait(3600)
+        cache_dir = tempfile.mkdtemp()
+        os.environ.update({
+            'CHAT_USERNAMES': ",".join(usernames),
+            'USER_CACHE_PATH': os.path.join(cache_dir, 'user_info.sqlite'),
+            'SPOOL_DIR': os.path.join(cache_dir, 'spool'),
+            'NEAR_DUPLICATE_INDEX_PATH': os.path.join(cache_dir, 'near_duplicates.sqlite'),
+            'KNOWN_IDS_DIR': os.path.join(cache_dir, 'known_ids'),
+            # Pace requests through the governor without throttling the fakes
+            'RPC_RATE_SCALE': '1000000',
+            'LOGGING_LEVEL': 'WARNING',
+            'WRITE_LEGACY_COLUMNS': 'true' if args.legacy_columns else 'false',
+            'DATASET_ID': 'bench',
+            'TABLE_CHAT_CONFIG': 'chat_config',
+            'TABLE_CHAT_HISTORY': 'chat_history',
+            'TABLE_CHAT_INFO': 'chat_info',
+            'TABLE_USER_INFO': 'user_info',
+            'TELEGRAM_SESSION_STRINGS': ",".join(f"session{i}" for i in range(args.accounts)),
+        })
+        import main as etl_main
+
+        # Route the clients main() creates to the fakes
+        fake_clients = iter(clients)
+        etl_main.telegram_client = lambda *a, **k: next(fake_clients)
+        etl_main.bigquery_client = lambda: bq_client
+
+        end_date = (client.end - timedelta(days=1)).date()
+        start_date = (client.end - timedelta(days=args.days)).date()
+        await etl_main.main('backload', start_date.isoformat(), end_date.isoformat())
+        sent = [c.rpc_calls + c.pages for c in clients]
+        counted = etl_main.metrics.value('rpc_calls')
+        if counted != sum(sent):
+            raise AssertionError(f"rpc_calls counted {counted} requests, the fake clients served {sum(sent)}")
+        return None, {'loads': bq_client.loads, 'queries': bq_client.queries, 'bytes_loaded': bq_client.bytes_loaded, 'rpc_calls': sent if args.accounts > 1 else sent[0], 'build_seconds': sum(c.build_seconds for c in clients)}
+
+    raise ValueError(f"Unknown stage: {stage}")
+
+
+def run_in_process(stage, args):
+    # Imports take longer than a stage of a few thousand messages; they are a
+    # startup cost (see --profile-startup), not part of the hot path
+    import fakes, sinks, bigquery_loader, telegram_api.chat_history, telegram_api.data_processor
+
+    start = time.perf_counter()
+    count, extra = asyncio.run(run_stage(stage, args))
+    elapsed = extra.pop('elapsed_override', None)
+    if elapsed is None:
+        elapsed = time.perf_counter() - start - extra.pop('build_seconds', 0.0)
+    if count is None:
+        # main() covers every chat; messages outside the backload range are not fetched
+        count = int(args.messages * args.chats * (args.days - 1) / args.days)
+    return {
+        'stage': stage,
+        'messages': count,
+        'seconds': round(elapsed, 3),
+        'messages_per_sec': round(count / elapsed, 1) if elapsed else None,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        **extra,
+    }
+
+
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = {row['stage']: row for row in json.load(f)}
+    regressions = []
+    for row in results:
+        before = baseline.get(row['stage'])
+        if not before or not before.get('messages_per_sec') or not row['messages_per_sec']:
+            continue
+        change = row['messages_per_sec'] / before['messages_per_sec'] - 1
+        print(f"{row['stage']:<22} {before['messages_per_sec']:>12.1f} -> {row['messages_per_sec']:>12.1f} msg/s ({change:+.1%})")
+        if change < -tolerance:
+            regressions.append(row['stage'])
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic-load benchmark of the Telegram ETL")
+    parser.add_argument("--stages", nargs='+', choices=STAGES, default=list(STAGES), help="Stages to run")
+    parser.add_argument("--messages", type=int, default=20000, help="Messages per chat")
+    parser.add_argument("--users", type=int, default=2000, help="Distinct senders")
+    parser.add_argument("--days", type=int, default=10, help="Days of history per chat")
+    parser.add_argument("--chats", type=int, default=4, help="Chats in the main() stage")
+    parser.add_argument("--accounts", type=int, default=1, help="Telegram accounts in the main() stage")
+    parser.add_argument("--flush_rows", type=int, default=5000, help="Rows per load chunk")
+    parser.add_argument("--page_latency", type=float, default=0.0, help="Simulated seconds per history page")
+    parser.add_argument("--rpc_latency", type=float, default=0.0, help="Simulated seconds per other RPC")
+    parser.add_argument("--load_latency", type=float, default=0.0, help="Simulated seconds per load job")
+    parser.add_argument("--legacy_columns", type=int, choices=(0, 1), default=1, help="Also fill the legacy repr columns")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--compare", help="Compare against results saved with --output")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative drop in messages/sec")
+    parser.add_argument("--stage", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage:
+        # Child process: run a single stage and report it on stdout
+        print(json.dumps(run_in_process(args.stage, args)))
+        return
+
+    passthrough = sys.argv[1:]
+    results = []
+    for stage in args.stages:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), *passthrough, '--stage', stage],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"{'stage':<22} {'messages':>10} {'seconds':>9} {'msg/s':>12} {'peak RSS MB':>12}")
+    for row in results:
+        print(f"{row['stage']:<22} {row['messages']:>10} {row['seconds']:>9.2f} {row['messages_per_sec']:>12.1f} {row['peak_rss_mb']:>12.1f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        if regressions:
+            print(f"Performance regression in: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
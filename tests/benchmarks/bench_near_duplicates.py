@@ -0,0 +1,125 @@
+"""
+Benchmark of the near-duplicate index at millions of messages.
+
+Streams synthetic messages through NearDuplicateIndex.assign_many in batches, as
+ingest does. Texts are drawn from a Zipf-distributed vocabulary, so unrelated
+messages share their common words like real ones; a share of the messages are
+edited copies of a recent message (words replaced, a link or a prefix added),
+the way reposts and spam campaigns vary. Reports messages/sec per tenth of the
+run (flat if assignments are sub-linear in the index size), the size of the
+index, and the recall (copies assigned to their original's cluster) and false
+positive rate (unrelated messages assigned to an earlier cluster).
+
+Usage (from the repository root):
+
+    python tests/benchmarks/bench_near_duplicates.py --messages 1000000
+    python tests/benchmarks/bench_near_duplicates.py --messages 5000000 --index /data/near_duplicates.sqlite
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import deque
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'src'))
+
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+class MessageGenerator:
+    """
+    Deterministic stream of (chat_id, message_id, text, original) tuples, where
+    `original` is the index of the message a copy was made from, or None.
+    """
+
+    def __init__(self, vocabulary=50000, duplicate_rate=0.2, recent=100000, seed=0):
+        self.rng = random.Random(seed)
+        self.vocabulary = [''.join(self.rng.choice(LETTERS) for _ in range(self.rng.randint(2, 10))) for _ in range(vocabulary)]
+        self.weights = list(itertools.accumulate(1 / rank for rank in range(1, vocabulary + 1)))
+        self.duplicate_rate = duplicate_rate
+        # Originals copies are made from: (index, words)
+        self.recent = deque(maxlen=recent)
+
+    def edit(self, words):
+        rng = self.rng
+        words = [rng.choices(self.vocabulary, cum_weights=self.weights)[0] if rng.random() < 0.1 else word for word in words]
+        if rng.random() < 0.3:
+            words.append(f"https://t.me/{''.join(rng.choice(LETTERS) for _ in range(8))}")
+        if rng.random() < 0.2:
+            words.insert(0, rng.choice(("repost", "forwarded", "🔥", "breaking")))
+        return words
+
+    def __iter__(self):
+        rng = self.rng
+        for i in itertools.count():
+            chat_id = 1000000 + rng.randrange(500)
+            if self.recent and rng.random() < self.duplicate_rate:
+                original, words = rng.choice(self.recent)
+                yield chat_id, i, ' '.join(self.edit(words)), original
+                continue
+            words = rng.choices(self.vocabulary, cum_weights=self.weights, k=rng.randint(5, 60))
+            self.recent.append((i, words))
+            yield chat_id, i, ' '.join(words), None
+
+
+def run(args):
+    from telegram_api.near_duplicates import NearDuplicateIndex
+
+    path = args.index or os.path.join(tempfile.mkdtemp(), 'near_duplicates.sqlite')
+    index = NearDuplicateIndex(path)
+    messages = iter(MessageGenerator(args.vocabulary, args.duplicate_rate, seed=args.seed))
+    clusters = {}
+    copies = found = originals = false_positives = 0
+    windows = []
+    elapsed = 0.0
+    window = max(args.messages // 10, args.batch)
+    for start in range(0, args.messages, args.batch):
+        batch = list(itertools.islice(messages, min(args.batch, args.messages - start)))
+        started = time.perf_counter()
+        assigned = index.assign_many([(chat_id, message_id, text) for chat_id, message_id, text, _ in batch])
+        elapsed += time.perf_counter() - started
+        for (chat_id, message_id, _, original), cluster in zip(batch, assigned):
+            if original is None:
+                originals += 1
+                false_positives += cluster is not None and cluster != f"{chat_id}:{message_id}"
+                clusters[message_id] = cluster
+            else:
+                copies += 1
+                found += cluster is not None and cluster == clusters.get(original)
+        if (start + len(batch)) % window < args.batch:
+            windows.append(round(window / elapsed, 1))
+            elapsed = 0.0
+        # Keep the ground truth to the originals copies can still be made from
+        if len(clusters) > 2 * 100000:
+            for message_id in sorted(clusters)[:len(clusters) - 100000]:
+                del clusters[message_id]
+    index.close()
+
+    return {
+        'messages': args.messages,
+        'messages_per_sec_by_tenth': windows,
+        'index_mb': round(sum(os.path.getsize(f"{path}{suffix}") for suffix in ('', '-wal') if os.path.exists(f"{path}{suffix}")) / 2 ** 20, 1),
+        'recall': round(found / copies, 4) if copies else None,
+        'false_positive_rate': round(false_positives / originals, 4) if originals else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the near-duplicate index")
+    parser.add_argument("--messages", type=int, default=1000000, help="Messages to assign")
+    parser.add_argument("--batch", type=int, default=100, help="Messages per assign_many call")
+    parser.add_argument("--duplicate_rate", type=float, default=0.2, help="Share of messages that are edited copies")
+    parser.add_argument("--vocabulary", type=int, default=50000, help="Distinct words")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the message generator")
+    parser.add_argument("--index", help="Path of the index, a temporary file by default")
+    args = parser.parse_args()
+    print(json.dumps(run(args), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""
+In-process stand-ins for the Telegram and BigQuery clients used by the benchmarks.
+
+FakeTelegramClient yields real Telethon Message objects (with reactions, media,
+replies, edits and many distinct senders) generated deterministically from a
+seed, so the ETL hot path runs exactly as it does against Telegram. FakeBigQueryClient
+accepts queries and load jobs and records what was loaded.
+"""
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from telethon import errors
+from telethon.extensions import markdown
+from telethon.tl.custom.message import Message
+from telethon.tl.functions.channels import GetMessagesRequest
+from telethon.tl.functions.contacts import ResolveUsernameRequest
+from telethon.tl.functions.messages import GetHistoryRequest
+from telethon.tl.functions.users import GetFullUserRequest, GetUsersRequest
+from telethon.tl.types import (
+    Channel, Document, DocumentAttributeFilename, DocumentAttributeVideo,
+    InputChannel, InputMessageID, InputPeerChannel, InputPeerUser, InputUser, MessageEntityBold, MessageEntityUrl, MessageMediaDocument, MessageMediaPhoto,
+    MessageReactions, MessageReplies, MessageReplyHeader, PeerChannel, PeerUser, Photo, PhotoSize,
+    ReactionCount, ReactionCustomEmoji, ReactionEmoji, User,
+)
+
+WORDS = (
+    "market update price breaking news token launch airdrop community report today new "
+    "analysis thread link join channel official announcement partnership release chart"
+).split()
+EMOJIS = ["👍", "🔥", "❤", "😂", "👎", "🎉", "🤔"]
+
+
+class FakeTelegramClient:
+    """
+    Minimal async Telethon client serving a synthetic channel history.
+
+    Args:
+        messages_per_chat (int): Number of messages in each chat's history.
+        users (int): Number of distinct senders.
+        span (timedelta): Time span covered by each chat's history, ending now.
+        page_size (int): Messages per simulated GetHistoryRequest page.
+        page_latency (float): Seconds of simulated network latency per page.
+        rpc_latency (float): Seconds of simulated latency per other RPC.
+        seed (int): Seed of the message generator.
+    """
+
+    def __init__(self, messages_per_chat=10000, users=2000, span=timedelta(days=30),
+                 page_size=100, page_latency=0.0, rpc_latency=0.0, seed=0):
+        self.messages_per_chat = messages_per_chat
+        self.users = users
+        self.span = span
+        self.page_size = page_size
+        self.page_latency = page_latency
+        self.rpc_latency = rpc_latency
+        self.seed = seed
+        self.end = datetime.now(timezone.utc).replace(microsecond=0)
+        self.parse_mode = markdown
+        self.rpc_calls = 0
+        self.pages = 0
+        # Seconds spent building the messages of the synthetic history
+        self.build_seconds = 0.0
+        self._self_id = 0
+        self._mb_entity_cache = {}
+        self._chats = {}
+        # Same bookkeeping as Telethon: request constructor ID -> time.time() the FloodWait ends
+        self._flood_waited_requests = {}
+
+    async def start(self, *args, **kwargs):
+        return self
+
+    def flood_wait(self, seconds, request=GetHistoryRequest):
+        """
+        Simulates a FloodWait of `seconds` on a request type, as ClientPool sees it.
+        """
+        self._flood_waited_requests[request.CONSTRUCTOR_ID] = time.time() + seconds
+
+    async def disconnect(self):
+        pass
+
+    def _chat(self, username):
+        if username not in self._chats:
+            chat_id = 1000000 + len(self._chats)
+            self._chats[username] = Channel(
+                id=chat_id, title=f"Channel {username}", photo=None, date=self.end - self.span,
+                username=username, access_hash=chat_id * 7, broadcast=True, participants_count=50000,
+            )
+        return self._chats[username]
+
+    async def get_entity(self, entity):
+        if isinstance(entity, str):
+            return await self(ResolveUsernameRequest(entity))
+        entities = entity if isinstance(entity, list) else [entity]
+        users = await self(GetUsersRequest([InputUser(int(e), int(e) * 31) for e in entities]))
+        return users if isinstance(entity, list) else users[0]
+
+    async def get_input_entity(self, entity):
+        return InputPeerUser(int(entity), int(entity) * 31)
+
+    def _user(self, user_id):
+        return User(
+            id=user_id, access_hash=user_id * 31, first_name=f"User{user_id}", last_name=None,
+            username=f"user{user_id}", phone=None, bot=user_id % 50 == 0, verified=False, scam=False,
+        )
+
+    async def __call__(self, request):
+        # TelegramClient.__call__ resolves the entities passed in to input entities
+        if isinstance(request, GetFullUserRequest) and isinstance(request.id, User):
+            request.id = InputUser(request.id.id, request.id.access_hash)
+        return await self._call(None, request)
+
+    async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        """
+        Serves a request like TelegramClient._call, including its flood wait check.
+        """
+        due = self._flood_waited_requests.get(request.CONSTRUCTOR_ID, 0)
+        if due > time.time():
+            wait = round(due - time.time())
+            if wait > (60 if flood_sleep_threshold is None else flood_sleep_threshold):
+                raise errors.FloodWaitError(request=request, capture=wait)
+            await asyncio.sleep(wait)
+        if isinstance(request, GetHistoryRequest):
+            self.pages += 1
+            await asyncio.sleep(self.page_latency)
+            return None
+        self.rpc_calls += 1
+        await asyncio.sleep(self.rpc_latency)
+        if isinstance(request, ResolveUsernameRequest):
+            return self._chat(request.username)
+        if isinstance(request, GetUsersRequest):
+            return [self._user(input_user.user_id) for input_user in request.id]
+        if isinstance(request, GetFullUserRequest):
+            return SimpleNamespace(full_user=SimpleNamespace(about=f"Bio of {request.id.user_id}"))
+        if isinstance(request, GetMessagesRequest):
+            return None
+        raise NotImplementedError(type(request).__name__)
+
+    def message(self, chat, message_id):
+        """
+        Deterministically builds message `message_id` of a chat's history.
+        """
+        rng = random.Random(hash((self.seed, chat.id, message_id)))
+        step = self.span / self.messages_per_chat
+        date = self.end - step * (self.messages_per_chat - message_id)
+        user_id = 1 + int(rng.paretovariate(1.2) * 7) % self.users
+        sender = self._user(user_id)
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 60)))
+        entities = [MessageEntityBold(0, 5)] if rng.random() < 0.3 else []
+        if rng.random() < 0.2:
+            entities.append(MessageEntityUrl(len(text) - 4, 4))
+
+        media = None
+        roll = rng.random()
+        if roll < 0.15:
+            media = MessageMediaPhoto(photo=Photo(
+                id=rng.getrandbits(62), access_hash=rng.getrandbits(62), file_reference=b"ref", date=date,
+                sizes=[PhotoSize(type="x", w=1280, h=720, size=rng.randint(50000, 400000))], dc_id=2,
+            ))
+        elif roll < 0.22:
+            media = MessageMediaDocument(document=Document(
+                id=rng.getrandbits(62), access_hash=rng.getrandbits(62), file_reference=b"ref", date=date,
+                mime_type="video/mp4", size=rng.randint(10 ** 6, 10 ** 8), dc_id=2,
+                attributes=[DocumentAttributeVideo(duration=rng.randint(5, 600), w=1280, h=720),
+                            DocumentAttributeFilename("clip.mp4")],
+            ))
+
+        reactions = None
+        if rng.random() < 0.6:
+            results = [ReactionCount(reaction=ReactionEmoji(e), count=rng.randint(1, 500))
+                       for e in rng.sample(EMOJIS, rng.randint(1, 4))]
+            if rng.random() < 0.1:
+                results.append(ReactionCount(reaction=ReactionCustomEmoji(rng.getrandbits(62)), count=rng.randint(1, 50)))
+            reactions = MessageReactions(results=results)
+
+        message = Message(
+            id=message_id,
+            peer_id=PeerChannel(chat.id),
+            date=date,
+            message=text,
+            from_id=PeerUser(user_id),
+            reply_to=MessageReplyHeader(reply_to_msg_id=message_id - rng.randint(1, 50)) if message_id > 50 and rng.random() < 0.25 else None,
+            media=media,
+            entities=entities,
+            views=rng.randint(100, 100000),
+            forwards=rng.randint(0, 500),
+            replies=MessageReplies(replies=rng.randint(0, 40), replies_pts=0) if rng.random() < 0.5 else None,
+            edit_date=date + timedelta(minutes=rng.randint(1, 120)) if rng.random() < 0.1 else None,
+            post_author=f"Admin {rng.randint(1, 5)}" if rng.random() < 0.2 else None,
+            grouped_id=rng.getrandbits(62) if media and rng.random() < 0.3 else None,
+            reactions=reactions,
+        )
+        message._finish_init(self, {user_id: sender}, None)
+        return message
+
+    async def iter_messages(self, chat, offset_date=None, min_id=0, reverse=False, **kwargs):
+        """
+        Yields messages newest first, honouring offset_date and min_id like Telethon.
+
+        Each page of messages is built when it is requested, as Telethon reads a
+        page from a GetHistoryRequest response; the time spent building them is
+        added to `build_seconds`.
+        """
+        if isinstance(chat, str):
+            chat = self._chat(chat)
+        step = self.span / self.messages_per_chat
+        newest = self.messages_per_chat
+        if offset_date is not None and offset_date < self.end:
+            newest = min(newest, int(self.messages_per_chat - (self.end - offset_date) / step))
+        oldest = max(min_id, 0)
+        for first in range(newest, oldest, -self.page_size):
+            await self(GetHistoryRequest(
+                peer=InputPeerChannel(chat.id, chat.access_hash), offset_id=first + 1, offset_date=None,
+                add_offset=0, limit=self.page_size, max_id=0, min_id=min_id, hash=0,
+            ))
+            start = time.perf_counter()
+            page = [self.message(chat, message_id) for message_id in range(first, max(first - self.page_size, oldest), -1)]
+            self.build_seconds += time.perf_counter() - start
+            for message in page:
+                yield message
+
+    async def get_messages(self, chat, ids=None, **kwargs):
+        """
+        Returns messages by ID like Telethon, None for the ones that do not exist.
+        """
+        if isinstance(chat, str):
+            chat = self._chat(chat)
+        await self(GetMessagesRequest(InputChannel(chat.id, chat.access_hash), [InputMessageID(i) for i in ids]))
+        start = time.perf_counter()
+        messages = [self.message(chat, message_id) if 0 < message_id <= self.messages_per_chat else None for message_id in ids]
+        self.build_seconds += time.perf_counter() - start
+        return messages
+
+
+class FakeQueryJob:
+    def __init__(self, rows=()):
+        self._rows = list(rows)
+
+    def result(self):
+        return self._rows
+
+
+class FakeBigQueryClient:
+    """
+    Accepts queries and load jobs without a network.
+
+    Queries return no rows except for the chat_config table, which returns the
+    configured chat configs. Load jobs read their payload fully (as the real client
+    would upload it) and are counted in `loads`, `rows_loaded` and `bytes_loaded`.
+    Tables have no streaming buffer.
+
+    Args:
+        chat_configs (list): Rows returned for chat_config queries.
+        load_latency (float): Seconds each load job takes.
+    """
+
+    def __init__(self, chat_configs=(), load_latency=0.0, **kwargs):
+        self.chat_configs = list(chat_configs)
+        self.load_latency = load_latency
+        self.queries = 0
+        self.loads = 0
+        self.bytes_loaded = 0
+
+    def query(self, query, job_config=None):
+        self.queries += 1
+        if "SELECT id, username" in query:
+            return FakeQueryJob(self.chat_configs)
+        return FakeQueryJob()
+
+    def dataset(self, dataset_id):
+        return SimpleNamespace(table=lambda table_id: f"{dataset_id}.{table_id}")
+
+    def get_table(self, table):
+        return SimpleNamespace(table_id=table, streaming_buffer=None)
+
+    def load_table_from_file(self, file_obj, destination, **kwargs):
+        self.bytes_loaded += len(file_obj.read())
+        self.loads += 1
+        if self.load_latency:
+            import time
+            time.sleep(self.load_latency)
+        return FakeQueryJob()
+
+
+def chat_config_rows(usernames):
+    """
+    Builds chat_config rows, without watermarks, for the given usernames.
+    """
+    return [
+        {'id': username, 'username': username, 'dates_to_load': [], 'last_message_id': None, 'last_message_date': None, 'coverage': []}
+        for username in usernames
+    ]
@@ -0,0 +1,100 @@
+"""
+Tests of the incremental contract of ChatAnalytics over a small DuckDB sink: each
+run only processes the days completed since the previous one, and every output
+file is replaced atomically.
+
+Needs the packages of requirements-local.txt and requirements-analytics.txt.
+
+Usage (from the repository root):
+
+    python -m pytest -q tests/test_analytics.py
+"""
+import asyncio
+import csv
+import os
+import sys
+from datetime import date, datetime, timezone
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+pytest.importorskip('duckdb')
+pytest.importorskip('pytz')
+pytest.importorskip('sklearn')
+
+from analytics import ChatAnalytics, STATE_FILE
+from sinks.duckdb_sink import DuckDBSink
+
+TEXTS = [
+    "bitcoin price breaks new record high today",
+    "bitcoin market rally continues as price climbs",
+    "football match tonight the team wins the final",
+    "football transfer news the striker joins the team",
+]
+
+
+def messages(day, chat_id, count, first_id=1):
+    return [
+        {
+            'id': first_id + i, 'chat_id': chat_id, 'date': datetime(2024, 5, day, 8 + i, tzinfo=timezone.utc),
+            'sender': str(100 + i % 2), 'text': TEXTS[i % len(TEXTS)] if i % 3 else None,
+        }
+        for i in range(count)
+    ]
+
+
+def read_csv(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        return list(csv.reader(f))
+
+
+def leftovers(directory):
+    return [name for _, dirs, files in os.walk(directory) for name in dirs + files if name.endswith('.tmp')]
+
+
+@pytest.fixture
+def sink(tmp_path):
+    sink = DuckDBSink(str(tmp_path / 'sink.duckdb'))
+    rows = messages(1, 1, 6) + messages(1, 2, 3) + messages(3, 1, 4, first_id=7)
+    # An edited message is only counted once, in its newest version
+    rows.append({**rows[1], 'text': 'bitcoin price edited', 'edit_date': datetime(2024, 5, 1, 23, tzinfo=timezone.utc)})
+    assert asyncio.run(sink.upload_rows('chat_history', rows))
+    yield sink
+    sink.close()
+
+
+def test_runs_only_process_the_days_completed_since_the_last_run(sink, tmp_path):
+    directory = str(tmp_path / 'analytics')
+
+    analytics = ChatAnalytics(sink, directory, n_topics=2, chunk_rows=4)
+    assert asyncio.run(analytics.run(start_date=date(2024, 5, 1), end_date=date(2024, 5, 4))) == 2
+    assert analytics.state['processed_through'] == date(2024, 5, 4)
+    assert sorted(os.listdir(os.path.join(directory, 'daily'))) == ['2024-05-01', '2024-05-03']
+    assert read_csv(os.path.join(directory, 'daily', '2024-05-01', 'frequency.csv')) == [
+        ['chat_id', 'messages', 'senders'], ['1', '6', '2'], ['2', '3', '2'],
+    ]
+    assert read_csv(os.path.join(directory, 'daily', '2024-05-03', 'frequency.csv')) == [
+        ['chat_id', 'messages', 'senders'], ['1', '4', '2'],
+    ]
+    topics = read_csv(os.path.join(directory, 'daily', '2024-05-01', 'topics.csv'))
+    assert len(topics) == 1 + 9
+    # Messages without text get no topic
+    assert [row[2] for row in topics[1:] if row[:2] == ['1', '1']] == ['-1']
+    top_terms = read_csv(os.path.join(directory, 'daily', '2024-05-01', 'top_terms.csv'))
+    assert top_terms[0] == ['chat_id', 'rank', 'term', 'count'] and ['1', '1', 'bitcoin', '3'] in top_terms
+    assert os.path.exists(os.path.join(directory, 'topics.csv')) and os.path.exists(os.path.join(directory, STATE_FILE))
+    assert leftovers(directory) == []
+
+    # A second run, from the saved state, has nothing left to do
+    analytics = ChatAnalytics(sink, directory, n_topics=2, chunk_rows=4)
+    assert analytics.state['processed_through'] == date(2024, 5, 4)
+    assert asyncio.run(analytics.run(end_date=date(2024, 5, 4))) == 0
+
+    # Messages of a new day are picked up by the next run; processed days are not read again
+    assert asyncio.run(sink.upload_rows('chat_history', messages(5, 2, 2, first_id=20) + messages(1, 3, 1)))
+    assert asyncio.run(analytics.run(end_date=date(2024, 5, 6))) == 1
+    assert analytics.state['processed_through'] == date(2024, 5, 6)
+    assert sorted(os.listdir(os.path.join(directory, 'daily'))) == ['2024-05-01', '2024-05-03', '2024-05-05']
+    assert len(read_csv(os.path.join(directory, 'daily', '2024-05-01', 'frequency.csv'))) == 3
+    assert leftovers(directory) == []
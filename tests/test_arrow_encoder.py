@@ -0,0 +1,31 @@
+"""
+Tests of the typed column buffers built by arrow_encoder.ColumnarBuffer.
+
+Usage (from the repository root):
+
+    python -m pytest -q tests/test_arrow_encoder.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import metrics
+from arrow_encoder import ColumnarBuffer
+
+
+def test_post_author_signature_is_kept():
+    buffer = ColumnarBuffer('chat_history')
+    buffer.add({'id': 1, 'post_author': 'John Smith'})
+    buffer.add({'id': 2, 'post_author': None})
+    assert buffer.to_record_batch().column('post_author').to_pylist() == ['John Smith', None]
+
+
+def test_values_that_cannot_be_coerced_are_counted():
+    metrics.registry.reset()
+    buffer = ColumnarBuffer('chat_history')
+    buffer.add({'id': 1, 'views': 'many', 'date': object()})
+    batch = buffer.to_record_batch()
+    assert batch.column('views').to_pylist() == [None]
+    assert metrics.value('coercion_failures', column='views') == 1
+    assert metrics.value('coercion_failures', column='date') == 1
@@ -0,0 +1,158 @@
+"""
+Tests of the load job configuration built by bigquery_loader.load_payload and
+of the batch and staging writers.
+
+Usage (from the repository root):
+
+    python -m pytest -q tests/test_bigquery_loader.py
+"""
+import asyncio
+import os
+import sys
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from google.cloud.bigquery import SchemaField, SourceFormat
+
+from bigquery_loader import load_payload, BigQueryBatchWriter, BigQueryOverwriteWriter
+
+
+class RecordingClient:
+    """
+    Records the job config of every load job and the text of every query instead of running them.
+    """
+
+    def __init__(self, streaming_buffer=None):
+        self.job_configs = []
+        self.queries = []
+        self.streaming_buffer = streaming_buffer
+
+    def dataset(self, dataset_id):
+        return self
+
+    def table(self, table_id):
+        return table_id
+
+    def load_table_from_file(self, file_obj, destination, job_config=None, **kwargs):
+        self.job_configs.append(job_config)
+        return self
+
+    def query(self, query, job_config=None, **kwargs):
+        self.queries.append(query)
+        return self
+
+    def get_table(self, table):
+        return SimpleNamespace(streaming_buffer=self.streaming_buffer)
+
+    def result(self):
+        return None
+
+
+def load(source_format, schema=None):
+    client = RecordingClient()
+    assert asyncio.run(load_payload(client, b'', 'dataset', 'chat_history', source_format, schema))
+    return client.job_configs[0]
+
+
+def test_parquet_loads_infer_lists():
+    schema = [SchemaField('id', 'INTEGER'), SchemaField('reaction_counts', 'RECORD', mode='REPEATED', fields=[SchemaField('count', 'INTEGER')])]
+    job_config = load(SourceFormat.PARQUET, schema)
+    assert job_config.source_format == SourceFormat.PARQUET
+    assert job_config.parquet_options.enable_list_inference is True
+    assert job_config.schema == schema
+
+
+def test_json_loads_have_no_parquet_options():
+    job_config = load(SourceFormat.NEWLINE_DELIMITED_JSON)
+    assert job_config.parquet_options is None
+    assert job_config.autodetect is True
+
+
+def overwrite(range_complete, streaming_buffer=None):
+    client = RecordingClient(streaming_buffer)
+
+    async def run():
+        writer = BigQueryOverwriteWriter(
+            client, 'dataset', 'chat_history', 42,
+            datetime(2024, 1, 1, tzinfo=timezone.utc), datetime(2024, 1, 2, tzinfo=timezone.utc), asyncio.Lock(),
+        )
+        async with writer:
+            writer.range_complete = range_complete
+
+    asyncio.run(run())
+    return client.queries
+
+
+def test_overwrite_without_rows_keeps_the_range():
+    queries = overwrite(range_complete=False)
+    assert not any('DELETE FROM' in query for query in queries)
+    assert 'DROP TABLE IF EXISTS' in queries[-1]
+
+
+def test_overwrite_of_a_complete_empty_range_clears_it():
+    queries = overwrite(range_complete=True)
+    assert any('DELETE FROM `dataset.chat_history`' in query for query in queries)
+
+
+def test_overwrite_keeps_rows_in_the_streaming_buffer():
+    buffer = SimpleNamespace(estimated_rows=10, oldest_entry_time=datetime(2024, 1, 1, 12, tzinfo=timezone.utc))
+    apply = overwrite(range_complete=True, streaming_buffer=buffer)[-1]
+    assert 'target.date < @streamed_after' in apply
+    assert 'NOT EXISTS' in apply
+
+
+def test_overwrite_without_streaming_buffer_replaces_the_whole_range():
+    apply = overwrite(range_complete=True)[-1]
+    assert '@streamed_after' not in apply
+
+
+class FullDiskSpool:
+    """
+    A spool whose disk is full.
+    """
+
+    def append(self, *args):
+        raise OSError(28, "No space left on device")
+
+
+class WorkerKilled(BaseException):
+    pass
+
+
+def write_rows(writer, count):
+    async def run():
+        async with writer:
+            for i in range(count):
+                await writer.add({'id': i})
+
+    asyncio.run(asyncio.wait_for(run(), timeout=5))
+
+
+def test_failed_chunks_are_counted_without_stopping_the_writer():
+    writer = BigQueryBatchWriter(
+        RecordingClient(), 'chat_history', 'dataset', None, 'chat_history', None, None,
+        max_rows=1, max_pending=1, workers=1, spool=FullDiskSpool(),
+    )
+    write_rows(writer, 5)
+    assert writer.rows_failed == 5
+    assert writer.rows_loaded == 0
+
+
+def test_stopped_workers_fail_the_writer_instead_of_hanging():
+    writer = BigQueryBatchWriter(
+        RecordingClient(), 'chat_history', 'dataset', None, 'chat_history', None, None,
+        max_rows=1, max_pending=1, workers=1,
+    )
+
+    async def load_chunk(payload, rows):
+        raise WorkerKilled()
+
+    writer._load_chunk = load_chunk
+    with pytest.raises(RuntimeError):
+        write_rows(writer, 5)
+    # The rows queued behind the stopped worker count as failed too
+    assert writer.rows_failed == writer.rows_added > 1
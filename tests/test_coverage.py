@@ -0,0 +1,182 @@
+"""
+Tests of the chat coverage intervals, of the date shards and of the chat_config
+MERGE that compacts coverage in BigQuery.
+
+Usage (from the repository root):
+
+    python -m pytest -q tests/test_coverage.py
+"""
+import asyncio
+import os
+import sys
+from datetime import date, datetime, time, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+
+from fakes import FakeTelegramClient
+from telegram_api.coverage import merge_intervals, add_dates, find_gaps, complete_dates, gap_ranges
+from telegram_api.chat_config import commit_chat_config_updates
+from telegram_api.chat_history import get_chat_history
+from telegram_api.data_processor import split_date_range
+from telegram_api.message_index import MessageIdIndex, DEDUP_STOP, DEDUP_SKIP
+
+
+def d(day):
+    return date(2024, 1, day)
+
+
+def dt(day, hour=0):
+    return datetime(2024, 1, day, hour, tzinfo=timezone.utc)
+
+
+def test_merge_intervals_joins_overlapping_and_adjacent_intervals():
+    assert merge_intervals([(d(5), d(6)), (d(1), d(3)), (d(2), d(4)), (d(10), d(12))]) == [(d(1), d(6)), (d(10), d(12))]
+
+
+def test_merge_intervals_keeps_contained_intervals_once():
+    assert merge_intervals([(d(1), d(10)), (d(3), d(4))]) == [(d(1), d(10))]
+
+
+def test_add_dates_fills_gaps_between_intervals():
+    assert add_dates([(d(1), d(2)), (d(4), d(5))], [d(3), d(8)]) == [(d(1), d(5)), (d(8), d(8))]
+
+
+def test_find_gaps_within_the_requested_range():
+    intervals = [(d(3), d(4)), (d(7), d(8))]
+    assert find_gaps(intervals, d(1), d(10)) == [(d(1), d(2)), (d(5), d(6)), (d(9), d(10))]
+    assert find_gaps(intervals, d(3), d(4)) == []
+    assert find_gaps([], d(1), d(2)) == [(d(1), d(2))]
+
+
+def test_find_gaps_with_intervals_overhanging_the_range():
+    assert find_gaps([(date(2023, 12, 1), d(2)), (d(9), date(2024, 2, 1))], d(1), d(10)) == [(d(3), d(8))]
+
+
+def test_complete_dates_only_counts_whole_past_days():
+    today = d(10)
+    assert complete_dates(dt(1), datetime.combine(d(3), time.max, tzinfo=timezone.utc), today) == [d(1), d(2), d(3)]
+    # Partial first and last days are not complete
+    assert complete_dates(dt(1, 12), dt(3, 12), today) == [d(2)]
+    # Nor is the current day, nor anything after it
+    assert complete_dates(dt(8), dt(12), today) == [d(8), d(9)]
+    assert complete_dates(dt(10), dt(12), today) == []
+
+
+def test_complete_dates_of_an_empty_range():
+    assert complete_dates(dt(2, 12), dt(2, 13), d(10)) == []
+
+
+def test_gap_ranges_are_clipped_and_newest_first():
+    start, end = dt(1, 6), dt(10, 18)
+    ranges = gap_ranges([(d(3), d(4)), (d(7), d(8))], start, end)
+    assert ranges == [
+        (dt(9), end),
+        (dt(5), datetime.combine(d(6), time.max, tzinfo=timezone.utc)),
+        (start, datetime.combine(d(2), time.max, tzinfo=timezone.utc)),
+    ]
+
+
+def test_split_date_range_covers_the_range_newest_first():
+    start, end = dt(1), dt(8, 12)
+    shards = split_date_range(start, end, 3)
+    assert shards[0][1] == end and shards[-1][0] == start
+    assert [shard_start for shard_start, _ in shards] == [dt(7), dt(4), dt(1)]
+    # Consecutive shards neither overlap nor leave a gap
+    for (newer_start, _), (_, older_end) in zip(shards, shards[1:]):
+        assert newer_start - older_end == timedelta(microseconds=1)
+
+
+def test_split_date_range_shorter_than_a_shard():
+    assert split_date_range(dt(1), dt(1, 12), 7) == [(dt(1), dt(1, 12))]
+
+
+class RecordingClient:
+    """
+    Records the text and job config of every query instead of running it.
+    """
+
+    def __init__(self):
+        self.queries = []
+        self.job_configs = []
+
+    def query(self, query, job_config=None, **kwargs):
+        self.queries.append(query)
+        self.job_configs.append(job_config)
+        return self
+
+    def result(self):
+        return None
+
+
+def test_commit_merges_coverage_as_gaps_and_islands():
+    client = RecordingClient()
+    updates = {
+        'chat': {'dates': {'2024-01-03', d(1)}, 'last_message_id': 7, 'last_message_date': dt(3)},
+        'other': {'dates': set(), 'last_message_id': None, 'last_message_date': None},
+    }
+    asyncio.run(commit_chat_config_updates(client, 'dataset', 'chat_config', updates))
+
+    query = client.queries[0]
+    assert 'MERGE `dataset.chat_config` AS target' in query
+    # Existing intervals are expanded to days, unioned with the new dates and regrouped into islands
+    assert 'UNNEST(GENERATE_DATE_ARRAY(covered.start_date, covered.end_date))' in query
+    assert 'SELECT DISTINCT day' in query
+    assert 'DATE_SUB(day, INTERVAL ROW_NUMBER() OVER (ORDER BY day) DAY) AS island' in query
+    assert 'GROUP BY island' in query
+    assert 'ORDER BY start_date' in query
+    # The watermark only moves forward
+    assert 'IF(source.last_message_id > IFNULL(target.last_message_id, -1)' in query
+
+    chat, other = client.job_configs[0].query_parameters[0].values
+    assert chat.struct_values['id'] == 'chat'
+    assert chat.struct_values['dates'].values == [d(1), d(3)]
+    assert chat.struct_values['last_message_id'] == 7
+    assert other.struct_values['dates'].values == []
+    assert other.struct_values['last_message_id'] is None
+
+
+class RecordingWriter:
+    def __init__(self):
+        self.rows = []
+
+    async def add(self, row):
+        self.rows.append(row)
+
+
+class LoadedIdsSink:
+    def __init__(self, message_ids):
+        self.message_ids = message_ids
+
+    async def load_message_index(self, chat_id, start_date, end_date, min_id=0):
+        return MessageIdIndex(self.message_ids)
+
+
+def scan(dedup_strategy, loaded_ids, span=timedelta(days=10)):
+    client = FakeTelegramClient(messages_per_chat=100, users=5, span=span)
+    chat = client._chat('chat')
+    writer = RecordingWriter()
+    start_date = client.end - timedelta(days=5)
+    asyncio.run(get_chat_history(client, chat, start_date, client.end, LoadedIdsSink(loaded_ids), dedup_strategy=dedup_strategy, writer=writer))
+    return client, chat, writer, start_date
+
+
+def test_a_stopped_scan_only_covers_the_dates_it_reached():
+    client, chat, writer, _ = scan(DEDUP_STOP, [80])
+    assert len(writer.rows) == 20
+    assert writer.scanned_from == client.message(chat, 80).date
+    assert writer.range_complete is False
+
+
+def test_a_scan_reaching_the_start_date_covers_the_range():
+    _, _, writer, start_date = scan(DEDUP_SKIP, [80])
+    assert writer.scanned_from == start_date
+    assert writer.range_complete is True
+
+
+def test_a_scan_reaching_the_end_of_the_history_covers_the_range():
+    # The whole history is newer than the start date
+    _, _, writer, start_date = scan(DEDUP_STOP, [], span=timedelta(days=2))
+    assert len(writer.rows) == 100
+    assert writer.scanned_from == start_date
+    assert writer.range_complete is True
@@ -0,0 +1,166 @@
+"""
+Tests of the Telegram Desktop export parsing of desktop_export, against the
+single-chat and full account exports in tests/fixtures/desktop_export.
+
+Usage (from the repository root):
+
+    python -m pytest -q tests/test_desktop_export.py
+"""
+import os
+import sys
+from datetime import datetime, timezone
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from telethon.extensions import markdown
+from telethon.tl.types import MessageEntityBold, MessageEntityCode, MessageEntityPre, MessageEntityTextUrl
+
+from telegram_api.desktop_export import (
+    iter_export_chats, _peer_id, message_date, export_text, export_message_row, export_user_info, export_chat_info,
+)
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'desktop_export')
+SINGLE_CHAT = os.path.join(FIXTURES, 'single_chat', 'result.json')
+FULL_ACCOUNT = os.path.join(FIXTURES, 'full_account', 'result.json')
+
+
+def read_export(path):
+    return [(chat, list(messages)) for chat, messages in iter_export_chats(path)]
+
+
+def test_single_chat_exports_are_one_chat():
+    (chat, messages), = read_export(SINGLE_CHAT)
+    assert chat == {'name': 'Test Channel', 'type': 'public_channel', 'id': 1234567}
+    assert [message['id'] for message in messages] == [1, 2, 3]
+    assert messages[1]['text_entities'][1] == {'type': 'bold', 'text': 'world'}
+
+
+def test_full_account_exports_list_chats_and_left_chats():
+    chats = read_export(FULL_ACCOUNT)
+    # personal_information and contacts are not chats
+    assert [chat['name'] for chat, _ in chats] == ['Test Group', 'Bob', 'Old Channel']
+    assert [[message['id'] for message in messages] for _, messages in chats] == [[10, 11], [1], [5]]
+
+
+def test_unconsumed_messages_are_skipped():
+    chats = []
+    for chat, messages in iter_export_chats(FULL_ACCOUNT):
+        if chat['id'] == 5550001:
+            # Only the first message of this chat is read
+            next(messages)
+        chats.append(chat['id'])
+    assert chats == [5550001, 77, 8880001]
+
+
+def test_peer_ids_are_marked():
+    assert _peer_id('user42') == 42
+    assert _peer_id('channel1234567') == -1001234567
+    assert _peer_id('chat99') == -99
+    assert _peer_id('bot1') is None
+    assert _peer_id(None) is None
+
+
+def test_unixtime_fields_take_precedence_over_local_dates():
+    (_, messages), = read_export(SINGLE_CHAT)
+    # The plain dates are in the exporting machine's time zone
+    assert message_date(messages[1]) == datetime(2024, 1, 1, 12, tzinfo=timezone.utc)
+    assert message_date(messages[1], 'edited') == datetime(2024, 1, 1, 12, 5, tzinfo=timezone.utc)
+    # Older exports only have the plain dates
+    assert message_date(messages[2]) == datetime(2024, 1, 2, 9, 30, tzinfo=timezone.utc)
+    assert message_date(messages[2], 'edited') is None
+
+
+def test_export_rows():
+    (chat, messages), = read_export(SINGLE_CHAT)
+    rows = [export_message_row(message, str(chat['id'])) for message in messages]
+
+    assert rows[0]['action_type'] == 'channel_create'
+    assert rows[0]['sender'] == '-1001234567' and rows[0]['from_user'] is None
+
+    assert rows[1] == {
+        'id': 2,
+        'date': '2024-01-01 12:00:00 +0000',
+        'from_user': '42',
+        'text': 'Hello **world**, see [the docs](https://example.com)',
+        'sender': '42',
+        'chat_id': '1234567',
+        'is_reply': False,
+        'views': 0,
+        'forwards': 0,
+        'replies': 0,
+        'mentioned': False,
+        'post_author': 'Alice A.',
+        'edit_date': datetime(2024, 1, 1, 12, 5, tzinfo=timezone.utc).timestamp(),
+        'via_bot': 0,
+        'reply_to_msg_id': 0,
+        'grouped_id': 0,
+        'media_type': None,
+        'media_file_id': None,
+        'media_size': None,
+        'media_mime_type': None,
+        'media_duration': None,
+        'reaction_counts': [{'emoji': '👍', 'count': 3}, {'emoji': 'CustomEmoji:5368324170671202286', 'count': 1}],
+        'button_types': [],
+        'action_type': None,
+    }
+
+    assert rows[2]['is_reply'] is True and rows[2]['reply_to_msg_id'] == 2
+    assert (rows[2]['media_type'], rows[2]['media_size'], rows[2]['media_mime_type']) == ('photo', 48213, 'image/jpeg')
+    assert rows[2]['post_author'] is None
+
+
+def test_full_account_export_rows():
+    chats = read_export(FULL_ACCOUNT)
+    group, group_messages = chats[0]
+    document, code = [export_message_row(message, str(group['id'])) for message in group_messages]
+    assert (document['media_type'], document['media_size'], document['media_mime_type']) == ('document', 20480, 'application/pdf')
+    assert code['text'] == '```print(1)```'
+    left, left_messages = chats[2]
+    assert export_message_row(left_messages[0], str(left['id']))['action_type'] == 'pin_message'
+
+    assert export_chat_info(group) == {'id': '5550001', 'name': 'Test Group', 'username': '', 'description': '', 'members_count': 0, 'source': 'export'}
+    user_info = export_user_info(group_messages[0])
+    assert user_info['id'] == '77' and user_info['first_name'] == 'Bob' and user_info['source'] == 'export'
+    assert export_user_info(left_messages[0]) is None
+
+
+def telethon_entities(parts):
+    """
+    Builds the text and Telethon entities equivalent to the text parts of an export message.
+    """
+    entity_types = {'bold': MessageEntityBold, 'code': MessageEntityCode}
+    text = ''
+    entities = []
+    for part in parts:
+        offset = len(text.encode('utf-16-le')) // 2
+        length = len(part['text'].encode('utf-16-le')) // 2
+        if part['type'] in entity_types:
+            entities.append(entity_types[part['type']](offset, length))
+        elif part['type'] == 'pre':
+            entities.append(MessageEntityPre(offset, length, language=part.get('language', '')))
+        elif part['type'] == 'text_link':
+            entities.append(MessageEntityTextUrl(offset, length, url=part['href']))
+        text += part['text']
+    return text, entities
+
+
+EXPORT_TEXT_CASES = {
+    'plain': [{'type': 'plain', 'text': 'just text'}],
+    'adjacent': [{'type': 'bold', 'text': 'bold'}, {'type': 'code', 'text': 'code'}, {'type': 'plain', 'text': ' end'}],
+    'pre with language': [{'type': 'plain', 'text': 'run:\n'}, {'type': 'pre', 'text': 'print(1)', 'language': 'python'}],
+    'link': [{'type': 'text_link', 'text': 'docs', 'href': 'https://example.com'}, {'type': 'plain', 'text': ' *not bold*'}],
+    'non-BMP': [{'type': 'plain', 'text': '😀 '}, {'type': 'bold', 'text': '🎉 party'}, {'type': 'plain', 'text': ' 👍'}],
+}
+
+
+@pytest.mark.parametrize('parts', EXPORT_TEXT_CASES.values(), ids=EXPORT_TEXT_CASES.keys())
+def test_export_text_matches_telethon(parts):
+    assert export_text({'text_entities': parts}) == markdown.unparse(*telethon_entities(parts))
+
+
+def test_export_text_without_entities():
+    assert export_text({'text': 'plain'}) == 'plain'
+    assert export_text({'text': ['a ', {'type': 'italic', 'text': 'b'}]}) == 'a __b__'
+    assert export_text({}) == ''
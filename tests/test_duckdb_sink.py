@@ -0,0 +1,162 @@
+"""
+Tests of the local DuckDB sink: chat configuration, dedup lookups and the
+staging writers that overwrite and update chat_history.
+
+Needs the packages of requirements-local.txt; no credentials or network.
+
+Usage (from the repository root):
+
+    python -m pytest -q tests/test_duckdb_sink.py
+"""
+import asyncio
+import os
+import sys
+from datetime import date, datetime, timezone
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+pytest.importorskip('duckdb')
+pytest.importorskip('pytz')
+
+from sinks.duckdb_sink import DuckDBSink
+
+CHAT_ID = -1001
+
+
+def at(day, hour=12):
+    return datetime(2024, 5, day, hour, tzinfo=timezone.utc)
+
+
+def message(message_id, day, **fields):
+    return {'id': message_id, 'chat_id': CHAT_ID, 'date': at(day), 'text': f"message {message_id}", **fields}
+
+
+@pytest.fixture
+def sink(tmp_path):
+    sink = DuckDBSink(str(tmp_path / 'sink.duckdb'))
+    yield sink
+    sink.close()
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def history(sink, columns='id, text, views'):
+    return sink._execute(f"SELECT {columns} FROM chat_history ORDER BY id")
+
+
+async def write(writer, rows):
+    async with writer:
+        for row in rows:
+            await writer.add(row)
+    return writer
+
+
+def test_chat_config_coverage_and_forward_only_watermark(sink):
+    run(sink.ensure_chat_configs(['some_chat']))
+    run(sink.ensure_chat_configs(['some_chat']))
+    config = run(sink.get_chat_configs())['some_chat']
+    assert config['coverage'] == [] and config['last_message_id'] is None
+
+    run(sink.update_processed_dates('some_chat', [date(2024, 5, 1), '2024-05-02', date(2024, 5, 4)]))
+    run(sink.update_processed_dates('some_chat', [date(2024, 5, 3)]))
+    run(sink.update_watermark('some_chat', 100, at(2)))
+    run(sink.update_watermark('some_chat', 90, at(1)))
+
+    configs = run(sink.get_chat_configs())
+    assert list(configs) == ['some_chat']
+    config = configs['some_chat']
+    assert config['coverage'] == [(date(2024, 5, 1), date(2024, 5, 4))]
+    assert config['last_message_id'] == 100
+    assert config['last_message_date'] == at(2)
+
+
+def test_message_index_is_limited_to_the_window_and_above_min_id(sink):
+    rows = [message(1, 1), message(2, 2), message(3, 2), message(4, 5)]
+    rows.append({**message(5, 2), 'chat_id': CHAT_ID - 1})
+    assert run(sink.upload_rows('chat_history', rows))
+
+    index = run(sink.load_message_index(CHAT_ID, at(2, 0), at(3, 0)))
+    assert len(index) == 2 and 2 in index and 3 in index and 5 not in index
+    index = run(sink.load_message_index(CHAT_ID, at(1, 0), at(6, 0), min_id=2))
+    assert len(index) == 2 and (index.min_id, index.max_id) == (3, 4)
+
+
+def test_overwrite_writer_swaps_the_range(sink):
+    assert run(sink.upload_rows('chat_history', [message(1, 1), message(2, 2), message(3, 3), message(4, 4)]))
+
+    writer = sink.overwrite_writer(CHAT_ID, at(2, 0), at(3, 23), 2, float('inf'))
+    run(write(writer, [message(3, 3, text='edited'), message(5, 3)]))
+
+    assert writer.rows_loaded == 2 and writer.rows_failed == 0
+    # Message 2 is gone from the range, messages outside it are untouched
+    assert [row[:2] for row in history(sink)] == [(1, 'message 1'), (3, 'edited'), (4, 'message 4'), (5, 'message 5')]
+    assert not sink._execute("SELECT table_name FROM information_schema.tables WHERE table_name LIKE 'chat_history_staging%'")
+
+
+def test_overwrite_writer_keeps_the_range_when_nothing_was_fetched(sink):
+    assert run(sink.upload_rows('chat_history', [message(1, 1), message(2, 2)]))
+
+    run(write(sink.overwrite_writer(CHAT_ID, at(1, 0), at(2, 23), 10, float('inf')), []))
+    assert [row[0] for row in history(sink)] == [1, 2]
+
+    # A scan that reached the start of the range proves it is empty
+    writer = sink.overwrite_writer(CHAT_ID, at(1, 0), at(2, 23), 10, float('inf'))
+    writer.range_complete = True
+    run(write(writer, []))
+    assert history(sink) == []
+
+
+def test_overwrite_writer_applies_nothing_when_the_block_raises(sink):
+    assert run(sink.upload_rows('chat_history', [message(1, 1)]))
+
+    async def interrupted():
+        async with sink.overwrite_writer(CHAT_ID, at(1, 0), at(1, 23), 10, float('inf')) as writer:
+            await writer.add(message(2, 1))
+            raise RuntimeError('fetch failed')
+
+    with pytest.raises(RuntimeError):
+        run(interrupted())
+    assert [row[0] for row in history(sink)] == [1]
+
+
+def test_merge_writer_updates_only_the_given_columns_of_matching_rows(sink):
+    assert run(sink.upload_rows('chat_history', [message(1, 1, views=10), message(2, 2, views=20)]))
+
+    writer = sink.merge_writer(['views'], at(1, 0), at(3, 0), 10, float('inf'))
+    run(write(writer, [
+        message(1, 1, views=15, text='not merged'),
+        # No stored message matches these
+        message(2, 3, views=99),
+        message(7, 1, views=70),
+    ]))
+
+    assert writer.rows_loaded == 3 and writer.rows_failed == 0
+    assert history(sink) == [(1, 'message 1', 15), (2, 'message 2', 20)]
+
+
+def test_integer_post_author_is_retyped_on_open(tmp_path):
+    import duckdb
+
+    path = str(tmp_path / 'old.duckdb')
+    conn = duckdb.connect(path)
+    conn.execute("CREATE TABLE chat_history (id BIGINT, chat_id BIGINT, post_author BIGINT)")
+    conn.execute("INSERT INTO chat_history VALUES (1, ?, 0)", [CHAT_ID])
+    conn.close()
+
+    sink = DuckDBSink(path)
+    try:
+        column_type = sink._execute(
+            "SELECT data_type FROM information_schema.columns WHERE table_name = 'chat_history' AND column_name = 'post_author'"
+        )
+        assert column_type == [('VARCHAR',)]
+        assert run(sink.upload_rows('chat_history', [message(2, 1, post_author='John Smith')]))
+        assert history(sink, 'id, post_author') == [(1, None), (2, 'John Smith')]
+    finally:
+        sink.close()
+
+    # Reopening a retyped database leaves it alone
+    DuckDBSink(path).close()
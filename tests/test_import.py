@@ -0,0 +1,113 @@
+"""
+Tests of the users and chats of an import: the placeholder rows built from a
+Telegram Desktop export must not stop a later Telegram fetch from loading the
+real profiles.
+
+Runs the fixture exports and the synthetic channel of the benchmark fakes into a
+local DuckDB sink; needs the packages of requirements-local.txt.
+
+Usage (from the repository root):
+
+    python -m pytest -q tests/test_import.py
+"""
+import asyncio
+import os
+import sys
+from datetime import timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+
+pytest.importorskip('duckdb')
+pytest.importorskip('pytz')
+
+from telethon.tl.types import PeerUser
+
+from fakes import FakeTelegramClient
+from sinks.duckdb_sink import DuckDBSink
+from telegram_api.data_processor import DataProcessor
+
+SINGLE_CHAT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'desktop_export', 'single_chat', 'result.json')
+# The sender of the fixture export's messages, 'Alice'
+SENDER = 42
+EXPORTED_CHAT = '1234567'
+
+
+class OneSenderTelegramClient(FakeTelegramClient):
+    """
+    Serves the synthetic channel with every message sent by SENDER.
+    """
+
+    def message(self, chat, message_id):
+        message = super().message(chat, message_id)
+        message.from_id = PeerUser(SENDER)
+        message._finish_init(self, {SENDER: self._user(SENDER)}, None)
+        return message
+
+
+def user_rows(sink, user_id):
+    return sink._execute("SELECT first_name, username, bio, source FROM user_info WHERE id = ? ORDER BY source NULLS FIRST", [user_id])
+
+
+def test_a_telegram_fetch_after_an_import_loads_the_real_profile(tmp_path):
+    sink = DuckDBSink(str(tmp_path / 'sink.duckdb'))
+    client = OneSenderTelegramClient(messages_per_chat=20, span=timedelta(days=2))
+    known_ids_dir = str(tmp_path / 'known_ids')
+
+    async def run():
+        processor = DataProcessor(client, sink, known_ids_dir=known_ids_dir)
+        await processor.initialize()
+        assert await processor.import_export(SINGLE_CHAT)
+        await processor.upload_new_data()
+        assert user_rows(sink, SENDER) == [('Alice', None, None, 'export')]
+        assert str(SENDER) not in processor.existing_users and EXPORTED_CHAT not in processor.existing_chats
+
+        # A second import in the same run loads no placeholder twice
+        assert await processor.import_export(SINGLE_CHAT)
+        await processor.upload_new_data()
+        assert len(user_rows(sink, SENDER)) == 1
+        assert sink._execute("SELECT COUNT(*) FROM chat_info WHERE id = ?", [int(EXPORTED_CHAT)]) == [(1,)]
+
+        # The same run then fetches the sender from Telegram
+        await sink.ensure_chat_configs(['some_channel'])
+        chat_config = (await sink.get_chat_configs())['some_channel']
+        assert await processor.process_chat('some_channel', client.end - client.span, client.end, chat_config)
+        await processor.upload_new_data()
+        assert user_rows(sink, SENDER) == [('User42', 'user42', 'Bio of 42', None), ('Alice', None, None, 'export')]
+
+        # Later runs know the fetched profile, but not the chat only seen in the export
+        processor = DataProcessor(client, sink, known_ids_dir=known_ids_dir)
+        await processor.initialize()
+        assert str(SENDER) in processor.existing_users
+        assert EXPORTED_CHAT not in processor.existing_chats
+
+    try:
+        asyncio.run(run())
+    finally:
+        sink.close()
+
+
+def test_placeholders_are_not_known_to_later_runs(tmp_path):
+    sink = DuckDBSink(str(tmp_path / 'sink.duckdb'))
+    client = OneSenderTelegramClient(messages_per_chat=20, span=timedelta(days=2))
+
+    async def run():
+        processor = DataProcessor(None, sink)
+        await processor.initialize()
+        assert await processor.import_export(SINGLE_CHAT)
+        await processor.upload_new_data()
+
+        processor = DataProcessor(client, sink)
+        await processor.initialize()
+        assert len(processor.existing_users) == 0 and len(processor.existing_chats) == 0
+        await sink.ensure_chat_configs(['some_channel'])
+        chat_config = (await sink.get_chat_configs())['some_channel']
+        assert await processor.process_chat('some_channel', client.end - client.span, client.end, chat_config)
+        assert processor.new_users[str(SENDER)]['username'] == 'user42'
+
+    try:
+        asyncio.run(run())
+    finally:
+        sink.close()
@@ -0,0 +1,157 @@
+"""
+Tests of KnownIdIndex: its snapshot file, the deltas read since the snapshot and
+the merge of the IDs added during a run.
+
+Usage (from the repository root):
+
+    python -m pytest -q tests/test_known_ids.py
+"""
+import asyncio
+import json
+import os
+import sys
+from array import array
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import telegram_api.known_ids as known_ids
+from telegram_api.known_ids import KnownIdIndex, SNAPSHOT_OVERLAP, SNAPSHOT_VERSION
+
+
+class FakeSink:
+    """
+    Serves a dimension table's IDs, all of them or the ones in `delta` when asked for the IDs added since a time.
+    """
+
+    name = 'fake'
+
+    def __init__(self, ids, delta=None):
+        self.ids = ids
+        self.delta = delta
+        self.calls = []
+
+    def table_id(self, table_type):
+        return f"dataset.{table_type}"
+
+    async def get_existing_ids(self, table_type, since=None):
+        self.calls.append(since)
+        if since is None:
+            return array('q', self.ids)
+        return None if self.delta is None else array('q', self.delta)
+
+
+def refresh(index, sink):
+    return asyncio.run(index.refresh(sink, 'user_info'))
+
+
+def read_snapshot(path):
+    with open(path, 'rb') as f:
+        header = json.loads(f.readline())
+        ids = array('q')
+        ids.frombytes(f.read())
+    return header, ids
+
+
+def rewrite_header(path, **changes):
+    header, ids = read_snapshot(path)
+    header.update(changes)
+    with open(path, 'wb') as f:
+        f.write(json.dumps(header).encode('utf-8') + b'\n')
+        ids.tofile(f)
+
+
+def test_first_refresh_reads_the_table_and_saves_a_snapshot(tmp_path):
+    path = str(tmp_path / 'known' / 'user_info.ids')
+    started = datetime.now(timezone.utc)
+    index = KnownIdIndex(path)
+    assert refresh(index, FakeSink([5, 3, 5, 1])) == 4
+    assert len(index) == 3 and 3 in index and '5' in index and 2 not in index
+
+    header, ids = read_snapshot(path)
+    assert header['version'] == SNAPSHOT_VERSION
+    assert header['source'] == 'fake:dataset.user_info'
+    assert header['count'] == 3 and list(ids) == [1, 3, 5]
+    # The next delta starts before this refresh, to catch rows that were still in flight
+    since = datetime.fromisoformat(header['since'])
+    assert started - SNAPSHOT_OVERLAP <= since <= datetime.now(timezone.utc) - SNAPSHOT_OVERLAP
+    assert not os.path.exists(f"{path}.tmp")
+
+
+def test_next_refresh_only_reads_the_delta_since_the_snapshot(tmp_path):
+    path = str(tmp_path / 'user_info.ids')
+    refresh(KnownIdIndex(path), FakeSink([1, 3, 5]))
+    since = datetime.fromisoformat(read_snapshot(path)[0]['since'])
+
+    # The overlap returns IDs of the snapshot again
+    sink = FakeSink([1, 3, 5, 4, 9], delta=[5, 4, 9, 9])
+    index = KnownIdIndex(path)
+    assert refresh(index, sink) == 4
+    assert sink.calls == [since]
+    assert len(index) == 5 and all(i in index for i in (1, 3, 4, 5, 9))
+    assert list(read_snapshot(path)[1]) == [1, 3, 4, 5, 9]
+
+
+def test_sinks_without_deltas_fall_back_to_a_full_scan(tmp_path):
+    path = str(tmp_path / 'user_info.ids')
+    refresh(KnownIdIndex(path), FakeSink([1, 3, 5]))
+
+    sink = FakeSink([1, 7])
+    index = KnownIdIndex(path)
+    refresh(index, sink)
+    assert sink.calls[0] is not None and sink.calls[1] is None
+    # The table replaces the snapshot
+    assert 3 not in index and 7 in index
+
+
+def test_snapshots_past_the_maximum_age_are_rebuilt(tmp_path):
+    path = str(tmp_path / 'user_info.ids')
+    refresh(KnownIdIndex(path), FakeSink([1, 3, 5]))
+    old = datetime.now(timezone.utc) - known_ids.MAX_DELTA_AGE - timedelta(minutes=1)
+    rewrite_header(path, since=old.isoformat())
+
+    sink = FakeSink([1, 7], delta=[8])
+    index = KnownIdIndex(path)
+    refresh(index, sink)
+    assert sink.calls == [None]
+    assert list(read_snapshot(path)[1]) == [1, 7]
+
+
+def test_snapshots_of_another_version_table_or_size_are_rebuilt(tmp_path):
+    path = str(tmp_path / 'user_info.ids')
+    for changes in ({'version': SNAPSHOT_VERSION + 1}, {'source': 'fake:dataset.chat_info'}, {'count': 4}):
+        refresh(KnownIdIndex(path), FakeSink([1, 3, 5]))
+        rewrite_header(path, **changes)
+        sink = FakeSink([1, 3, 5], delta=[8])
+        refresh(KnownIdIndex(path), sink)
+        assert sink.calls == [None], changes
+
+
+def test_unreadable_snapshots_are_rebuilt(tmp_path):
+    path = tmp_path / 'user_info.ids'
+    path.write_bytes(b'not json\n')
+    sink = FakeSink([2])
+    index = KnownIdIndex(str(path))
+    refresh(index, sink)
+    assert sink.calls == [None] and 2 in index
+
+
+def test_added_ids_are_merged_into_the_sorted_array(monkeypatch):
+    monkeypatch.setattr(known_ids, 'MERGE_THRESHOLD', 3)
+    index = KnownIdIndex()
+    refresh(index, FakeSink([10, 20, 30]))
+    index.update(['20', 25, 5])
+    # Held in a set below the threshold
+    assert len(index._added) == 2 and 25 in index and '5' in index
+    index.update([-1, 40, 35])
+    # Merged into the array once the threshold is reached
+    assert index._added == set()
+    assert list(index._ids) == [-1, 5, 10, 20, 25, 30, 35, 40]
+    assert 'abc' not in index and None not in index
+
+
+def test_ids_added_during_the_run_survive_a_full_scan():
+    index = KnownIdIndex()
+    index.add(99)
+    refresh(index, FakeSink([1, 2]))
+    assert list(index._ids) == [1, 2, 99]
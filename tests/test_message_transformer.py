@@ -0,0 +1,161 @@
+"""
+Tests of the message text rendering of MessageTransformer against Telethon's markdown
+parse mode, of the legacy repr and date columns against Telethon's str() and strftime,
+and of the reaction columns.
+
+Usage (from the repository root):
+
+    python -m pytest -q tests/test_message_transformer.py
+"""
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+
+from telethon.extensions import markdown
+from telethon.tl.types import (
+    Document, DocumentAttributeAudio, DocumentAttributeFilename, GeoPoint, MessageActionChatAddUser,
+    MessageActionPhoneCall, MessageActionPinMessage, MessageActionTopicCreate,
+    MessageEntityBold, MessageEntityCode, MessageEntityItalic, MessageEntityMentionName, MessageEntityPre,
+    MessageEntityStrike, MessageEntityTextUrl, MessageEntityUrl, MessageMediaContact, MessageMediaDice,
+    MessageMediaDocument, MessageMediaEmpty, MessageMediaGeo, MessageMediaPhoto, MessageMediaPoll, MessageMediaWebPage,
+    MessageReactions, PeerUser, PhoneCallDiscardReasonMissed, Photo, PhotoSize, PhotoStrippedSize, Poll, PollAnswer,
+    PollAnswerVoters, PollResults, ReactionCount, ReactionCustomEmoji, ReactionEmoji, ReactionPaid, TextWithEntities,
+    WebPage,
+)
+
+from fakes import FakeTelegramClient
+from telegram_api.message_transformer import (
+    MessageTransformer, unparse_markdown, reaction_emoji, reaction_counts, format_reactions, tl_repr,
+)
+
+DATE = datetime(2024, 2, 29, 23, 59, 7, 250000, tzinfo=timezone.utc)
+PHOTO = Photo(
+    id=1, access_hash=-2, file_reference=b"\x00ref'", date=DATE, dc_id=4,
+    sizes=[PhotoStrippedSize(type='i', bytes=b'\xff'), PhotoSize(type='x', w=1280, h=720, size=227090)],
+)
+
+REPR_CASES = {
+    'photo': MessageMediaPhoto(photo=PHOTO, spoiler=True),
+    # Unset vectors (thumbs, video_thumbs) are rendered as []
+    'document': MessageMediaDocument(document=Document(
+        id=3, access_hash=4, file_reference=b'', date=None, mime_type='audio/ogg', size=10 ** 9, dc_id=2,
+        attributes=[DocumentAttributeAudio(duration=61, voice=True, waveform=b'\x01\x02'), DocumentAttributeFilename("a 'quoted' name.ogg")],
+    ), voice=True),
+    'document with thumbs': MessageMediaDocument(document=Document(
+        id=3, access_hash=4, file_reference=b'', date=DATE, mime_type='video/mp4', size=1, dc_id=2,
+        attributes=[], thumbs=[PhotoSize(type='m', w=320, h=180, size=1000)], video_thumbs=[],
+    )),
+    'web page': MessageMediaWebPage(webpage=WebPage(
+        id=5, url='https://example.com/\u00e9', display_url='example.com', hash=0, title='Ünïcödé 😀\n"title"', photo=PHOTO,
+    )),
+    'poll': MessageMediaPoll(
+        poll=Poll(id=6, question=TextWithEntities('Which?', [MessageEntityBold(0, 5)]), hash=0, answers=[
+            PollAnswer(text=TextWithEntities('Yes', []), option=b'0'), PollAnswer(text=TextWithEntities('No', []), option=b'1'),
+        ], close_date=DATE),
+        results=PollResults(results=[PollAnswerVoters(option=b'0', voters=3, chosen=True)], total_voters=3, recent_voters=[PeerUser(7)]),
+    ),
+    'geo': MessageMediaGeo(geo=GeoPoint(long=13.4, lat=-52.5, access_hash=0, accuracy_radius=None)),
+    'contact': MessageMediaContact(phone_number='+100', first_name='A', last_name='', vcard='', user_id=8),
+    'dice': MessageMediaDice(value=6, emoticon='🎲'),
+    'empty': MessageMediaEmpty(),
+    'add user': MessageActionChatAddUser(users=[1, 2, 3]),
+    'phone call': MessageActionPhoneCall(call_id=9, reason=PhoneCallDiscardReasonMissed(), duration=None),
+    'pin': MessageActionPinMessage(),
+    'topic': MessageActionTopicCreate(title='Topic', icon_color=0xFFD67E, icon_emoji_id=None),
+}
+
+UNPARSE_CASES = {
+    'plain': ("Hello world", [MessageEntityBold(0, 5)]),
+    'nested': ("Hello brave world", [MessageEntityBold(0, 17), MessageEntityItalic(6, 5), MessageEntityCode(7, 2)]),
+    'same span': ("Hello", [MessageEntityBold(0, 5), MessageEntityItalic(0, 5), MessageEntityStrike(0, 5)]),
+    'adjacent': ("HelloWorld!", [MessageEntityBold(0, 5), MessageEntityItalic(5, 5), MessageEntityCode(10, 1)]),
+    'unsorted': ("one two three", [MessageEntityCode(8, 5), MessageEntityBold(0, 3), MessageEntityItalic(4, 3)]),
+    'empty entity': ("abc", [MessageEntityBold(1, 0)]),
+    'whole text': ("abc", [MessageEntityItalic(0, 3)]),
+    'links': ("see docs and @user", [MessageEntityTextUrl(4, 4, url='https://example.com'), MessageEntityMentionName(13, 5, user_id=42)]),
+    'pre with language': ("x = 1\nprint(x)", [MessageEntityPre(0, 14, language='python')]),
+    'unrendered types': ("visit https://example.com", [MessageEntityUrl(6, 19), MessageEntityBold(0, 5)]),
+    'only unrendered types': ("visit https://example.com 😀", [MessageEntityUrl(6, 19)]),
+    'non-BMP before': ("😀 hi there", [MessageEntityBold(3, 2)]),
+    'non-BMP inside': ("a😀b😀c", [MessageEntityBold(0, 7), MessageEntityItalic(1, 2), MessageEntityCode(4, 2)]),
+    'non-BMP adjacent': ("😀😀😀", [MessageEntityBold(0, 2), MessageEntityItalic(2, 2), MessageEntityStrike(4, 2)]),
+    'non-BMP nested': ("👍🏽 great 🎉 news", [MessageEntityBold(0, 16), MessageEntityItalic(5, 5), MessageEntityTextUrl(11, 2, url='https://example.com')]),
+    'non-BMP with BMP emoji': ("❤ and 𝒜𝒷𝒸", [MessageEntityBold(0, 1), MessageEntityItalic(6, 6)]),
+    # Offsets splitting a surrogate pair are moved after it
+    'split surrogate': ("a😀b", [MessageEntityBold(0, 2), MessageEntityItalic(2, 2)]),
+}
+
+
+@pytest.mark.parametrize('text, entities', UNPARSE_CASES.values(), ids=UNPARSE_CASES.keys())
+def test_unparse_markdown_matches_telethon(text, entities):
+    assert unparse_markdown(text, entities) == markdown.unparse(text, entities)
+
+
+def test_unparse_markdown_without_entities():
+    assert unparse_markdown("😀 text", []) == "😀 text"
+    assert unparse_markdown("", [MessageEntityBold(0, 1)]) == ""
+    assert unparse_markdown(None, None) is None
+
+
+@pytest.mark.parametrize('obj', REPR_CASES.values(), ids=REPR_CASES.keys())
+def test_tl_repr_matches_telethon(obj):
+    # Twice, the second time from the layout recorded for the class
+    assert tl_repr(obj) == str(obj)
+    assert tl_repr(obj) == str(obj)
+
+
+def test_tl_repr_renders_each_object_from_its_own_attributes():
+    first = MessageActionChatAddUser(users=[1])
+    second = MessageActionChatAddUser(users=None)
+    assert tl_repr(first) == str(first) and tl_repr(second) == str(second) == 'MessageActionChatAddUser(users=[])'
+
+
+def test_format_date_matches_strftime():
+    transformer = MessageTransformer(FakeTelegramClient())
+    dates = [DATE + timedelta(seconds=seconds) for seconds in (0, 1, 52, 53, 3600, 86400 * 400)]
+    dates.append(datetime(1999, 12, 31, 0, 0, 0, tzinfo=timezone.utc))
+    dates.append(datetime(2024, 6, 1, 12, 30, 0, tzinfo=timezone(timedelta(hours=2))))
+    for date in dates:
+        assert transformer.format_date(date) == date.strftime('%Y-%m-%d %H:%M:%S %z')
+
+
+def test_legacy_columns_match_telethon():
+    client = FakeTelegramClient(messages_per_chat=500)
+    chat = client._chat('some_channel')
+    transformer = MessageTransformer(client, legacy_columns=True)
+    for message_id in range(1, 501):
+        message = client.message(chat, message_id)
+        row = transformer.transform(message)
+        assert row['text'] == message.text
+        assert row['date'] == message.date.strftime('%Y-%m-%d %H:%M:%S %z')
+        assert row['media'] == (str(message.media) if message.media else None)
+        assert row['reactions'] == format_reactions(message.reactions)
+        assert (row['from_user'], row['sender']) == (str(message.from_id.user_id), str(message.sender_id))
+
+
+def test_reaction_emoji():
+    assert reaction_emoji(ReactionEmoji(emoticon='👍')) == '👍'
+    assert reaction_emoji(ReactionCustomEmoji(document_id=5368324170671202286)) == 'CustomEmoji:5368324170671202286'
+    assert reaction_emoji(ReactionPaid()) == 'UnknownEmoji'
+    # Reactions of Telegram Desktop exports
+    assert reaction_emoji({'type': 'emoji', 'emoji': '👍', 'count': 3}) == '👍'
+    assert reaction_emoji({'type': 'custom_emoji', 'document_id': '5368324170671202286'}) == 'CustomEmoji:5368324170671202286'
+    assert reaction_emoji({'type': 'paid', 'count': 1}) == 'UnknownEmoji'
+
+
+def test_reaction_counts_and_formatted_reactions_agree():
+    reactions = MessageReactions(results=[
+        ReactionCount(reaction=ReactionEmoji(emoticon='❤'), count=5),
+        ReactionCount(reaction=ReactionCustomEmoji(document_id=42), count=2),
+        ReactionCount(reaction=ReactionPaid(), count=1),
+    ])
+    assert reaction_counts(reactions) == [
+        {'emoji': '❤', 'count': 5}, {'emoji': 'CustomEmoji:42', 'count': 2}, {'emoji': 'UnknownEmoji', 'count': 1},
+    ]
+    assert format_reactions(reactions) == '❤:5, CustomEmoji:42:2, UnknownEmoji:1'
+    assert reaction_counts(None) == [] and format_reactions(None) == ''
@@ -0,0 +1,134 @@
+"""
+Tests of the MinHash/LSH clustering of NearDuplicateIndex.
+
+Usage (from the repository root):
+
+    python -m pytest -q tests/test_near_duplicates.py
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from telegram_api.near_duplicates import NearDuplicateIndex, NUM_PERM, BANDS, normalize_text, assign_clusters
+
+TEXT = (
+    "The quarterly community report is out today with the latest market analysis, "
+    "the roadmap for the next release and a summary of every partnership announced this month"
+)
+# One word changed
+NEAR_COPY = TEXT.replace("latest", "newest")
+# The same text once normalized
+SAME_COPY = TEXT.upper().replace(",", " !!")
+UNRELATED = (
+    "Weather forecast for the weekend: heavy rain on Saturday morning, clearing up in the "
+    "afternoon, with sunny skies and light winds expected on Sunday across the region"
+)
+
+
+def count(path, table):
+    with sqlite3.connect(path) as conn:
+        return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'index' / 'near_duplicates.sqlite')
+
+
+def test_signatures_have_one_value_per_permutation_and_band_keys_one_per_band(path):
+    index = NearDuplicateIndex(path)
+    signatures = index.signatures([normalize_text(TEXT), normalize_text(UNRELATED)])
+    assert signatures.shape == (2, NUM_PERM)
+    assert index.band_keys(signatures).shape == (2, BANDS)
+    # The hash functions are seeded, so every index computes the same signatures
+    other = NearDuplicateIndex(path + '.other')
+    assert (other.signatures([normalize_text(TEXT)]) == signatures[:1]).all()
+
+
+def test_an_existing_index_keeps_its_parameters(path, caplog):
+    NearDuplicateIndex(path, num_perm=32, bands=8).close()
+    with caplog.at_level(logging.WARNING):
+        index = NearDuplicateIndex(path)
+    assert (index.num_perm, index.bands) == (32, 8)
+    assert 'keeping them' in caplog.text
+    assert index.signatures([normalize_text(TEXT)]).shape == (1, 32)
+
+
+def test_bands_must_divide_the_permutations(path):
+    with pytest.raises(ValueError):
+        NearDuplicateIndex(path, num_perm=64, bands=10)
+
+
+def test_identical_and_near_identical_texts_join_the_first_cluster(path):
+    index = NearDuplicateIndex(path)
+    assert index.assign(-1001234, 1, TEXT) == '1234:1'
+    assert index.assign(1234, 2, SAME_COPY) == '1234:1'
+    assert index.assign(5678, 3, NEAR_COPY) == '1234:1'
+    assert index.assign(1234, 4, UNRELATED) == '1234:4'
+    assert index.duplicates == 2
+
+
+def test_short_texts_are_not_clustered(path):
+    index = NearDuplicateIndex(path)
+    assert index.assign_many([(1, 1, "thanks!"), (1, 2, None), (1, 3, "")]) == [None, None, None]
+    assert index.assigned == 0
+
+
+def test_texts_without_spaces_are_clustered(path):
+    index = NearDuplicateIndex(path)
+    text = "今日は市場の最新分析と次のリリースのロードマップを含む四半期コミュニティレポートを公開しました"
+    assert index.assign(1, 1, text) == '1:1'
+    assert index.assign(1, 2, text + "。") == '1:1'
+
+
+def test_only_the_first_message_of_a_cluster_is_indexed(path):
+    index = NearDuplicateIndex(path)
+    index.assign(1, 1, TEXT)
+    index.commit()
+    bands = count(path, 'bands')
+    assert bands == BANDS
+
+    index.assign_many([(1, 2, NEAR_COPY), (1, 3, SAME_COPY)])
+    index.commit()
+    assert count(path, 'bands') == bands
+    assert count(path, 'clusters') == 1
+
+
+def test_messages_of_a_batch_are_clustered_with_each_other(path):
+    index = NearDuplicateIndex(path)
+    clusters = index.assign_many([(1, 1, TEXT), (1, 2, UNRELATED), (1, 3, NEAR_COPY)])
+    assert clusters == ['1:1', '1:2', '1:1']
+
+
+def test_reruns_return_the_same_clusters_without_new_founders(path):
+    messages = [(1, 1, TEXT), (1, 2, UNRELATED), (1, 3, NEAR_COPY), (2, 7, SAME_COPY)]
+    index = NearDuplicateIndex(path)
+    first = index.assign_many(messages)
+    assert first == ['1:1', '1:2', '1:1', '1:1']
+    # An overwrite within the same run
+    assert index.assign_many(messages) == first
+    index.close()
+
+    # A backload of the same messages in a later run, in another order
+    index = NearDuplicateIndex(path)
+    assert index.assign_many(messages[::-1]) == first[::-1]
+    index.close()
+    assert count(path, 'clusters') == 2
+    assert count(path, 'bands') == 2 * BANDS
+
+
+def test_assign_clusters_fills_the_rows(path):
+    index = NearDuplicateIndex(path)
+    rows = [
+        {'chat_id': 1, 'id': 1, 'text': TEXT},
+        {'chat_id': 1, 'id': 2, 'text': NEAR_COPY},
+        {'chat_id': 1, 'id': 3, 'text': "ok"},
+    ]
+    asyncio.run(assign_clusters(index, rows))
+    assert [row['duplicate_cluster'] for row in rows] == ['1:1', '1:1', None]
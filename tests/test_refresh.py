@@ -0,0 +1,127 @@
+"""
+Tests of the refresh mode: a message that did not change hashes the same fresh from
+MessageTransformer and read back from a sink, so only changed messages are merged.
+
+Runs against the synthetic channel of the benchmark fakes and a local DuckDB sink;
+needs the packages of requirements-local.txt.
+
+Usage (from the repository root):
+
+    python -m pytest -q tests/test_refresh.py
+"""
+import asyncio
+import os
+import sys
+from datetime import timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+
+pytest.importorskip('duckdb')
+pytest.importorskip('pytz')
+
+from fakes import FakeTelegramClient
+from sinks.duckdb_sink import DuckDBSink
+from telegram_api.data_processor import DataProcessor
+from telegram_api.message_transformer import MessageTransformer, mutable_hash, standardize_chat_id
+from telethon.tl.types import MessageReactions, ReactionCount, ReactionEmoji
+
+USERNAME = 'refresh_channel'
+MESSAGES = 300
+
+
+class ChangingTelegramClient(FakeTelegramClient):
+    """
+    Serves the synthetic channel with some messages changed or deleted since they were loaded.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.changes = {}
+        self.deleted = set()
+
+    def message(self, chat, message_id):
+        message = super().message(chat, message_id)
+        for field, value in self.changes.get(message_id, {}).items():
+            setattr(message, field, value)
+        return message
+
+    async def get_messages(self, chat, ids=None, **kwargs):
+        messages = await super().get_messages(chat, ids=ids, **kwargs)
+        return [None if message is not None and message.id in self.deleted else message for message in messages]
+
+
+class RecordingWriter:
+    def __init__(self):
+        self.rows = []
+
+    async def add(self, row):
+        self.rows.append(row)
+
+
+@pytest.fixture(params=[True, False], ids=['legacy columns', 'structured columns only'])
+def loaded(request, tmp_path):
+    """
+    A client and a DuckDB sink holding every message of the client's channel, as get_chat_history writes them.
+    """
+    legacy_columns = request.param
+    client = ChangingTelegramClient(messages_per_chat=MESSAGES, span=timedelta(days=3))
+    sink = DuckDBSink(str(tmp_path / 'sink.duckdb'))
+    chat = client._chat(USERNAME)
+    transformer = MessageTransformer(client, legacy_columns=legacy_columns)
+    rows = [transformer.transform(client.message(chat, message_id)) for message_id in range(1, MESSAGES + 1)]
+    assert asyncio.run(sink.upload_rows('chat_history', rows))
+    yield client, sink, chat, legacy_columns, rows
+    sink.close()
+
+
+def test_unchanged_rows_read_back_from_the_sink_hash_equal(loaded):
+    client, sink, chat, legacy_columns, rows = loaded
+    processor = DataProcessor(client, sink, legacy_columns=legacy_columns)
+    stored = asyncio.run(sink.load_mutable_fields(
+        standardize_chat_id(chat.id), client.end - client.span - timedelta(days=1), client.end, processor.mutable_columns,
+    ))
+    assert len(stored) == MESSAGES
+    fresh = {row['id']: mutable_hash(row, processor.mutable_columns) for row in rows}
+    assert [row['id'] for row in stored if mutable_hash(row, processor.mutable_columns) != fresh[row['id']]] == []
+    # The fixture covers what the normalization has to reconcile
+    assert any(not row['reaction_counts'] for row in rows) and any(row['reaction_counts'] for row in rows)
+    assert any(row['edit_date'] for row in rows) and any(not row['replies'] for row in rows)
+
+
+def test_only_changed_messages_reach_the_merge_writer(loaded):
+    client, sink, chat, legacy_columns, _ = loaded
+    client.changes = {
+        10: {'views': 123456789},
+        20: {'reactions': MessageReactions(results=[ReactionCount(reaction=ReactionEmoji('🆕'), count=1)])},
+        30: {'message': 'edited text', 'entities': []},
+    }
+    client.deleted = {40}
+    processor = DataProcessor(client, sink, legacy_columns=legacy_columns)
+    start_date, end_date = client.end - client.span - timedelta(days=1), client.end
+
+    writer = RecordingWriter()
+    assert asyncio.run(processor.refresh_chat(USERNAME, start_date, end_date, writer)) == 3
+    assert sorted(row['id'] for row in writer.rows) == [10, 20, 30]
+
+    async def merge():
+        async with sink.merge_writer(processor.mutable_columns, start_date, end_date, 100, float('inf')) as merge_writer:
+            await processor.refresh_chat(USERNAME, start_date, end_date, merge_writer)
+        return merge_writer
+
+    merge_writer = asyncio.run(merge())
+    assert merge_writer.rows_loaded == 3 and merge_writer.rows_failed == 0
+    assert sink._execute("SELECT views FROM chat_history WHERE id = 10") == [(123456789,)]
+    assert sink._execute("SELECT text FROM chat_history WHERE id = 30") == [('edited text',)]
+    # Once merged, nothing differs any more
+    assert asyncio.run(processor.refresh_chat(USERNAME, start_date, end_date, RecordingWriter())) == 0
+
+
+def test_nulls_hash_like_the_defaults_the_transformer_writes():
+    columns = ('text', 'views', 'forwards', 'replies', 'edit_date', 'reaction_counts', 'reactions')
+    fresh = {'text': '', 'views': 0, 'forwards': 0, 'replies': 0, 'edit_date': 0.0, 'reaction_counts': [], 'reactions': ''}
+    assert mutable_hash(dict.fromkeys(columns), columns) == mutable_hash(fresh, columns)
+    stored = {**fresh, 'reaction_counts': [{'emoji': '👍', 'count': None}]}
+    assert mutable_hash(stored, columns) == mutable_hash({**fresh, 'reaction_counts': [{'emoji': '👍', 'count': 0}]}, columns)
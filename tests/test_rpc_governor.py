@@ -0,0 +1,202 @@
+"""
+Tests of the RPC pacing of RpcGovernor and of the account rotation of ClientPool
+on flood waits. Time is simulated, so no test sleeps.
+
+Usage (from the repository root):
+
+    python -m pytest -q tests/test_rpc_governor.py
+"""
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+
+from telethon import errors
+from telethon.tl.functions.messages import GetHistoryRequest
+from telethon.tl.functions.users import GetUsersRequest
+
+from fakes import FakeTelegramClient
+import telegram_api.rpc_governor as rpc_governor
+from telegram_api.rpc_governor import BURST, INCREASE_AFTER, RpcGovernor, TokenBucket
+from telegram_api.client_pool import ClientPool
+
+
+class FakeClock:
+    """
+    Stands in for the time and asyncio modules of rpc_governor: sleeping advances the clock.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rpc_governor, 'time', clock)
+    monkeypatch.setattr(rpc_governor, 'asyncio', clock)
+    return clock
+
+
+class ScriptedCall:
+    """
+    A fake `_call` that raises a FloodWaitError for each of `waits`, then succeeds.
+    """
+
+    def __init__(self, *waits):
+        self.waits = list(waits)
+        self.calls = []
+
+    async def __call__(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        self.calls.append(flood_sleep_threshold)
+        if self.waits:
+            raise errors.FloodWaitError(request=request, capture=self.waits.pop(0))
+        return 'result'
+
+
+def request():
+    return GetUsersRequest([])
+
+
+def test_flood_waits_halve_the_rate_and_block_the_bucket(clock):
+    bucket = TokenBucket(8.0)
+    bucket.on_flood_wait(30)
+    assert bucket.rate == 4.0
+    assert bucket.blocked_until == clock.now + 30
+    assert bucket.reserve() == 30.0
+    # Down to the minimum rate at most
+    for _ in range(10):
+        bucket.on_flood_wait(1)
+    assert bucket.rate == bucket.min_rate == 8.0 / 32
+
+
+def test_successes_raise_the_rate_by_ten_percent_after_a_streak(clock):
+    bucket = TokenBucket(10.0)
+    for _ in range(INCREASE_AFTER - 1):
+        bucket.on_success()
+    assert bucket.rate == 10.0
+    bucket.on_success()
+    assert bucket.rate == pytest.approx(11.0)
+
+    # A flood wait restarts the streak
+    for _ in range(INCREASE_AFTER - 1):
+        bucket.on_success()
+    bucket.on_flood_wait(1)
+    bucket.on_success()
+    assert bucket.rate == pytest.approx(5.5)
+
+
+def test_the_rate_is_capped():
+    bucket = TokenBucket(1.0, max_rate=1.05)
+    for _ in range(INCREASE_AFTER):
+        bucket.on_success()
+    assert bucket.rate == 1.05
+
+
+def test_buckets_allow_a_burst_then_pace_requests(clock):
+    bucket = TokenBucket(2.0)
+    delays = [bucket.reserve() for _ in range(BURST + 2)]
+    assert delays == [0.0] * BURST + [0.5, 1.0]
+
+
+def test_flood_waits_are_slept_through_and_retried(clock):
+    governor = RpcGovernor(rates={'GetUsersRequest': 4.0})
+    call = ScriptedCall(5, 7)
+    assert asyncio.run(governor.call(call, None, request=request())) == 'result'
+    assert len(call.calls) == 3
+    bucket = governor.buckets['GetUsersRequest']
+    assert bucket.rate == 1.0 and bucket.flood_waits == 2 and bucket.flood_wait_seconds == 12
+    assert sum(clock.slept) >= 12
+
+
+def test_flood_waits_above_the_maximum_are_raised(clock):
+    governor = RpcGovernor(max_flood_sleep=60)
+    call = ScriptedCall(61)
+    with pytest.raises(errors.FloodWaitError):
+        asyncio.run(governor.call(call, None, request=request()))
+    assert len(call.calls) == 1
+    assert clock.slept == []
+    assert governor.buckets['GetUsersRequest'].blocked_until == clock.now + 61
+
+
+def test_install_takes_flood_waits_over_from_telethon(clock):
+    call = ScriptedCall(30, 30)
+    client = SimpleNamespace(_call=call, flood_sleep_threshold=60)
+    RpcGovernor(max_flood_sleep=60).install(client)
+    assert client.flood_sleep_threshold == 0
+    assert client.rpc_governor is not None
+
+    # Telethon never sleeps through a flood wait itself
+    assert asyncio.run(client._call(None, request())) == 'result'
+    assert call.calls == [0, 0, 0]
+
+    # The threshold a request is sent with caps the waits slept through
+    call.waits = [30]
+    with pytest.raises(errors.FloodWaitError):
+        asyncio.run(client._call(None, request(), flood_sleep_threshold=10))
+
+
+def test_flood_waited_accounts_are_rotated_out():
+    clients = [FakeTelegramClient(), FakeTelegramClient()]
+    pool = ClientPool(clients, names=['a', 'b'])
+    home = pool.home('chat')
+    other = 1 - home
+    assert pool.acquire('chat') == (pool.names[home], clients[home])
+
+    clients[home].flood_wait(300)
+    assert pool.acquire('chat') == (pool.names[other], clients[other])
+    assert pool.rotations[home] == 1
+    assert 299 <= pool.wait_seconds[home] <= 300
+
+    # With every account waiting, the wait that ends first wins
+    clients[other].flood_wait(100)
+    assert pool.acquire('chat')[1] is clients[other]
+
+
+def test_waits_the_governor_sleeps_through_keep_the_account():
+    clients = [FakeTelegramClient(), FakeTelegramClient()]
+    pool = ClientPool(clients)
+    pool.install_governors(max_flood_sleep=60)
+    home = pool.home('chat')
+
+    clients[home].flood_wait(30, request=GetHistoryRequest)
+    assert pool.acquire('chat')[1] is clients[home]
+    clients[home].flood_wait(120, request=GetHistoryRequest)
+    assert pool.acquire('chat')[1] is clients[1 - home]
+    assert time.time() < pool.flood_wait_until(home)
+
+
+def test_chats_failed_by_a_flood_wait_are_moved_to_a_free_account():
+    clients = [FakeTelegramClient(), FakeTelegramClient(), FakeTelegramClient()]
+    pool = ClientPool(clients, names=['a', 'b', 'c'])
+    account, client = pool.acquire('chat')
+    home = pool.names.index(account)
+
+    # A chat that failed for another reason is not retried
+    assert pool.reacquire('chat', account) is None
+
+    client.flood_wait(300)
+    nxt = (home + 1) % 3
+    assert pool.reacquire('chat', account) == (pool.names[nxt], clients[nxt])
+    assert pool.rotations[home] == 1 and pool.chats[nxt] == 1
+
+    # Accounts still waiting are skipped, and with none free the chat stays failed
+    clients[nxt].flood_wait(300)
+    last = (home + 2) % 3
+    assert pool.reacquire('chat', pool.names[nxt]) == (pool.names[last], clients[last])
+    clients[last].flood_wait(300)
+    assert pool.reacquire('chat', pool.names[last]) is None
@@ -0,0 +1,131 @@
+"""
+Tests of the crash recovery of the local load spool.
+
+Every test writes segments, simulates a crash by leaving the spool directory in
+the state a killed process would, and checks what a reopened spool replays.
+
+Usage (from the repository root):
+
+    python -m pytest -q tests/test_spool.py
+"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from spool import Spool, MANIFEST
+
+
+def manifest(directory):
+    with open(os.path.join(directory, MANIFEST), encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def files(directory):
+    return sorted(name for name in os.listdir(directory) if name != MANIFEST)
+
+
+def test_unacked_segments_are_replayed_on_open(tmp_path):
+    directory = str(tmp_path / 'spool')
+    spool = Spool(directory)
+    first = spool.append('chat_history', 'json', 2, b'{"id": 1}\n{"id": 2}\n')
+    second = spool.append('chat_history', 'parquet', 1, b'PAR1 rows PAR1')
+    spool.append('user_info', 'json', 1, b'{"id": 3}\n')
+    spool.remove(spool.pending()[-1]['segment'])
+
+    # The process dies here: the first two segments were never acked
+    spool = Spool(directory)
+    assert [record['segment'] for record in spool.pending()] == [first, second]
+    assert len(spool) == 2 and spool.pending_rows == 3
+    assert spool.read(first) == b'{"id": 1}\n{"id": 2}\n'
+    assert spool.read(second) == b'PAR1 rows PAR1'
+    assert files(directory) == [first, second]
+
+
+def test_acked_segments_are_gone_after_reopening(tmp_path):
+    directory = str(tmp_path)
+    spool = Spool(directory)
+    segment = spool.append('chat_history', 'json', 1, b'{}\n')
+    spool.remove(segment)
+    spool = Spool(directory)
+    assert spool.pending() == [] and files(directory) == []
+    # The manifest is compacted once nothing is pending
+    assert manifest(directory) == []
+
+
+def test_a_torn_last_manifest_line_is_ignored(tmp_path):
+    directory = str(tmp_path)
+    spool = Spool(directory)
+    kept = spool.append('chat_history', 'json', 1, b'kept')
+    torn = spool.append('chat_history', 'json', 1, b'torn')
+    # A crash in the middle of appending the 'add' record of the second segment
+    path = os.path.join(directory, MANIFEST)
+    with open(path, encoding='utf-8') as f:
+        lines = f.readlines()
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(lines[0] + lines[1][:len(lines[1]) // 2])
+
+    spool = Spool(directory)
+    assert [record['segment'] for record in spool.pending()] == [kept]
+    # Without its record the second segment is dropped, and the manifest is whole again
+    assert files(directory) == [kept]
+    assert [record['segment'] for record in manifest(directory)] == [kept]
+    assert torn not in files(directory)
+
+
+def test_interrupted_appends_leave_nothing_behind(tmp_path):
+    directory = str(tmp_path)
+    spool = Spool(directory)
+    kept = spool.append('chat_history', 'json', 1, b'kept')
+    # A crash while writing a segment, and one between its rename and its 'add' record
+    with open(os.path.join(directory, '0000000002.chat_history.json.gz.tmp'), 'wb') as f:
+        f.write(b'partial')
+    with open(os.path.join(directory, '0000000003.chat_history.parquet'), 'wb') as f:
+        f.write(b'unrecorded')
+
+    spool = Spool(directory)
+    assert [record['segment'] for record in spool.pending()] == [kept]
+    assert files(directory) == [kept]
+    # New segments never reuse the name of a recorded one
+    new = spool.append('chat_history', 'json', 1, b'new')
+    assert new > kept
+    assert spool.read(new) == b'new'
+
+
+def test_segments_acked_but_not_deleted_are_removed_on_open(tmp_path):
+    directory = str(tmp_path)
+    spool = Spool(directory)
+    segment = spool.append('chat_history', 'json', 1, b'loaded')
+    pending = spool.append('chat_history', 'json', 1, b'pending')
+    # A crash between the 'done' record and the delete
+    record = spool.pending()[0]
+    spool._log({'op': 'done', 'seq': record['seq'], 'segment': segment})
+
+    spool = Spool(directory)
+    assert [record['segment'] for record in spool.pending()] == [pending]
+    assert files(directory) == [pending]
+
+
+def test_recorded_segments_whose_file_is_missing_are_dropped(tmp_path):
+    directory = str(tmp_path)
+    spool = Spool(directory)
+    segment = spool.append('chat_history', 'json', 1, b'lost')
+    os.remove(os.path.join(directory, segment))
+    spool = Spool(directory)
+    assert spool.pending() == []
+
+
+def test_replayed_segments_can_be_acked(tmp_path):
+    directory = str(tmp_path)
+    spool = Spool(directory)
+    for i in range(3):
+        spool.append('chat_history', 'json', 1, f'{{"id": {i}}}'.encode())
+
+    spool = Spool(directory)
+    payloads = []
+    for record in spool.pending():
+        payloads.append(spool.read(record['segment']))
+        spool.remove(record['segment'])
+    assert payloads == [b'{"id": 0}', b'{"id": 1}', b'{"id": 2}']
+    assert len(Spool(directory)) == 0 and files(directory) == []
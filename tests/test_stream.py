@@ -0,0 +1,221 @@
+"""
+Tests of how StreamIngestor moves the chats' watermarks over streamed messages
+and merges the events it receives during a catch-up.
+
+Usage (from the repository root):
+
+    python -m pytest -q tests/test_stream.py
+"""
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+
+from fakes import FakeTelegramClient
+from telegram_api.message_transformer import MessageTransformer
+from telegram_api.stream import StreamIngestor
+
+
+class FakeSink:
+    """
+    Records the streamed rows and the watermark updates.
+    """
+
+    def __init__(self):
+        self.rows = []
+        self.watermarks = []
+
+    async def stream_rows(self, table_type, rows):
+        if table_type == 'chat_history':
+            self.rows.extend(rows)
+        return True
+
+    async def update_watermark(self, chat_id, last_message_id, last_message_date):
+        self.watermarks.append(last_message_id)
+
+
+class FakeProcessor:
+    """
+    Stands in for DataProcessor, with a catch-up that runs `fetch(min_id)`.
+    """
+
+    legacy_columns = False
+    near_duplicates = None
+    user_cache = None
+
+    def __init__(self, sink, users):
+        self.sink = sink
+        self.existing_users = {str(user_id) for user_id in range(1, users + 1)}
+        self.existing_chats = set()
+        self.new_chats = {}
+        self.fetch = None
+
+    async def catch_up(self, client, username, chat, chat_config, start_date, end_date, min_id=0):
+        return await self.fetch(min_id)
+
+    async def upload_new_data(self):
+        pass
+
+
+class Stream:
+    def __init__(self, last_message_id=10):
+        self.client = FakeTelegramClient(messages_per_chat=100, users=5)
+        self.chat = self.client._chat('chat')
+        self.sink = FakeSink()
+        self.processor = FakeProcessor(self.sink, users=5)
+        self.ingestor = StreamIngestor(self.processor, None, {}, [])
+        config = {'id': 'chat', 'last_message_id': last_message_id, 'last_message_date': self.message(last_message_id).date}
+        self.ingestor.chats[self.chat.id] = {'username': 'chat', 'chat': self.chat, 'client': self.client, 'account': 'main', 'config': config}
+        self.ingestor._last_ids[self.chat.id] = last_message_id
+        self.ingestor._transformers[self.chat.id] = MessageTransformer(self.client)
+
+    def message(self, message_id, edit_date=None):
+        message = self.client.message(self.chat, message_id)
+        message.edit_date = edit_date
+        return message
+
+    async def new(self, *message_ids):
+        for message_id in message_ids:
+            await self.ingestor._on_new_message(SimpleNamespace(chat_id=self.chat.id, message=self.message(message_id)))
+
+    async def edit(self, message_id, edit_date):
+        await self.ingestor._on_message_edited(SimpleNamespace(chat_id=self.chat.id, message=self.message(message_id, edit_date)))
+
+    @property
+    def watermark(self):
+        return self.ingestor._last_ids[self.chat.id]
+
+    def written(self):
+        return [(row['id'], bool(row['edit_date'])) for row in self.sink.rows]
+
+
+def test_out_of_order_messages_advance_the_watermark_once_contiguous():
+    async def run():
+        stream = Stream()
+        await stream.new(12)
+        await stream.ingestor.flush()
+        assert stream.watermark == 10 and stream.sink.watermarks == []
+
+        await stream.new(11)
+        await stream.ingestor.flush()
+        assert stream.watermark == 12 and stream.sink.watermarks == [12]
+
+        # Within one batch too
+        await stream.new(14, 13)
+        await stream.ingestor.flush()
+        assert stream.watermark == 14 and stream.sink.watermarks == [12, 14]
+        assert stream.ingestor._streamed[stream.chat.id] == {}
+
+    asyncio.run(run())
+
+
+def test_new_messages_below_the_watermark_are_ignored():
+    async def run():
+        stream = Stream()
+        await stream.new(9, 10)
+        await stream.ingestor.flush()
+        assert stream.sink.rows == [] and stream.sink.watermarks == []
+
+    asyncio.run(run())
+
+
+def test_a_gap_holds_the_watermark_until_the_catch_up_fills_it():
+    async def run():
+        stream = Stream()
+        await stream.new(11, 13)
+        await stream.ingestor.flush()
+        assert stream.watermark == 11 and stream.sink.watermarks == [11]
+
+        min_ids = []
+
+        async def fetch(min_id):
+            min_ids.append(min_id)
+            # The catch-up loads the missing message and skips the streamed one
+            return True, (12, stream.message(12).date)
+
+        stream.processor.fetch = fetch
+        await stream.ingestor.catch_up([stream.chat.id])
+        assert min_ids == [11]
+        assert stream.watermark == 13 and stream.sink.watermarks == [11, 13]
+        assert stream.ingestor._streamed[stream.chat.id] == {}
+
+    asyncio.run(run())
+
+
+def test_a_failed_catch_up_keeps_the_watermark():
+    async def run():
+        stream = Stream()
+        await stream.new(11, 13)
+        await stream.ingestor.flush()
+
+        async def fetch(min_id):
+            return False, None
+
+        stream.processor.fetch = fetch
+        await stream.ingestor.catch_up([stream.chat.id])
+        assert stream.watermark == 11 and stream.sink.watermarks == [11]
+        assert 13 in stream.ingestor._streamed[stream.chat.id]
+
+    asyncio.run(run())
+
+
+def test_events_during_a_catch_up_are_merged_with_what_it_fetched():
+    async def run():
+        stream = Stream()
+        later = datetime.now(timezone.utc) + timedelta(hours=1)
+
+        async def fetch(min_id):
+            # Live events overlapping the messages the catch-up fetches
+            await stream.new(11, 12, 13)
+            await stream.edit(11, stream.message(11).date + timedelta(minutes=1))
+            await stream.edit(12, later)
+            return True, (12, stream.message(12).date)
+
+        stream.processor.fetch = fetch
+        await stream.ingestor.catch_up([stream.chat.id])
+        assert stream.watermark == 12 and stream.sink.watermarks == []
+
+        await stream.ingestor.flush()
+        # 11 and 12 were fetched by the catch-up, as was the edit of 11 but not the later one of 12
+        assert stream.written() == [(13, False), (12, True)]
+        assert stream.watermark == 13 and stream.sink.watermarks == [13]
+
+    asyncio.run(run())
+
+
+def test_edits_of_streamed_rows_add_a_version_without_moving_the_watermark():
+    async def run():
+        stream = Stream()
+        await stream.new(11)
+        await stream.ingestor.flush()
+        await stream.edit(11, datetime.now(timezone.utc))
+        await stream.edit(5, datetime.now(timezone.utc))
+        await stream.ingestor.flush()
+        assert stream.written() == [(11, False), (11, True), (5, True)]
+        assert stream.watermark == 11 and stream.sink.watermarks == [11]
+
+    asyncio.run(run())
+
+
+def test_edits_held_during_a_catch_up_of_streamed_rows_are_kept():
+    async def run():
+        stream = Stream()
+        await stream.new(11, 13)
+        await stream.ingestor.flush()
+
+        async def fetch(min_id):
+            # 13 was streamed, so the catch-up skipped it and did not see the edit
+            await stream.edit(13, stream.message(13).date + timedelta(minutes=1))
+            return True, (12, stream.message(12).date)
+
+        stream.processor.fetch = fetch
+        await stream.ingestor.catch_up([stream.chat.id])
+        await stream.ingestor.flush()
+        assert stream.written() == [(11, False), (13, False), (13, True)]
+        assert stream.watermark == 13
+
+    asyncio.run(run())
@@ -0,0 +1,135 @@
+"""
+Tests of the persistent user cache and of the batched user lookups of get_users_info,
+against the synthetic users of the benchmark fakes.
+
+Usage (from the repository root):
+
+    python -m pytest -q tests/test_user_info.py
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+
+from telethon import errors
+from telethon.tl.functions.users import GetFullUserRequest, GetUsersRequest
+
+from fakes import FakeTelegramClient
+import telegram_api.user_cache as user_cache
+from telegram_api.user_cache import UserInfoCache
+from telegram_api.user_info import USERS_BATCH_SIZE, get_users_info
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(user_cache, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = UserInfoCache(str(tmp_path / 'users' / 'cache.sqlite'), ttl=100, evict_after=1000)
+    yield cache
+    cache.close()
+
+
+class CountingTelegramClient(FakeTelegramClient):
+    """
+    Counts the requests by type, and fails the GetFullUserRequest of the users in `full_user_errors`.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.requests = {}
+        self.full_user_errors = {}
+
+    async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        name = type(request).__name__
+        self.requests[name] = self.requests.get(name, 0) + 1
+        if isinstance(request, GetFullUserRequest) and request.id.user_id in self.full_user_errors:
+            raise self.full_user_errors[request.id.user_id]
+        return await super()._call(sender, request, ordered, flood_sleep_threshold)
+
+
+def test_cache_splits_fresh_and_stale_entries_and_evicts_old_ones(cache, clock):
+    cache.put_many({1: {'id': 1, 'bio': 'one'}})
+    clock.now += 60
+    cache.put_many({'2': {'id': 2, 'bio': 'two'}})
+    clock.now += 60
+
+    fresh, stale = cache.get_many([1, '2', 3])
+    assert fresh == {2: {'id': 2, 'bio': 'two'}}
+    assert stale == {1: {'id': 1, 'bio': 'one'}}
+
+    clock.now += 1000 - 120 + 1
+    assert cache.evict() == 1
+    assert cache.get_many([1, 2]) == ({}, {2: {'id': 2, 'bio': 'two'}})
+
+
+def test_cache_looks_up_more_ids_than_sqlite_binds_at_once(cache, clock):
+    cache.put_many({user_id: {'id': user_id} for user_id in range(1, 1201)})
+    fresh, stale = cache.get_many(range(1, 1301))
+    assert sorted(fresh) == list(range(1, 1201)) and stale == {}
+
+
+def test_cached_users_are_not_looked_up_again(cache, clock):
+    client = CountingTelegramClient()
+    user_ids = list(range(1, USERS_BATCH_SIZE + 51))
+
+    users = asyncio.run(get_users_info(client, user_ids, cache=cache))
+    assert users['7']['username'] == 'user7' and users['7']['bio'] == 'Bio of 7'
+    assert client.requests == {'GetUsersRequest': 2, 'GetFullUserRequest': len(user_ids)}
+
+    client.requests.clear()
+    assert asyncio.run(get_users_info(client, user_ids, cache=cache)) == users
+    assert client.requests == {}
+
+    # Stale users are fetched again, fresh ones are not
+    clock.now += 101
+    cache.put_many({1: users['1']})
+    asyncio.run(get_users_info(client, [1, 2], cache=cache))
+    assert client.requests == {'GetUsersRequest': 1, 'GetFullUserRequest': 1}
+
+
+def test_users_whose_full_profile_failed_are_not_cached(cache, clock, caplog):
+    client = CountingTelegramClient()
+    client.full_user_errors = {2: errors.FloodWaitError(request=GetFullUserRequest(None), capture=3600)}
+
+    users = asyncio.run(get_users_info(client, [1, 2], cache=cache))
+    assert users['2']['username'] == 'user2' and users['2']['bio'] is None
+    assert 'Could not fetch the full profile of 1 users' in caplog.text
+    fresh, stale = cache.get_many([1, 2])
+    assert list(fresh) == [1] and stale == {}
+
+    # The next lookup fetches the bio that failed
+    client.full_user_errors = {}
+    client.requests.clear()
+    users = asyncio.run(get_users_info(client, [1, 2], cache=cache))
+    assert users['2']['bio'] == 'Bio of 2'
+    assert client.requests == {'GetUsersRequest': 1, 'GetFullUserRequest': 1}
+    assert list(cache.get_many([2])[0]) == [2]
+
+
+def test_a_failed_refresh_keeps_the_stale_bio(cache, clock):
+    client = CountingTelegramClient()
+    asyncio.run(get_users_info(client, [3], cache=cache))
+    clock.now += 101
+    client.full_user_errors = {3: ConnectionError('reset')}
+
+    users = asyncio.run(get_users_info(client, [3], cache=cache))
+    assert users['3']['bio'] == 'Bio of 3'
+    # Still stale, so it is refreshed again the next time
+    assert cache.get_many([3])[0] == {}